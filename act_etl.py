@@ -4,6 +4,8 @@ import pyarrow
 import pyproj
 import configparser
 from crash_utilities import *
+from crash_storage import storage_path, storage_read_parquet
+from crash_pipeline import Stage, pipeline_runner, pipeline_fingerprint
 from datetime import datetime
 
 #read the config file to extract the aws credentials
@@ -12,8 +14,8 @@ config.read('config_file.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-#set the base s3_path for subsequent manipulation 
-s3_path = config['S3']['S3_BUCKET_PATH']
+#optional checkpoints of every pipeline stage's output - a rerun after a failure resumes from the last stage saved.
+checkpoint_dir = config.get('CACHE', 'CHECKPOINT_DIR', fallback=None) or None
 
 
 def act_description_harmoniser(df):
@@ -31,7 +33,7 @@ def act_description_harmoniser(df):
     
     #go down the list of things we can get for vic
     #severity - coerce to int bcause victoria records as int and dictionary accepts string keys
-    df['severity'] = df['crash_severity'].apply(lambda x: severity_dict[x])
+    df['severity'] = categorical_mapper(df['crash_severity'], severity_lookup)
     
     #build the crash type field out of EVENT_NATURE and EVENT_TYPE
 
@@ -41,12 +43,12 @@ def act_description_harmoniser(df):
 
     
     #road condition
-    df['road_sealed'] = df['road_condition'].apply(lambda x: road_sealed_dict[x])
-    df['road_wet'] = df['road_condition'].apply(lambda x: road_wet_dict[x])
+    df['road_sealed'] = categorical_mapper(df['road_condition'], road_sealed_lookup)
+    df['road_wet'] = categorical_mapper(df['road_condition'], road_wet_lookup)
     
     #other condition
-    df['weather'] = df['weather_condition'].apply(lambda x: weather_dict[x])
-    df['lighting'] = df['lighting_condition'].apply(lambda x: lighting_dict[x])
+    df['weather'] = categorical_mapper(df['weather_condition'], weather_lookup)
+    df['lighting'] = categorical_mapper(df['lighting_condition'], lighting_lookup)
 
     return df
 
@@ -66,10 +68,10 @@ def act_datetime_handler(df):
     df['date'] = df['crash_date'].str[0:10]
     df['time'] = df['crash_time'].dt.time.astype(str)
     
-    #concat and convert to datetime
-    df['datetime'] = ((df['date'] + ' ' + df['time'])
-                      .str.strip()
-                      .apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S')))
+    #concat and convert to datetime - cast once parsed, as a selection of years with no crashes leaves an empty, untyped column.
+    df['datetime'] = pd.to_datetime((df['date'] + ' ' + df['time'])
+                                    .str.strip()
+                                    .apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S')))
     
     #extract relevant parts
     df['year'] = df['datetime'].dt.year
@@ -81,9 +83,8 @@ def act_datetime_handler(df):
     #assign approximate false because information provided is sufficient.
     df = df.assign(approximate = False)
     
-    #generate id using string operations.
-    df['date_time_id'] = (df['year'].apply(str) + '-' + df['month'].apply(str) + '-' + df['day_of_month'].fillna('').apply(str) + '-' + df['day_of_week'].apply(str) 
-                         + '-' + df['hour'].apply(str))
+    #pack the parts into a single integer key - datetime_key_formatter gives back the legacy string.
+    df['date_time_id'] = datetime_key_builder(df)
     return df
     
 def act_location_handler(df):
@@ -100,7 +101,7 @@ def act_location_handler(df):
     logging.info('Parsing location data...')
     
     #generate the key field
-    df['lat_long'] = df[['latitude', 'longitude']].apply(lambda x: (x[0], x[1]), axis=1)
+    df['lat_long'] = location_key_builder(df['latitude'], df['longitude'])
     
     #assign country and state
     df = df.assign(country = 'AU')
@@ -112,37 +113,116 @@ def act_location_handler(df):
     return df
     
     
-def act_main():
+def act_data_loader(years = None, since = None):
     """
-    Function which conducts the etl to the final staging structure for new zealand data
+    Function which loads the australian capital territory crash data into memory as a pandas dataframe from the s3 storage location.
     ---
     
     Keyword Arguments:
-    None.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
     
     Returns:
-    Data frame containing the structure coerced appropriately to the correct format.
+    act_df -- pandas dataframe containing the australian capital territory crash data
     """
     #read the datasets
     logging.info('Read in datasets...')
-    act_df = pd.read_parquet(s3_path + '/crash_act/crash')
+    #crash_date is an iso date string so the year filter is pushed into the parquet scan as a string range.
+    act_df = storage_read_parquet(storage_path('crash_act', 'crash'), filters = year_filter_builder('crash_date', years, since, date_prefix = True))
     
-    #field harmonisation
+    return act_df
+
+def act_harmoniser(act_df):
+    """
+    Function which runs the field harmonisers.
+    ---
+    
+    Keyword Arguments:
+    act_df -- pandas dataframe of the raw australian capital territory crash data.
+    
+    Returns:
+    act_df -- pandas dataframe with the harmonised fields.
+    """
     logging.info('Harmonising and renaming fields...')
     act_df = act_description_harmoniser(act_df)
+    
+    return act_df
 
-    #field name changing
-    act_df = act_datetime_handler(act_df)
-    act_df = act_location_handler(act_df)
+def act_structure_coercer(act_df):
+    """
+    Function which assigns the crash ids and coerces the data to the final staging structure.
+    ---
+    
+    Keyword Arguments:
+    act_df -- pandas dataframe of the harmonised australian capital territory data.
     
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
     #generate the primary key field.
     logging.info('Generating IDs...')
     act_df['crash_id'] = act_df['crash_id'].astype(str).apply(lambda x: 'ACT'+x)
     
     logging.info('Coercing to final staging structure...')
-    act_df = structure_checker(act_df, expected_fields, coerce = True)
     
-    return act_df
+    return structure_checker(act_df, expected_fields, coerce = True)
+
+#the australian capital territory etl as a pipeline of stages, see crash_pipeline. Each stage is handed the outputs of its inputs in order.
+act_stages = [Stage('load', lambda params: act_data_loader(params['years'], params['since']), ['params']),
+              Stage('harmonise', act_harmoniser, ['load']),
+              Stage('datetime', act_datetime_handler, ['harmonise']),
+              Stage('location', act_location_handler, ['datetime']),
+              Stage('coerce', act_structure_coercer, ['location'])]
+
+def act_inputs(years = None, since = None):
+    """
+    Function which gives the run parameters and raw sources of the australian capital territory etl.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    params -- dictionary of run parameters handed to the stages.
+    sources -- list of storage paths of the raw data read.
+    """
+    sources = [storage_path('crash_act', 'crash')]
+    
+    return {'years': None if years is None else sorted(years), 'since': since}, sources
+
+def act_fingerprint(years = None, since = None):
+    """
+    Function which fingerprints the inputs of the australian capital territory etl - the raw sources' versions, the run parameters and the code. The fingerprint changes 
+    whenever a rerun could give a different result.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    fingerprint -- hex string.
+    """
+    params, sources = act_inputs(years, since)
+    
+    return pipeline_fingerprint('ACT', act_stages, params, [__file__], sources)
+
+def act_main(years = None, since = None):
+    """
+    Function which conducts the etl to the final staging structure for australian capital territory data
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
+    params, sources = act_inputs(years, since)
+    
+    return pipeline_runner('ACT', act_stages, params, checkpoint_dir, [__file__], sources)
 
 
 if __name__ is '__main__':
@@ -0,0 +1,80 @@
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+from crash_utilities import *
+
+def coordinate_transformer_benchmark(point_count = 2000000, max_workers = None, proj_string = sa_proj_string, repeats = 3):
+    """
+    Function which times map_coord_transformer over a synthetic set of coordinates for every worker count from 1 to max_workers.
+    ---
+    
+    Keyword Arguments:
+    point_count -- integer number of synthetic coordinates to project.
+    max_workers -- integer largest worker count to time. Defaults to the number of available cores.
+    proj_string -- projection string used for the benchmark. Defaults to the sa proj string.
+    repeats -- integer number of timed runs per worker count. The fastest run is reported.
+    
+    Returns:
+    results_df -- pandas dataframe containing workers, seconds, points_per_second and speedup relative to one worker.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    
+    #spread points over roughly the extent of the sa grid - the projection cost does not depend much on where the points are.
+    rng = np.random.default_rng(0)
+    coordinate_df = pd.DataFrame({'x': rng.uniform(900000, 1600000, point_count), 'y': rng.uniform(1500000, 2300000, point_count)})
+    
+    results = []
+    for workers in range(1, max_workers+1):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            map_coord_transformer(coordinate_df.copy(), proj_string, 'x', 'y', workers = workers)
+            timings.append(time.perf_counter() - start)
+        results.append({'workers': workers, 'seconds': min(timings)})
+        logging.info(f'Coordinate benchmark: {workers} workers took {min(timings):.3f} seconds.')
+    
+    results_df = pd.DataFrame(results)
+    results_df['points_per_second'] = point_count/results_df['seconds']
+    results_df['speedup'] = results_df['seconds'].iloc[0]/results_df['seconds']
+    
+    return results_df
+
+def vehicles_id_benchmark(row_count = 200000):
+    """
+    Function which compares the throughput of the row-wise vehicles_id_generator with the column-wise vehicles_id_builder on synthetic counts.
+    ---
+    
+    Keyword Arguments:
+    row_count -- integer number of synthetic crashes.
+    
+    Returns:
+    results_df -- pandas dataframe containing method, seconds and rows_per_second. Raises an AssertionError if the two methods disagree.
+    """
+    #mostly zeros with the odd car or two - roughly the shape of the real counts. The text column keeps rows mixed type as in the harmonisers.
+    rng = np.random.default_rng(0)
+    vehicle_df = pd.DataFrame(rng.poisson(0.15, size=(row_count, len(expected_vehicle_fields))), columns=expected_vehicle_fields)
+    vehicle_df['car_sedan'] = rng.poisson(1.5, size=row_count)
+    vehicle_df['crash_id'] = 'SA'
+    
+    start = time.perf_counter()
+    generator_ids = vehicle_df.apply(vehicles_id_generator, axis=1)
+    generator_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    builder_ids = vehicles_id_builder(vehicle_df)
+    builder_seconds = time.perf_counter() - start
+    
+    assert generator_ids.equals(builder_ids), 'vehicles_id_builder does not match vehicles_id_generator'
+    
+    results_df = pd.DataFrame({'method': ['vehicles_id_generator', 'vehicles_id_builder'], 'seconds': [generator_seconds, builder_seconds]})
+    results_df['rows_per_second'] = row_count/results_df['seconds']
+    
+    return results_df
+
+
+if __name__ == '__main__':
+    print(coordinate_transformer_benchmark().to_string(index=False))
+    print(vehicles_id_benchmark().to_string(index=False))
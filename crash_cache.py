@@ -0,0 +1,340 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow
+import pyarrow.parquet
+import pyproj
+from crash_storage import storage_info, storage_read_csv, storage_read_csv_chunks
+
+#options for the raw file mirror shared by every jurisdiction. refresh re-reads every raw file from the source and overwrites its mirrored copy.
+raw_cache_options = {'refresh': False, 'max_bytes': 10*1024**3}
+
+#rows per chunk when a filtered csv is read without the mirror - only the wanted rows of each chunk are kept.
+filtered_read_chunksize = 500000
+
+def coord_cache_file(cache_dir, proj_string):
+    """
+    Function which gives the parquet file holding the cached projections for a proj string.
+    ---
+    
+    Keyword Arguments:
+    cache_dir -- string path of the directory holding the coordinate cache.
+    proj_string -- projection string from the proj library describing the source coordinate system.
+    
+    Returns:
+    path -- string path of the cache file. The name is derived from the proj string and the proj version so that changing either starts a fresh file.
+    """
+    cache_key = hashlib.sha256(f'{proj_string}|{pyproj.proj_version_str}'.encode()).hexdigest()[:16]
+    
+    return os.path.join(cache_dir, f'coords_{cache_key}.parquet')
+
+def coord_cache_loader(cache_dir, proj_string):
+    """
+    Function which reads the cached projections for a proj string.
+    ---
+    
+    Keyword Arguments:
+    cache_dir -- string path of the directory holding the coordinate cache.
+    proj_string -- projection string from the proj library describing the source coordinate system.
+    
+    Returns:
+    cache_df -- pandas dataframe with columns x, y, calc_lat, calc_long and last_used. Empty if there is no valid cache for the proj string.
+    """
+    empty_df = pd.DataFrame({'x': pd.Series(dtype='float64'), 'y': pd.Series(dtype='float64'), 'calc_lat': pd.Series(dtype='float64'), 
+                             'calc_long': pd.Series(dtype='float64'), 'last_used': pd.Series(dtype='int64')})
+    cache_path = coord_cache_file(cache_dir, proj_string)
+    
+    if not os.path.exists(cache_path):
+        return empty_df
+    
+    table = pyarrow.parquet.read_table(cache_path)
+    metadata = table.schema.metadata or {}
+    
+    #the file name is only a short hash - confirm the file really belongs to this proj string and proj version before trusting it.
+    if (metadata.get(b'proj_string') != proj_string.encode() or metadata.get(b'proj_version') != pyproj.proj_version_str.encode()):
+        logging.warning(f'Coordinate cache {cache_path} does not match the requested projection. Invalidating.')
+        os.remove(cache_path)
+        return empty_df
+    
+    return table.to_pandas()
+
+def coord_cache_writer(cache_df, cache_dir, proj_string, max_rows):
+    """
+    Function which writes the cached projections for a proj string, evicting the least recently used points beyond max_rows.
+    ---
+    
+    Keyword Arguments:
+    cache_df -- pandas dataframe with columns x, y, calc_lat, calc_long and last_used.
+    cache_dir -- string path of the directory holding the coordinate cache.
+    proj_string -- projection string from the proj library describing the source coordinate system.
+    max_rows -- integer maximum number of points kept for the proj string.
+    
+    Returns:
+    None.
+    """
+    if len(cache_df) > max_rows:
+        logging.info(f'Evicting {len(cache_df) - max_rows} least recently used points from the coordinate cache...')
+        cache_df = cache_df.sort_values('last_used', ascending=False, kind='stable').head(max_rows)
+    
+    table = pyarrow.Table.from_pandas(cache_df.reset_index(drop=True), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'proj_string': proj_string.encode(), 
+                                           b'proj_version': pyproj.proj_version_str.encode()})
+    
+    #write beside the real file and swap it in so an interrupted run never leaves a half written cache.
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = coord_cache_file(cache_dir, proj_string)
+    pyarrow.parquet.write_table(table, cache_path + '.tmp')
+    os.replace(cache_path + '.tmp', cache_path)
+
+def cached_coordinate_transformer(proj_string, x, y, cache_dir, project, max_rows = 20000000, max_bytes = 2*1024**3):
+    """
+    Function which projects coordinates using the on disk cache, only sending points the cache has not seen to the projection function.
+    ---
+    
+    Keyword Arguments:
+    proj_string -- projection string from the proj library describing the source coordinate system.
+    x -- array like object containing the coordinates which will become latitude.
+    y -- array like object containing the coordinates which will become longitude.
+    cache_dir -- string path of the directory holding the coordinate cache.
+    project -- function accepting x and y numpy arrays and returning the latitude and longitude arrays for them.
+    max_rows -- integer maximum number of points kept in the cache for the proj string.
+    max_bytes -- integer maximum total size of the cache directory. Files for other proj strings are removed, oldest first, to stay within it.
+    
+    Returns:
+    lat_array -- numpy float64 array of calculated latitudes.
+    long_array -- numpy float64 array of calculated longitudes.
+    """
+    points_df = pd.DataFrame({'x': np.asarray(x, dtype='float64'), 'y': np.asarray(y, dtype='float64')})
+    
+    #work on distinct points - the same intersection turns up in many crashes.
+    unique_df = points_df.drop_duplicates().reset_index(drop=True)
+    cache_df = coord_cache_loader(cache_dir, proj_string)
+    lookup_df = unique_df.merge(cache_df, how='left', on=['x', 'y'])
+    
+    missing = lookup_df['calc_lat'].isna().to_numpy()
+    logging.info(f'Coordinate cache: {(~missing).sum()} of {len(lookup_df)} distinct points found, projecting the remainder...')
+    if missing.any():
+        lat_array, long_array = project(lookup_df.loc[missing, 'x'].to_numpy(), lookup_df.loc[missing, 'y'].to_numpy())
+        lookup_df.loc[missing, 'calc_lat'] = lat_array
+        lookup_df.loc[missing, 'calc_long'] = long_array
+    
+    #stamp every point used in this run so eviction keeps the points which keep turning up.
+    lookup_df['last_used'] = time.time_ns()
+    
+    #points with a missing coordinate are projected every time rather than stored under a nan key.
+    storable = lookup_df['x'].notna() & lookup_df['y'].notna()
+    untouched = ~pd.MultiIndex.from_frame(cache_df[['x', 'y']]).isin(pd.MultiIndex.from_frame(lookup_df[['x', 'y']]))
+    cache_df = pd.concat([cache_df[untouched], lookup_df[storable]], ignore_index=True)
+    coord_cache_writer(cache_df, cache_dir, proj_string, max_rows)
+    coord_cache_pruner(cache_dir, max_bytes)
+    
+    result_df = points_df.merge(lookup_df, how='left', on=['x', 'y'])
+    
+    return result_df['calc_lat'].to_numpy(dtype='float64'), result_df['calc_long'].to_numpy(dtype='float64')
+
+def coord_cache_pruner(cache_dir, max_bytes):
+    """
+    Function which removes whole coordinate cache files, least recently written first, until the directory fits within max_bytes. 
+    Files for proj strings that are no longer used stop being rewritten and so are the first to go.
+    ---
+    
+    Keyword Arguments:
+    cache_dir -- string path of the directory holding the coordinate cache.
+    max_bytes -- integer maximum total size of the cache files.
+    
+    Returns:
+    None.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    
+    #the sa and vic runs share the cache and may prune it at the same time - a file the other run has just removed is skipped.
+    cache_files = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('coords_') and name.endswith('.parquet'):
+            try:
+                cache_stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue
+            cache_files.append((cache_stat.st_mtime, cache_stat.st_size, os.path.join(cache_dir, name)))
+    cache_files.sort(reverse=True)
+    
+    total_bytes = 0
+    for _, cache_size, cache_path in cache_files:
+        total_bytes += cache_size
+        if total_bytes > max_bytes:
+            logging.info(f'Removing coordinate cache file {cache_path}...')
+            try:
+                os.remove(cache_path)
+            except FileNotFoundError:
+                pass
+
+def coord_cache_invalidator(cache_dir, proj_string = None):
+    """
+    Function which removes the cached projections for a proj string, or for every proj string.
+    ---
+    
+    Keyword Arguments:
+    cache_dir -- string path of the directory holding the coordinate cache.
+    proj_string -- projection string whose cache should be removed. If None the whole coordinate cache is removed.
+    
+    Returns:
+    None.
+    """
+    if proj_string is not None:
+        cache_files = [coord_cache_file(cache_dir, proj_string)]
+    elif os.path.isdir(cache_dir):
+        cache_files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.startswith('coords_') and name.endswith('.parquet')]
+    else:
+        cache_files = []
+    
+    for cache_path in cache_files:
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+def raw_object_signature(path):
+    """
+    Function which describes the current version of a raw source file so that a changed upload is never served from the mirror.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the raw file on the configured storage backend.
+    
+    Returns:
+    signature -- string combining the etag (s3 only), size and modification time of the object.
+    """
+    info = storage_info(path)
+    modified = info.get('LastModified', info.get('mtime', ''))
+    
+    return f"{info.get('ETag', '')}|{info.get('size', '')}|{modified}"
+
+def raw_cache_file(cache_dir, path, signature, read_kwargs):
+    """
+    Function which gives the parquet file mirroring one version of a raw source file.
+    ---
+    
+    Keyword Arguments:
+    cache_dir -- string path of the directory holding the raw file mirror.
+    path -- string path or url of the raw file.
+    signature -- string from raw_object_signature describing the version of the raw file.
+    read_kwargs -- dict of keyword arguments the raw file is read with. A change of columns or dtypes gives a different file.
+    
+    Returns:
+    path -- string path of the mirrored file. The name starts with a hash of the source path so older versions of the same file can be found and removed.
+    """
+    path_key = hashlib.sha256(path.encode()).hexdigest()[:16]
+    version_key = hashlib.sha256(f'{signature}|{json.dumps(read_kwargs, sort_keys=True, default=str)}'.encode()).hexdigest()[:16]
+    
+    return os.path.join(cache_dir, f'raw_{path_key}_{version_key}.parquet')
+
+def cached_csv_reader(path, cache_dir = None, row_filter = None, **read_kwargs):
+    """
+    Function which reads a raw csv through a local parquet mirror. The first read of each version of a file parses the csv and stores the result, 
+    later reads load the stored columnar copy instead.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the raw csv file.
+    cache_dir -- string path of the directory holding the raw file mirror. If None the csv is read directly.
+    row_filter -- function taking a dataframe and returning a boolean mask of the rows to keep. If None every row is kept. The mirror always holds 
+                  every row so runs with different filters share it.
+    read_kwargs -- keyword arguments passed on to pandas read_csv.
+    
+    Returns:
+    df -- pandas dataframe of the raw file.
+    """
+    if cache_dir is None:
+        if row_filter is None:
+            return storage_read_csv(path, **read_kwargs)
+        
+        #filter as the file streams in so the unwanted rows are never held together.
+        filtered_chunks = [chunk_df[row_filter(chunk_df)] for chunk_df in storage_read_csv_chunks(path, filtered_read_chunksize, **read_kwargs)]
+        return pd.concat(filtered_chunks, ignore_index=True)
+    
+    if row_filter is not None:
+        df = cached_csv_reader(path, cache_dir, **read_kwargs)
+        return df[row_filter(df)].reset_index(drop=True)
+    
+    cache_path = raw_cache_file(cache_dir, path, raw_object_signature(path), read_kwargs)
+    
+    if os.path.exists(cache_path) and not raw_cache_options['refresh']:
+        logging.info(f'Reading {path} from the raw file mirror...')
+        #touch the file so eviction keeps the files which are still being read.
+        os.utime(cache_path)
+        return pd.read_parquet(cache_path)
+    
+    df = storage_read_csv(path, **read_kwargs)
+    
+    try:
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as error:
+        #mixed type object columns cannot be stored as parquet - read these files directly every time.
+        logging.warning(f'{path} could not be mirrored as parquet and will be read from source each run: {error}')
+        return df
+    
+    #write beside the real file and swap it in so an interrupted run never leaves a half written copy.
+    os.makedirs(cache_dir, exist_ok=True)
+    pyarrow.parquet.write_table(table, cache_path + '.tmp')
+    os.replace(cache_path + '.tmp', cache_path)
+    
+    #older versions of this file will not be read again.
+    path_prefix = os.path.basename(cache_path).rsplit('_', 1)[0] + '_'
+    for name in os.listdir(cache_dir):
+        if name.startswith(path_prefix) and name.endswith('.parquet') and os.path.join(cache_dir, name) != cache_path:
+            raw_cache_remover(os.path.join(cache_dir, name))
+    
+    raw_cache_pruner(cache_dir, raw_cache_options['max_bytes'])
+    
+    return df
+
+def raw_cache_remover(cache_path):
+    """
+    Function which removes a mirrored file, ignoring files another reader has already removed.
+    ---
+    
+    Keyword Arguments:
+    cache_path -- string path of the mirrored file.
+    
+    Returns:
+    None.
+    """
+    try:
+        os.remove(cache_path)
+    except FileNotFoundError:
+        pass
+
+def raw_cache_pruner(cache_dir, max_bytes):
+    """
+    Function which removes mirrored files, least recently read first, until the raw file mirror fits within max_bytes.
+    ---
+    
+    Keyword Arguments:
+    cache_dir -- string path of the directory holding the raw file mirror.
+    max_bytes -- integer maximum total size of the mirrored files.
+    
+    Returns:
+    None.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    
+    cache_files = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('raw_') and name.endswith('.parquet'):
+            try:
+                cache_stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue
+            cache_files.append((cache_stat.st_mtime, cache_stat.st_size, os.path.join(cache_dir, name)))
+    cache_files.sort(reverse=True)
+    
+    total_bytes = 0
+    for _, cache_size, cache_path in cache_files:
+        total_bytes += cache_size
+        if total_bytes > max_bytes:
+            logging.info(f'Removing raw mirror file {cache_path}...')
+            raw_cache_remover(cache_path)
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+#options for the stage records. tracemalloc traces every allocation python makes, which slows a run down, so it is off unless asked for.
+instrumentation_options = {'tracemalloc': False}
+
+#records of the stages run in this process, in the order they finished, and any further sections for the run report, e.g. the final writes.
+stage_records = []
+report_sections = {}
+instrumentation_lock = threading.Lock()
+
+#running tracemalloc peak of every stage open in this process, innermost last. Stages nest, and each resets the one tracemalloc peak as it starts.
+traced_peaks = []
+
+def traced_peak_folder():
+    """
+    Function which folds the tracemalloc peak since the last reset into the running peak of every open stage, before the peak is reset or read.
+    ---
+    
+    Keyword Arguments:
+    None.
+    
+    Returns:
+    None.
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    traced_peaks[:] = [max(running_peak, peak) for running_peak in traced_peaks]
+
+def row_counter(obj):
+    """
+    Function which counts the rows of a stage's input or output.
+    ---
+    
+    Keyword Arguments:
+    obj -- dataframe, or tuple or list of dataframes. Anything else, e.g. the params dictionary, has no rows.
+    
+    Returns:
+    row_count -- integer number of rows. None if obj holds no dataframes.
+    """
+    if isinstance(obj, pd.DataFrame):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        counts = [row_counter(item) for item in obj]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    
+    return None
+
+def peak_rss_bytes():
+    """
+    Function which gives the peak resident set size of this process so far.
+    ---
+    
+    Keyword Arguments:
+    None.
+    
+    Returns:
+    peak_rss -- integer bytes. Linux reports the peak in kilobytes and macos in bytes.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    return peak_rss if sys.platform == 'darwin' else peak_rss*1024
+
+@contextmanager
+def stage_instrument(pipeline_name, stage_name, rows_in = None, source = 'run'):
+    """
+    Context manager which records the wall time, cpu time, rows and memory of a stage. The record is kept in stage_records and logged.
+    ---
+    
+    Keyword Arguments:
+    pipeline_name -- string name of the pipeline, e.g. SA.
+    stage_name -- string name of the stage, e.g. harmonise.
+    rows_in -- integer number of rows going into the stage, if known.
+    source -- string, run if the stage is run or checkpoint if its output is loaded from a checkpoint.
+    
+    Returns:
+    Yields the record dictionary. Set its rows_out, and its status if the stage did not complete, e.g. missed, before the block ends. The cpu time 
+    covers every thread of the process. The peak rss only grows, so its delta is how far the stage took the process beyond any earlier peak. The 
+    tracemalloc delta is only recorded if the option is on, and covers the whole stage even when inner stages reset the tracemalloc peak.
+    """
+    record = {'pipeline': pipeline_name, 'stage': stage_name, 'source': source, 'pid': os.getpid(), 'status': None, 'rows_in': rows_in,
+              'rows_out': None}
+    tracing = instrumentation_options['tracemalloc']
+    if tracing:
+        with instrumentation_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            traced_peak_folder()
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+            traced_peaks.append(traced_start)
+    
+    rss_start = peak_rss_bytes()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+        record['status'] = record['status'] or 'completed'
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        record['peak_rss_bytes'] = peak_rss_bytes()
+        record['peak_rss_delta_bytes'] = record['peak_rss_bytes'] - rss_start
+        if tracing:
+            with instrumentation_lock:
+                traced_peak_folder()
+                record['tracemalloc_peak_delta_bytes'] = traced_peaks.pop() - traced_start
+        
+        with instrumentation_lock:
+            stage_records.append(record)
+        logging.info(f"{pipeline_name} stage {stage_name} {record['status']} in {record['wall_seconds']:.3f}s wall, {record['cpu_seconds']:.3f}s cpu, "
+                     f"rows {record['rows_in']} -> {record['rows_out']}, peak rss {record['peak_rss_bytes']/1024**2:.0f} MB "
+                     f"(+{record['peak_rss_delta_bytes']/1024**2:.0f} MB).")
+
+def run_report_writer(report_dir, run_info, storage_df = None):
+    """
+    Function which writes the machine readable report of a run - the run's parameters and timings, every stage record and the report sections - so
+    runs can be compared with each other.
+    ---
+    
+    Keyword Arguments:
+    report_dir -- string path of the local directory the reports are kept in.
+    run_info -- dictionary of the run's parameters, start time and duration. Must be json serialisable.
+    storage_df -- pandas dataframe output by storage_report. Its totals per operation are included if given.
+    
+    Returns:
+    report_path -- string path of the json report, named for the run's start time.
+    """
+    with instrumentation_lock:
+        report = {'run': run_info, 'stages': list(stage_records), **report_sections}
+    if storage_df is not None:
+        report['storage'] = [{'operation': operation, 'objects': len(operation_df), 'bytes': int(operation_df['bytes'].sum()),
+                              'seconds': float(operation_df['seconds'].sum())} for operation, operation_df in storage_df.groupby('operation')]
+    
+    os.makedirs(report_dir, exist_ok=True)
+    report_path = os.path.join(report_dir, f"run_{run_info['started'].replace(':', '').replace('-', '')}.json")
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    logging.info(f'Run report written to {report_path}.')
+    
+    return report_path
@@ -0,0 +1,377 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+from collections import Counter, namedtuple
+import pandas as pd
+import pyarrow
+import pyarrow.parquet
+import crash_utilities
+from crash_instrumentation import stage_instrument, row_counter
+from crash_storage import storage_signature, storage_read_parquet, storage_write_parquet, storage_read_pickle, storage_write_pickle, storage_remover
+
+#a stage of an etl pipeline. function is called with the outputs of the named input stages, in order. The name params gives the run parameters.
+Stage = namedtuple('Stage', ['name', 'function', 'inputs'])
+
+#source files every pipeline's results depend on - a change to any of them gives every stage a new key.
+pipeline_code_files = [crash_utilities.__file__, __file__]
+
+def code_version_hasher(code_files):
+    """
+    Function which hashes the source of the files a pipeline's results depend on.
+    ---
+    
+    Keyword Arguments:
+    code_files -- iterable of string paths of python source files.
+    
+    Returns:
+    code_version -- hex string hash of the files' contents.
+    """
+    code_hash = hashlib.sha256()
+    for code_file in sorted(set(code_files)):
+        with open(code_file, 'rb') as file:
+            code_hash.update(file.read())
+    
+    return code_hash.hexdigest()
+
+def staging_parts(staging_df):
+    """
+    Function which gives the pieces of a staging table one at a time - the dataframe itself, or each part file of a streamed staging table read in turn.
+    ---
+    
+    Keyword Arguments:
+    staging_df -- pandas dataframe, string storage path of a parquet part file, or list of either.
+    
+    Returns:
+    Generator of pandas dataframes.
+    """
+    if isinstance(staging_df, str):
+        yield storage_read_parquet(staging_df)
+    elif isinstance(staging_df, list):
+        for part in staging_df:
+            yield from staging_parts(part)
+    else:
+        yield staging_df
+
+def frame_hasher(df):
+    """
+    Function which hashes the contents of a dataframe, for stages whose input is handed in rather than produced by the pipeline.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe, or list of dataframes. Streamed staging tables, given as lists of part file paths, are read and hashed a part at a time.
+    
+    Returns:
+    frame_key -- hex string hash of the columns, dtypes, index and values.
+    """
+    frame_hash = hashlib.sha256()
+    for part_df in staging_parts(df):
+        frame_hash.update(json.dumps([[str(column), str(dtype)] for column, dtype in part_df.dtypes.items()]).encode())
+        frame_hash.update(pd.util.hash_pandas_object(part_df, index=True).to_numpy().tobytes())
+    
+    return frame_hash.hexdigest()
+
+def pipeline_keys(pipeline_name, stages, params, code_files = (), sources = (), external = None):
+    """
+    Function which gives every stage of a pipeline its checkpoint key. A stage's key covers its own name, the code version and the keys of its inputs,
+    so it changes whenever anything upstream of it changes. Keys are worked out without running anything.
+    ---
+    
+    Keyword Arguments:
+    pipeline_name -- string name of the pipeline, e.g. SA.
+    stages -- list of Stage namedtuples in an order where every stage comes after its inputs.
+    params -- dictionary of run parameters, e.g. years and since. Must be json serialisable.
+    code_files -- iterable of string paths of the python source files the stages depend on, beyond the shared pipeline files.
+    sources -- iterable of storage paths of the raw data read by the pipeline. Their etag, size and modification time are part of the params key.
+    external -- dictionary of stage name to dataframe, or list of dataframes, for inputs handed in rather than produced by the pipeline. These are keyed 
+                on their contents.
+    
+    Returns:
+    keys -- dictionary of stage name to hex string key.
+    """
+    code_version = code_version_hasher(list(code_files) + pipeline_code_files)
+    source_signatures = [storage_signature(source) for source in sources]
+    keys = {'params': hashlib.sha256(json.dumps([params, source_signatures], sort_keys=True, default=str).encode()).hexdigest()}
+    keys.update({name: frame_hasher(df) for name, df in (external or {}).items()})
+    
+    for stage in stages:
+        key_string = '|'.join([pipeline_name, stage.name, code_version] + [keys[input_name] for input_name in stage.inputs])
+        keys[stage.name] = hashlib.sha256(key_string.encode()).hexdigest()[:16]
+    
+    return keys
+
+def pipeline_fingerprint(pipeline_name, stages, params = None, code_files = (), sources = ()):
+    """
+    Function which fingerprints everything a pipeline's output depends on, without running it. This is the key of its last stage.
+    ---
+    
+    Keyword Arguments:
+    pipeline_name -- string name of the pipeline, e.g. SA.
+    stages -- list of Stage namedtuples in an order where every stage comes after its inputs.
+    params -- dictionary of run parameters. Must be json serialisable.
+    code_files -- iterable of string paths of the python source files the stages depend on, beyond the shared pipeline files.
+    sources -- iterable of storage paths of the raw data read by the pipeline.
+    
+    Returns:
+    fingerprint -- hex string key.
+    """
+    return pipeline_keys(pipeline_name, stages, params or {}, code_files, sources)[stages[-1].name]
+
+def checkpoint_files(checkpoint_dir, pipeline_name, stage_name, key):
+    """
+    Function which gives the marker file recording a complete checkpoint, and the prefix of its part files.
+    ---
+    
+    Keyword Arguments:
+    checkpoint_dir -- string path of the directory holding the checkpoints.
+    pipeline_name -- string name of the pipeline.
+    stage_name -- string name of the stage.
+    key -- hex string key of the stage.
+    
+    Returns:
+    marker_path -- string path of the marker, written once every part is in place. It records the parts and their original dtypes.
+    part_prefix -- string path prefix of the parquet part files.
+    """
+    part_prefix = os.path.join(checkpoint_dir, pipeline_name, f'{stage_name}_{key}')
+    
+    return part_prefix + '.pkl', part_prefix
+
+def dtype_restorer(df, dtypes):
+    """
+    Function which gives a dataframe read back from parquet its original dtypes. Parquet does not bring back every pandas dtype, e.g. categories of 
+    booleans come back as plain booleans.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe read from parquet.
+    dtypes -- dictionary of column name to the dtype the column had when written.
+    
+    Returns:
+    df -- the dataframe with any changed columns cast back.
+    """
+    #cast column by column - a dict astype leaves every column in its own block, and concat treats all missing columns differently when they are.
+    for column, dtype in dtypes.items():
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    
+    return df
+
+def checkpoint_loader(checkpoint_dir, pipeline_name, stage_name, key):
+    """
+    Function which reads a stage's checkpointed output.
+    ---
+    
+    Keyword Arguments:
+    checkpoint_dir -- string path of the directory holding the checkpoints.
+    pipeline_name -- string name of the pipeline.
+    stage_name -- string name of the stage.
+    key -- hex string key of the stage.
+    
+    Returns:
+    output -- the dataframe, or tuple of dataframes, the stage returned. None if there is no complete checkpoint for the key.
+    """
+    marker_path, part_prefix = checkpoint_files(checkpoint_dir, pipeline_name, stage_name, key)
+    if not os.path.exists(marker_path):
+        return None
+    
+    with open(marker_path, 'rb') as file:
+        marker = pickle.load(file)
+    
+    parts = [dtype_restorer(pd.read_parquet(f'{part_prefix}_{part}.parquet'), dtypes) for part, dtypes in enumerate(marker['dtypes'])]
+    
+    return tuple(parts) if marker['tuple'] else parts[0]
+
+def checkpoint_writer(output, checkpoint_dir, pipeline_name, stage_name, key):
+    """
+    Function which writes a stage's output as a checkpoint and removes the stage's checkpoints for older keys.
+    ---
+    
+    Keyword Arguments:
+    output -- the dataframe, or tuple of dataframes, the stage returned.
+    checkpoint_dir -- string path of the directory holding the checkpoints.
+    pipeline_name -- string name of the pipeline.
+    stage_name -- string name of the stage.
+    key -- hex string key of the stage.
+    
+    Returns:
+    None.
+    """
+    marker_path, part_prefix = checkpoint_files(checkpoint_dir, pipeline_name, stage_name, key)
+    parts = output if isinstance(output, tuple) else (output,)
+    
+    try:
+        tables = [pyarrow.Table.from_pandas(part) for part in parts]
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as error:
+        #mixed type object columns cannot be stored as parquet - the stage is simply rerun next time.
+        logging.warning(f'{pipeline_name} stage {stage_name} could not be checkpointed: {error}')
+        return
+    
+    pipeline_dir = os.path.dirname(marker_path)
+    os.makedirs(pipeline_dir, exist_ok=True)
+    for name in os.listdir(pipeline_dir):
+        if name.startswith(f'{stage_name}_') and not name.startswith(f'{stage_name}_{key}'):
+            os.remove(os.path.join(pipeline_dir, name))
+    
+    for part, table in enumerate(tables):
+        pyarrow.parquet.write_table(table, f'{part_prefix}_{part}.parquet')
+    
+    #the marker goes last so a checkpoint interrupted part way through is never read.
+    with open(marker_path + '.tmp', 'wb') as file:
+        pickle.dump({'dtypes': [part.dtypes.to_dict() for part in parts], 'tuple': isinstance(output, tuple)}, file)
+    os.replace(marker_path + '.tmp', marker_path)
+
+def pipeline_runner(pipeline_name, stages, params = None, checkpoint_dir = None, code_files = (), sources = (), external = None):
+    """
+    Function which runs a pipeline of stages. With a checkpoint directory every stage's output is saved as it completes, and a rerun with the same keys
+    starts from the latest saved stages rather than from the beginning - earlier stages are not even loaded. Every stage run or loaded is timed and
+    recorded by stage_instrument.
+    ---
+    
+    Keyword Arguments:
+    pipeline_name -- string name of the pipeline, e.g. SA.
+    stages -- list of Stage namedtuples in an order where every stage comes after its inputs. The last stage's output is returned.
+    params -- dictionary of run parameters, e.g. years and since, available to stages as the input named params.
+    checkpoint_dir -- string path of the directory holding the checkpoints. If None nothing is checkpointed.
+    code_files -- iterable of string paths of the python source files the stages depend on, beyond the shared pipeline files.
+    sources -- iterable of storage paths of the raw data read by the pipeline.
+    external -- dictionary of stage name to dataframe, or list of dataframes, for inputs handed in rather than produced by the pipeline.
+    
+    Returns:
+    output -- the last stage's output.
+    """
+    params = params or {}
+    external = external or {}
+    stage_dict = {stage.name: stage for stage in stages}
+    keys = pipeline_keys(pipeline_name, stages, params, code_files, sources, external) if checkpoint_dir is not None else {}
+    
+    #outputs are let go once every stage reading them has run, so the pipeline holds no more than the straight line version would.
+    outputs = {'params': params, **external}
+    consumers = Counter(input_name for stage in stages for input_name in stage.inputs)
+    
+    def stage_output(stage_name):
+        if stage_name in outputs:
+            return outputs[stage_name]
+        
+        if checkpoint_dir is not None:
+            with stage_instrument(pipeline_name, stage_name, source='checkpoint') as record:
+                output = checkpoint_loader(checkpoint_dir, pipeline_name, stage_name, keys[stage_name])
+                record['rows_out'] = row_counter(output)
+                if output is None:
+                    record['status'] = 'missed'
+            if output is not None:
+                logging.info(f'{pipeline_name} stage {stage_name} loaded from checkpoint {keys[stage_name]}.')
+                outputs[stage_name] = output
+                return output
+        
+        stage = stage_dict[stage_name]
+        inputs = [stage_output(input_name) for input_name in stage.inputs]
+        logging.info(f'Running {pipeline_name} stage {stage_name}...')
+        with stage_instrument(pipeline_name, stage_name, rows_in=row_counter(inputs)) as record:
+            output = stage.function(*inputs)
+            del inputs
+            record['rows_out'] = row_counter(output)
+        
+        for input_name in stage.inputs:
+            consumers[input_name] -= 1
+            if consumers[input_name] == 0:
+                outputs.pop(input_name, None)
+        
+        if checkpoint_dir is not None and output is not None:
+            checkpoint_writer(output, checkpoint_dir, pipeline_name, stage_name, keys[stage_name])
+        outputs[stage_name] = output
+        
+        return output
+    
+    return stage_output(stages[-1].name)
+
+def partition_paths(partition_root, name):
+    """
+    Function which gives the storage paths of a staging partition and of its marker.
+    ---
+    
+    Keyword Arguments:
+    partition_root -- string storage path of the directory holding the partitions.
+    name -- string name of the partition, e.g. VIC.
+    
+    Returns:
+    marker_path -- string path of the marker recording the partition's fingerprint and dtypes. It is written once the data is in place.
+    data_path -- string path of the partition's parquet data.
+    parts_path -- string path of the directory holding the partition's parquet part files instead, if it is a streamed staging table.
+    """
+    return f'{partition_root}/{name}.pkl', f'{partition_root}/{name}.parquet', f'{partition_root}/{name}'
+
+def partition_fingerprint(partition_root, name):
+    """
+    Function which gives the fingerprint of the inputs a staging partition was built from.
+    ---
+    
+    Keyword Arguments:
+    partition_root -- string storage path of the directory holding the partitions.
+    name -- string name of the partition.
+    
+    Returns:
+    fingerprint -- hex string. None if there is no complete partition.
+    """
+    marker_path, _, _ = partition_paths(partition_root, name)
+    try:
+        return storage_read_pickle(marker_path)['fingerprint']
+    except FileNotFoundError:
+        return None
+
+def partition_loader(partition_root, name):
+    """
+    Function which reads a staging partition.
+    ---
+    
+    Keyword Arguments:
+    partition_root -- string storage path of the directory holding the partitions.
+    name -- string name of the partition.
+    
+    Returns:
+    df -- pandas dataframe of the partition with its original dtypes, or list of the paths of its part files if it is a streamed staging table.
+    """
+    marker_path, data_path, _ = partition_paths(partition_root, name)
+    marker = storage_read_pickle(marker_path)
+    if 'parts' in marker:
+        return marker['parts']
+    
+    return dtype_restorer(storage_read_parquet(data_path), marker['dtypes'])
+
+def partition_writer(df, partition_root, name, fingerprint):
+    """
+    Function which replaces a staging partition.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe of the partition, or list of the paths of a streamed staging table's part files. The parts are copied a part at a time.
+    partition_root -- string storage path of the directory holding the partitions.
+    name -- string name of the partition.
+    fingerprint -- hex string fingerprint of the inputs the partition was built from.
+    
+    Returns:
+    None.
+    """
+    marker_path, data_path, parts_path = partition_paths(partition_root, name)
+    
+    #the old marker goes first and the new one last, so a partition interrupted part way through is never taken as current.
+    storage_remover(marker_path)
+    try:
+        if isinstance(df, pd.DataFrame):
+            storage_remover(parts_path)
+            storage_write_parquet(df, data_path)
+            marker = {'fingerprint': fingerprint, 'dtypes': df.dtypes.to_dict()}
+        else:
+            #the streamed parts are rewritten by every nz run, so the partition keeps copies of its own.
+            storage_remover(data_path)
+            storage_remover(parts_path)
+            part_paths = []
+            for part_df in staging_parts(df):
+                part_paths.append(f'{parts_path}/part-{len(part_paths):05d}.parquet')
+                storage_write_parquet(part_df, part_paths[-1], index=False)
+            marker = {'fingerprint': fingerprint, 'parts': part_paths}
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as error:
+        #with no marker the partition is simply rebuilt next time.
+        logging.warning(f'{name} staging partition could not be written: {error}')
+        return
+    storage_write_pickle(marker, marker_path)
@@ -0,0 +1,260 @@
+import logging
+import numpy as np
+import pandas as pd
+from crash_utilities import expected_crash_fields, expected_location_fields, expected_datetime_fields, expected_vehicle_tab_fields, expected_casualty_fields
+from crash_utilities import expected_description_fields, vehicles_key_builder, casualties_key_builder, location_key_missing
+from crash_utilities import vehicles_key_decoder, casualties_key_decoder, vehicles_id_builder, casualties_id_builder
+from crash_storage import storage_read_parquet
+
+def dtype_sampler(df):
+    """
+    Function which takes one value of each field of a jurisdiction's table - the first present value if there is one - so that the dtypes of the
+    joined table can be worked out once every jurisdiction has been seen.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe of a jurisdiction's slice of a table.
+    
+    Returns:
+    sample -- dictionary of field name to a single value pandas series with the field's dtype. None if df is empty, as empty frames do not affect
+              the dtypes of a join.
+    """
+    if len(df) == 0:
+        return None
+    
+    return {column: series.iloc[[max(series.notna().to_numpy().argmax(), 0)]] for column, series in df.items()}
+
+def dtype_unifier(table_df, samples):
+    """
+    Function which gives a table assembled from deduplicated slices the dtypes it would have had if every jurisdiction's full slice had been joined.
+    ---
+    
+    Keyword Arguments:
+    table_df -- pandas dataframe of the joined slices.
+    samples -- list of dtype_sampler outputs, one per jurisdiction.
+    
+    Returns:
+    table_df -- the dataframe with any differing fields cast to the joined dtype.
+    """
+    samples = [sample for sample in samples if sample is not None]
+    if not samples:
+        return table_df
+    
+    for column in table_df.columns:
+        column_samples = [sample[column] for sample in samples]
+        #a join passes over extension fields, e.g. categories, which hold nothing - numpy fields share storage with their neighbours so count even when empty.
+        present_samples = [series for series in column_samples if not (pd.api.types.is_extension_array_dtype(series.dtype) and series.isna().all())]
+        joined_dtype = pd.concat(present_samples or column_samples, ignore_index=True).dtype
+        if table_df[column].dtype != joined_dtype:
+            table_df[column] = table_df[column].astype(joined_dtype)
+    
+    return table_df
+
+def dimension_absorber(dimension, slice_df, key_field, check_sample = 0, rng = None, unkeyed = None):
+    """
+    Function which adds the rows of a jurisdiction's slice of a dimension table whose key has not been seen before - within the slice or in an earlier
+    jurisdiction. The first row with each key wins. Only the key is hashed, not the float and text attributes.
+    ---
+    
+    Keyword Arguments:
+    dimension -- dictionary holding the dimension's pieces, seen keys and row hashes, dtype samples and rows held back for the consistency check. 
+                 Updated in place.
+    slice_df -- pandas dataframe of the jurisdiction's slice of the dimension.
+    key_field -- string name of the dimension's key field, e.g. lat_long.
+    check_sample -- integer number of the dropped rows to hold back for the consistency check. 0 holds none back.
+    rng -- numpy random generator the held back rows are chosen with.
+    unkeyed -- key value shared by rows that have no real key, e.g. location_key_missing. These rows are deduplicated on all of their fields instead, 
+               so rows from different places are not folded into one. None if every key is real.
+    
+    Returns:
+    None.
+    """
+    dimension['samples'].append(dtype_sampler(slice_df))
+    
+    #the seen keys are a hash index - a lookup costs the same however many jurisdictions have been absorbed.
+    keys = pd.Index(slice_df[key_field].to_numpy())
+    seen = dimension['seen'] if dimension['seen'] is not None else keys[:0]
+    new_rows = ~keys.duplicated() & ~keys.isin(seen)
+    
+    unkeyed_rows = np.zeros(len(keys), dtype=bool) if unkeyed is None else np.asarray(keys == unkeyed)
+    if unkeyed_rows.any():
+        #the rows without a real key are told apart by a hash of every field, which drops the same rows a full drop_duplicates would.
+        row_hashes = pd.Index(pd.util.hash_pandas_object(slice_df[unkeyed_rows], index=False).to_numpy())
+        seen_hashes = dimension['seen_unkeyed'] if dimension['seen_unkeyed'] is not None else row_hashes[:0]
+        new_unkeyed = ~row_hashes.duplicated() & ~row_hashes.isin(seen_hashes)
+        new_rows[unkeyed_rows] = new_unkeyed
+        dimension['seen_unkeyed'] = seen_hashes.append(row_hashes[new_unkeyed])
+    
+    dimension['pieces'].append(slice_df[new_rows])
+    dimension['seen'] = seen.append(keys[new_rows & ~unkeyed_rows])
+    
+    if check_sample > 0:
+        dropped_positions = np.flatnonzero(~new_rows)
+        if len(dropped_positions) > check_sample:
+            dropped_positions = np.sort(rng.choice(dropped_positions, check_sample, replace=False))
+        dimension['checks'].append(slice_df.iloc[dropped_positions])
+
+def dimension_consistency_checker(name, table_df, key_field, check_dfs, check_sample):
+    """
+    Function which confirms that rows dropped from a dimension carry the same attributes as the row kept for their key. A sample of the dropped rows is
+    compared and any differences are logged.
+    ---
+    
+    Keyword Arguments:
+    name -- string name of the dimension, e.g. Location.
+    table_df -- pandas dataframe of the deduplicated dimension.
+    key_field -- string name of the dimension's key field.
+    check_dfs -- list of pandas dataframes of the dropped rows held back by dimension_absorber.
+    check_sample -- integer number of dropped rows compared.
+    
+    Returns:
+    mismatch_count -- integer number of the compared rows with at least one differing attribute.
+    """
+    check_df = pd.concat(check_dfs) if check_dfs else table_df.iloc[:0]
+    if len(check_df) > check_sample:
+        check_df = check_df.sample(check_sample, random_state=0)
+    if key_field == 'lat_long':
+        #every row without coordinates shares the missing key, so their attributes are expected to differ.
+        check_df = check_df[check_df[key_field] != location_key_missing]
+    
+    kept_df = table_df.set_index(key_field).loc[check_df[key_field]]
+    mismatches = np.zeros(len(check_df), dtype=bool)
+    field_counts = {}
+    for field in kept_df.columns:
+        kept_values = kept_df[field].to_numpy(dtype=object)
+        check_values = check_df[field].to_numpy(dtype=object)
+        if pd.api.types.is_float_dtype(kept_df[field].dtype) and pd.api.types.is_float_dtype(check_df[field].dtype):
+            equal = np.isclose(kept_values.astype('float64'), check_values.astype('float64'), equal_nan=True)
+        else:
+            equal = (kept_values == check_values) | (pd.isna(kept_values) & pd.isna(check_values))
+        if not equal.all():
+            field_counts[field] = int((~equal).sum())
+        mismatches |= ~equal
+    
+    if field_counts:
+        example_key = check_df[key_field].iloc[np.flatnonzero(mismatches)[0]]
+        logging.warning(f'{name} consistency check: {mismatches.sum()} of {len(check_df)} sampled dropped rows differ from the row kept for their '
+                        f'{key_field}, e.g. {key_field} {example_key}. Rows differing per field: {field_counts}')
+    else:
+        logging.info(f'{name} consistency check: all {len(check_df)} sampled dropped rows match the row kept for their {key_field}.')
+    
+    return int(mismatches.sum())
+
+def signature_id_normaliser(staging_df):
+    """
+    Function which rebuilds the vehicles_id and casualties_id strings from the packed keys, so every key has exactly one id. Jurisdictions holding 
+    their counts as floats or missing values otherwise give one key several ids, e.g. '1.0a' and '1a', and only one of them survives deduplication.
+    ---
+    
+    Keyword Arguments:
+    staging_df -- pandas dataframe of a staging table with vehicles_key and casualties_key fields. Updated in place.
+    
+    Returns:
+    None.
+    """
+    staging_df['vehicles_id'] = vehicles_id_builder(vehicles_key_decoder(staging_df['vehicles_key']))
+    
+    #whole counts are written without a '.0'. Missing counts are written as nan, as the key keeps them apart from 0, so each key has its own id.
+    casualty_counts = casualties_key_decoder(staging_df['casualties_key']).astype('Int64').astype(object)
+    staging_df['casualties_id'] = casualties_id_builder(casualty_counts.where(casualty_counts.notna(), np.nan), keep_missing=True)
+
+def signature_id_checker(name, table_df, key_field, id_field):
+    """
+    Function which confirms that the rebuilt string ids of a dimension deduplicated on its integer key are unique, so the ids join one to one with the 
+    keys.
+    ---
+    
+    Keyword Arguments:
+    name -- string name of the dimension, e.g. Casualties.
+    table_df -- pandas dataframe of the dimension, deduplicated on key_field.
+    key_field -- string name of the integer key field, e.g. casualties_key.
+    id_field -- string name of the string id field, e.g. casualties_id.
+    
+    Returns:
+    None. Raises ValueError if any id is shared by more than one key.
+    """
+    duplicated = table_df[id_field].duplicated(keep=False)
+    if duplicated.any():
+        examples = table_df.loc[duplicated, [key_field, id_field]].head(5).to_dict('records')
+        raise ValueError(f'{name} has {table_df.loc[duplicated, id_field].nunique()} {id_field} values shared by several {key_field} values, '
+                         f'e.g. {examples}.')
+
+def star_schema_builder(staging_dfs, integer_keys = False, check_sample = 0):
+    """
+    Function which builds the final tables from the jurisdictions' staging tables one jurisdiction at a time, rather than joining every staging table
+    first. Each staging table is let go as soon as it is absorbed - the Crash and Description tables are appended to, and the Location, DateTime,
+    Casualties and Vehicles dimensions only take rows whose key they have not seen before.
+    ---
+    
+    Keyword Arguments:
+    staging_dfs -- list of the jurisdictions' staging dataframes, in the order their rows are numbered. A streamed staging table is given as the list of 
+                   its part file paths instead. The list is emptied as they are absorbed.
+    integer_keys -- boolean. If true, packed integer vehicles_key and casualties_key fields are generated alongside the string ids. The Vehicles and
+                    Casualties tables are then deduplicated on the integer keys and the Crash table carries them for joins. The string ids are 
+                    rebuilt from the keys, with missing counts written as nan, and checked to be unique so they still join one to one.
+    check_sample -- integer number of rows dropped from each dimension to compare with the row kept for their key. 0 skips the check.
+    
+    Returns:
+    tables -- tuple of the crash, description, datetime, casualties, location and vehicles dataframes. The crash table has a state field beyond 
+              the final crash fields.
+    """
+    #the crash table also carries the state it is partitioned on in the parquet output.
+    crash_fields = list(expected_crash_fields) + (['vehicles_key', 'casualties_key'] if integer_keys else []) + ['state']
+    casualty_fields = (['casualties_key'] if integer_keys else []) + list(expected_casualty_fields)
+    vehicle_fields = (['vehicles_key'] if integer_keys else []) + list(expected_vehicle_tab_fields)
+    
+    table_fields = {'Crash': crash_fields, 'Description': list(expected_description_fields), 'DateTime': list(expected_datetime_fields),
+                    'Casualties': casualty_fields, 'Location': list(expected_location_fields), 'Vehicles': vehicle_fields}
+    #location and datetime keys are packed from their attributes, and the count keys from the counts - the first row with each key wins. Locations 
+    #without coordinates share one key, so they are compared on every field.
+    dimension_keys = {'DateTime': 'date_time_id', 'Location': 'lat_long', 'Casualties': casualty_fields[0], 'Vehicles': vehicle_fields[0]}
+    tables = {name: {'pieces': [], 'seen': None, 'seen_unkeyed': None, 'samples': [], 'checks': []} for name in table_fields}
+    rng = np.random.default_rng(0)
+    
+    row_offset = 0
+    while staging_dfs:
+        staging_df = staging_dfs.pop(0)
+        if isinstance(staging_df, list):
+            #a streamed staging table - its part files are absorbed one at a time, so the jurisdiction's table is never held whole.
+            staging_dfs[:0] = staging_df
+            continue
+        if isinstance(staging_df, str):
+            staging_df = storage_read_parquet(staging_df)
+        
+        #serial description id continuing on from the previous jurisdiction - the row's position in the joined staging table.
+        staging_df = staging_df.drop(columns=['description_id'])
+        staging_df.index = pd.RangeIndex(row_offset, row_offset + len(staging_df))
+        staging_df['description_id'] = staging_df.index.to_numpy(dtype='int64')
+        row_offset += len(staging_df)
+        
+        if integer_keys:
+            staging_df['vehicles_key'] = vehicles_key_builder(staging_df)
+            staging_df['casualties_key'] = casualties_key_builder(staging_df)
+            signature_id_normaliser(staging_df)
+        
+        for name, fields in table_fields.items():
+            slice_df = staging_df[fields]
+            if name in ('Crash', 'Description'):
+                #every row carries its own description id so nothing is ever dropped from these.
+                tables[name]['samples'].append(dtype_sampler(slice_df))
+                #kept as a plain integer index rather than a range, so the row numbers are written with the table as they always were.
+                tables[name]['pieces'].append(slice_df.set_axis(slice_df.index.to_numpy(), axis=0))
+            else:
+                dimension_absorber(tables[name], slice_df, dimension_keys[name], check_sample, rng, 
+                                   location_key_missing if name == 'Location' else None)
+        
+        logging.info(f'Absorbed {len(staging_df)} staging rows.')
+        del staging_df, slice_df
+    
+    table_dfs = []
+    for name, fields in table_fields.items():
+        pieces = tables[name]['pieces'] or [pd.DataFrame(columns=fields)]
+        table_dfs.append(dtype_unifier(pd.concat(pieces), tables[name]['samples']))
+        tables[name]['pieces'] = []
+        
+        if check_sample > 0 and name in dimension_keys:
+            dimension_consistency_checker(name, table_dfs[-1], dimension_keys[name], tables[name]['checks'], check_sample)
+        if integer_keys and name in ('Casualties', 'Vehicles'):
+            signature_id_checker(name, table_dfs[-1], dimension_keys[name], f'{name.lower()}_id')
+    
+    return tuple(table_dfs)
@@ -0,0 +1,385 @@
+import configparser
+import logging
+import os
+import pickle
+import threading
+import time
+import fsspec
+import pandas as pd
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
+
+#read the config file to extract the storage location and client settings
+config = configparser.ConfigParser()
+config.read('config_file.cfg')
+
+#root of the raw and final data. An s3 url for the s3 backends, a directory for the local backend.
+storage_root = config['S3']['S3_BUCKET_PATH'].rstrip('/')
+
+#backend - local (a directory standing in for the bucket), s3-local (an s3 compatible server such as minio or moto at ENDPOINT_URL) or s3.
+storage_settings = {'backend': config.get('STORAGE', 'BACKEND', fallback='s3' if storage_root.startswith('s3://') else 'local'),
+                    'endpoint_url': config.get('STORAGE', 'ENDPOINT_URL', fallback=None) or None,
+                    'max_concurrency': config.getint('STORAGE', 'MAX_CONCURRENCY', fallback=16),
+                    'retries': config.getint('STORAGE', 'RETRIES', fallback=5),
+                    'multipart_chunksize': config.getint('STORAGE', 'MULTIPART_CHUNKSIZE', fallback=16*1024**2)}
+
+#the filesystem client shared by every read and write in this process, with the pid it was built in, and the per object transfer records reported 
+#at the end of a run.
+storage_state = {'filesystem': None, 'pid': None}
+storage_lock = threading.Lock()
+storage_metrics = []
+
+def get_filesystem():
+    """
+    Function which gives the filesystem client for the configured backend. The client is built on first use and shared after that so every read and
+    write goes through one connection pool. A forked worker process builds its own - the s3 client's event loop cannot be used across a fork.
+    ---
+    
+    Keyword Arguments:
+    None.
+    
+    Returns:
+    fs -- fsspec filesystem object.
+    """
+    with storage_lock:
+        if storage_state['filesystem'] is None or storage_state['pid'] != os.getpid():
+            backend = storage_settings['backend']
+            
+            if backend == 'local':
+                fs = fsspec.filesystem('file', auto_mkdir=True)
+            elif backend in ('s3', 's3-local'):
+                client_kwargs = {'endpoint_url': storage_settings['endpoint_url']} if backend == 's3-local' else {}
+                #s3fs uses the block size as the part size for multipart uploads as well as for ranged reads.
+                fs = fsspec.filesystem('s3', client_kwargs=client_kwargs, default_block_size=storage_settings['multipart_chunksize'],
+                                       config_kwargs={'max_pool_connections': storage_settings['max_concurrency'],
+                                                      'retries': {'max_attempts': storage_settings['retries'], 'mode': 'adaptive'}})
+            else:
+                raise ValueError(f'Unknown storage backend {backend}. Expected local, s3-local or s3.')
+            
+            logging.info(f'Created {backend} storage client.')
+            storage_state['filesystem'] = fs
+            storage_state['pid'] = os.getpid()
+        
+        return storage_state['filesystem']
+
+def storage_path(*parts):
+    """
+    Function which builds the full path of an object below the storage root.
+    ---
+    
+    Keyword Arguments:
+    parts -- strings naming the folders and file below the storage root, e.g. 'crash_vic', 'ACCIDENT.csv'.
+    
+    Returns:
+    path -- string path or url of the object.
+    """
+    return '/'.join([storage_root] + [part.strip('/') for part in parts])
+
+def storage_recorder(path, operation, byte_count, start_time):
+    """
+    Function which records the size and time taken for one object transfer.
+    ---
+    
+    Keyword Arguments:
+    path -- string path of the object.
+    operation -- string, read or write.
+    byte_count -- integer number of bytes transferred.
+    start_time -- float time.perf_counter value taken when the transfer started.
+    
+    Returns:
+    None.
+    """
+    seconds = time.perf_counter() - start_time
+    logging.debug(f'Storage {operation} {path}: {byte_count} bytes in {seconds:.3f}s')
+    with storage_lock:
+        storage_metrics.append({'path': path, 'operation': operation, 'bytes': byte_count, 'seconds': seconds})
+
+def storage_info(path):
+    """
+    Function which gives the metadata of an object, e.g. size, mtime and (s3 only) ETag.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the object.
+    
+    Returns:
+    info -- dict of object metadata from the filesystem.
+    """
+    return get_filesystem().info(path)
+
+def storage_signature(path):
+    """
+    Function which describes the current version of an object, or of every object below a directory, so that changed source data can be detected.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the object or directory.
+    
+    Returns:
+    signature -- string combining the name, etag (s3 only), size and modification time of each object.
+    """
+    fs = get_filesystem()
+    objects = fs.find(path, detail=True) or {path: fs.info(path)}
+    
+    return ';'.join(f"{name}|{info.get('ETag', '')}|{info.get('size', '')}|{info.get('LastModified', info.get('mtime', ''))}" 
+                    for name, info in sorted(objects.items()))
+
+def storage_read_csv(path, **read_kwargs):
+    """
+    Function which reads a csv object into a dataframe through the shared client.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the csv object.
+    read_kwargs -- keyword arguments passed on to pandas read_csv.
+    
+    Returns:
+    df -- pandas dataframe of the csv.
+    """
+    start_time = time.perf_counter()
+    with get_filesystem().open(path, 'rb') as file:
+        df = pd.read_csv(file, **read_kwargs)
+        byte_count = file.tell()
+    storage_recorder(path, 'read', byte_count, start_time)
+    
+    return df
+
+def storage_read_csv_chunks(path, chunksize, **read_kwargs):
+    """
+    Generator which reads a csv object through the shared client a chunk at a time, so only one chunk is held in memory.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the csv object.
+    chunksize -- integer number of rows in each chunk.
+    read_kwargs -- keyword arguments passed on to pandas read_csv.
+    
+    Returns:
+    Yields a pandas dataframe for each chunk of the csv. The transfer is recorded once the last chunk has been read.
+    """
+    start_time = time.perf_counter()
+    with get_filesystem().open(path, 'rb') as file:
+        with pd.read_csv(file, chunksize=chunksize, **read_kwargs) as reader:
+            for chunk_df in reader:
+                yield chunk_df
+        byte_count = file.tell()
+    storage_recorder(path, 'read', byte_count, start_time)
+
+def storage_read_parquet(path, **read_kwargs):
+    """
+    Function which reads a parquet object, or a directory of parquet objects, into a dataframe through the shared client.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the parquet object or directory.
+    read_kwargs -- keyword arguments passed on to pandas read_parquet.
+    
+    Returns:
+    df -- pandas dataframe of the parquet data.
+    """
+    fs = get_filesystem()
+    start_time = time.perf_counter()
+    df = pd.read_parquet(fsspec.core.strip_protocol(path), filesystem=fs, **read_kwargs)
+    storage_recorder(path, 'read', fs.du(path), start_time)
+    
+    return df
+
+def storage_writer(df, path, write_method, **write_kwargs):
+    """
+    Function which writes a dataframe to an object through the shared client.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe to write.
+    path -- string path or url of the object.
+    write_method -- string name of the dataframe method doing the writing, e.g. to_csv or to_parquet.
+    write_kwargs -- keyword arguments passed on to the write method.
+    
+    Returns:
+    byte_count -- integer number of bytes written.
+    """
+    start_time = time.perf_counter()
+    #the file object uploads each block as it fills - a multipart upload on s3 - so the object is streamed out as it is serialised.
+    try:
+        with get_filesystem().open(path, 'wb') as file:
+            getattr(df, write_method)(file, **write_kwargs)
+            byte_count = file.tell()
+    except Exception:
+        #closing the file on the way out still commits what was written - take the partial object away again.
+        storage_remover(path)
+        raise
+    storage_recorder(path, 'write', byte_count, start_time)
+    
+    return byte_count
+
+def storage_write_csv(df, path, **write_kwargs):
+    """
+    Function which writes a dataframe to a csv object through the shared client.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe to write.
+    path -- string path or url of the object.
+    write_kwargs -- keyword arguments passed on to pandas to_csv, e.g. compression='gzip'.
+    
+    Returns:
+    byte_count -- integer number of bytes written.
+    """
+    return storage_writer(df, path, 'to_csv', **write_kwargs)
+
+def storage_write_parquet(df, path, **write_kwargs):
+    """
+    Function which writes a dataframe to a parquet object through the shared client.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe to write.
+    path -- string path or url of the object.
+    write_kwargs -- keyword arguments passed on to pandas to_parquet.
+    
+    Returns:
+    byte_count -- integer number of bytes written.
+    """
+    return storage_writer(df, path, 'to_parquet', **write_kwargs)
+
+def storage_write_dataset(df, path, partition_cols = None, row_group_size = None, compression = 'snappy'):
+    """
+    Function which writes a dataframe to a hive partitioned parquet dataset through the shared client, e.g. path/state=SA/year=2015/part-0.parquet. 
+    Every column chunk carries min/max statistics, and _metadata and _common_metadata summary files are written at the root so readers can prune 
+    partitions and row groups without opening each file. The dataset is written beside path first and only replaces anything already at path once it 
+    is complete, so a failed write leaves the previous dataset in place.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe to write.
+    path -- string path or url of the dataset directory.
+    partition_cols -- list of the field names the dataset is partitioned on, in directory order. These are taken out of the files. None writes a 
+                      single unpartitioned file. Partition fields should not hold missing values - pyarrow cannot read null partitions back into pandas.
+    row_group_size -- integer number of rows in each row group. None leaves the pyarrow default.
+    compression -- string parquet compression codec, e.g. snappy, zstd or gzip.
+    
+    Returns:
+    byte_count -- integer number of bytes written, summary files included.
+    """
+    fs = get_filesystem()
+    start_time = time.perf_counter()
+    root = fsspec.core.strip_protocol(path).rstrip('/')
+    table = pyarrow.Table.from_pandas(df)
+    #written beside the dataset under a leading underscore, which dataset readers skip, and left over from a failed write if it already exists.
+    parent, separator, name = root.rpartition('/')
+    temp_root = f'{parent}{separator}_{name}.tmp'
+    storage_remover(temp_root)
+    
+    #the footer of every file written, with its path relative to the root, for the _metadata summary.
+    file_metadata = {}
+    def file_visitor(written_file):
+        relative_path = written_file.path[len(temp_root)+1:]
+        written_file.metadata.set_file_path(relative_path)
+        file_metadata[relative_path] = written_file.metadata
+    
+    try:
+        fs.makedirs(temp_root, exist_ok=True)
+        if table.num_rows > 0:
+            file_schema = table.drop(partition_cols).schema if partition_cols else table.schema
+            file_options = pyarrow.dataset.ParquetFileFormat().make_write_options(compression=compression, write_statistics=True)
+            pyarrow.dataset.write_dataset(table, temp_root, format='parquet', filesystem=fs, partitioning=partition_cols, 
+                                          partitioning_flavor='hive' if partition_cols else None, file_options=file_options, 
+                                          min_rows_per_group=row_group_size or 0, max_rows_per_group=row_group_size or 1024**2, 
+                                          basename_template='part-{i}.parquet', existing_data_behavior='overwrite_or_ignore', file_visitor=file_visitor)
+        else:
+            #an empty table writes no files, so one empty file is written for readers to take the columns from. There are no partition directories 
+            #to carry the partition fields, so the file keeps them.
+            file_schema = table.schema
+            pyarrow.parquet.write_table(table, f'{temp_root}/part-0.parquet', filesystem=fs, compression=compression)
+            file_metadata['part-0.parquet'] = pyarrow.parquet.read_metadata(f'{temp_root}/part-0.parquet', filesystem=fs)
+            file_metadata['part-0.parquet'].set_file_path('part-0.parquet')
+        
+        #files are written on several threads - order the summary by path so it is the same from run to run.
+        pyarrow.parquet.write_metadata(file_schema, f'{temp_root}/_metadata', filesystem=fs, 
+                                       metadata_collector=[file_metadata[relative_path] for relative_path in sorted(file_metadata)])
+        pyarrow.parquet.write_metadata(file_schema, f'{temp_root}/_common_metadata', filesystem=fs)
+    except BaseException:
+        storage_remover(temp_root)
+        raise
+    
+    storage_remover(path)
+    fs.mv(temp_root, root, recursive=True)
+    byte_count = fs.du(path)
+    storage_recorder(path, 'write', byte_count, start_time)
+    
+    return byte_count
+
+def storage_write_pickle(obj, path):
+    """
+    Function which pickles a python object to an object through the shared client, e.g. a small record of dtypes that csv and parquet cannot hold.
+    ---
+    
+    Keyword Arguments:
+    obj -- python object to pickle.
+    path -- string path or url of the object.
+    
+    Returns:
+    None.
+    """
+    start_time = time.perf_counter()
+    with get_filesystem().open(path, 'wb') as file:
+        pickle.dump(obj, file)
+        byte_count = file.tell()
+    storage_recorder(path, 'write', byte_count, start_time)
+
+def storage_read_pickle(path):
+    """
+    Function which reads a pickled python object through the shared client.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the object.
+    
+    Returns:
+    obj -- the unpickled python object.
+    """
+    start_time = time.perf_counter()
+    with get_filesystem().open(path, 'rb') as file:
+        obj = pickle.load(file)
+        byte_count = file.tell()
+    storage_recorder(path, 'read', byte_count, start_time)
+    
+    return obj
+
+def storage_remover(path):
+    """
+    Function which removes an object, or a directory of objects, if it exists.
+    ---
+    
+    Keyword Arguments:
+    path -- string path or url of the object or directory.
+    
+    Returns:
+    None.
+    """
+    fs = get_filesystem()
+    if fs.exists(path):
+        fs.rm(path, recursive=True)
+
+def storage_report():
+    """
+    Function which logs the bytes, time and throughput of every object read or written so far.
+    ---
+    
+    Keyword Arguments:
+    None.
+    
+    Returns:
+    metrics_df -- pandas dataframe with one row per transfer and the columns path, operation, bytes, seconds and mb_per_second.
+    """
+    with storage_lock:
+        metrics_df = pd.DataFrame(storage_metrics, columns=['path', 'operation', 'bytes', 'seconds'])
+    metrics_df['mb_per_second'] = metrics_df['bytes']/1024**2/metrics_df['seconds'].where(metrics_df['seconds'] > 0)
+    
+    for row in metrics_df.itertuples():
+        logging.info(f'Storage {row.operation} {row.path}: {row.bytes} bytes in {row.seconds:.3f}s ({row.mb_per_second:.1f} MB/s)')
+    for operation, operation_df in metrics_df.groupby('operation'):
+        logging.info(f'Storage {operation} total: {len(operation_df)} objects, {operation_df["bytes"].sum()} bytes in {operation_df["seconds"].sum():.3f}s')
+    
+    return metrics_df
@@ -2,12 +2,81 @@ import pyproj
 import pandas as pd
 import numpy as np
 import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from crash_cache import cached_coordinate_transformer
 
 #declare some proj strings - these are for coordinate transformation for SA and VIC data
 sa_proj_string = "+proj=lcc +lon_0=135 +lat_0=-32 +lat_1=-28 +lat_2=-36 +x_0=1000000 +y_0=2000000"
 vic_proj_string = "+proj=tmerc +lat_0=0 +lon_0=145 +k=1 +x_0=2500000 +y_0=6596534.558457338 +f=0.003352891869237217 +a=6378160 +b=6356774.719 +no_defs"
 
-def map_coord_transformer(df, proj_string, lat_column_name, long_column_name):
+#process wide registry of transformers keyed by proj string - building the crs and transformer objects is comparatively slow.
+transformer_registry = {}
+transformer_registry_stats = {'hits': 0, 'misses': 0}
+
+def get_transformer(proj_string):
+    """
+    Function which returns the transformer from a proj string to latitude and longitude, building it only the first time it is requested in this process.
+    ---
+    
+    Keyword Arguments:
+    proj_string - projection string from the proj library describing the source coordinate system.
+    
+    Returns:
+    transformer - pyproj Transformer object converting the source coordinates to epsg:4326.
+    """
+    if proj_string in transformer_registry:
+        transformer_registry_stats['hits'] += 1
+        return transformer_registry[proj_string]
+    
+    transformer_registry_stats['misses'] += 1
+    logging.info('Generating coordinate reference systems... ')
+    #generate coordinate reference system objects for details of how this works 
+    from_crs = pyproj.CRS.from_string(proj_string)
+    from_proj = pyproj.Proj(from_crs)
+    gps_proj = pyproj.Proj('epsg:4326')
+    transformer_registry[proj_string] = pyproj.Transformer.from_proj(from_proj, gps_proj)
+    
+    return transformer_registry[proj_string]
+
+def prewarm_transformers(proj_strings = None):
+    """
+    Function which builds the transformers for the known jurisdictions up front so that later transformations only ever hit the registry.
+    ---
+    
+    Keyword Arguments:
+    proj_strings - iterable of proj strings to build. Defaults to the sa and vic proj strings.
+    
+    Returns:
+    None.
+    """
+    if proj_strings is None:
+        proj_strings = [sa_proj_string, vic_proj_string]
+    
+    logging.info('Pre-warming coordinate transformers...')
+    for proj_string in proj_strings:
+        #only build - prewarming should not count towards the hit statistics
+        if proj_string not in transformer_registry:
+            get_transformer(proj_string)
+
+def transformer_registry_report():
+    """
+    Function which logs and returns the hit and miss counts of the transformer registry.
+    ---
+    
+    Keyword Arguments:
+    None.
+    
+    Returns:
+    report - dictionary containing hits, misses and the number of transformers held.
+    """
+    report = {**transformer_registry_stats, 'transformers': len(transformer_registry)}
+    logging.info(f"Transformer registry: {report['hits']} hits, {report['misses']} misses, {report['transformers']} transformers held.")
+    
+    return report
+
+def map_coord_transformer(df, proj_string, lat_column_name, long_column_name, batch = True, workers = 1, cache_dir = None, cache_max_rows = 20000000):
     """
     Function which transforms individual jurisdictions' preferred coordinate system to a standard latitude and longitude format.
     ---
@@ -18,16 +87,44 @@ def map_coord_transformer(df, proj_string, lat_column_name, long_column_name):
                   rather than be forced to manually supply.
     lat_column_name - a string which is the name of the x coordinate column - The coordinate which will be latitude.
     long_column_name - a string which is the name of the y coordinate column - The coordinate which will be longitude.
+    batch - boolean. If true, the coordinate columns are sent through proj as whole arrays in a single call. If false, the original row by row
+            transformation is used. Both produce identical values.
+    workers - integer number of processes used to project the coordinates. Values above 1 split the arrays into chunks which are projected on a
+              process pool and reassembled in order. None uses every available core. Only applies in batch mode.
+    cache_dir - string path of a directory holding an on disk cache of projected points. When given, only points not already in the cache are
+                projected and new points are added to it. Only applies in batch mode.
+    cache_max_rows - integer maximum number of points kept in the cache for this proj string. Least recently used points are evicted first.
     
     Returns:
     df - dataframe with two additional columns calc_lat and calc_long for later manipulation. 
     """
-    logging.info('Generating coordinate reference systems... ')
-    #generate coordinate reference system objects for details of how this works 
-    from_crs = pyproj.CRS.from_string(proj_string)
-    from_proj = pyproj.Proj(from_crs)
-    gps_proj = pyproj.Proj('epsg:4326')
-    original_coordinates_to_latlong_obj = pyproj.Transformer.from_proj(from_proj, gps_proj)
+    if workers is None:
+        workers = os.cpu_count()
+    
+    if batch:
+        def original_coordinates_to_latlong_arrays(x, y):
+            #hand proj the whole coordinate arrays at once - proj loops over them in c rather than python.
+            if workers > 1:
+                logging.info(f'Converting coordinates on {workers} processes...')
+                return parallel_coordinate_transformer(proj_string, x, y, workers)
+            logging.info('Converting coordinates in batch...')
+            #transformers are built once per process and shared between calls
+            return coordinate_array_transformer(get_transformer(proj_string), x, y)
+        
+        if cache_dir is not None:
+            lat_array, long_array = cached_coordinate_transformer(proj_string, df[lat_column_name], df[long_column_name], cache_dir, 
+                                                                  original_coordinates_to_latlong_arrays, max_rows = cache_max_rows)
+        else:
+            lat_array, long_array = original_coordinates_to_latlong_arrays(df[lat_column_name], df[long_column_name])
+        
+        logging.info('Preparing to return calc_lat and calc_long...')
+        df.loc[:,'calc_lat'] = lat_array
+        df.loc[:,'calc_long'] = long_array
+        
+        return df
+    
+    original_coordinates_to_latlong_obj = get_transformer(proj_string)
+    
     logging.info('Defining transformation functions...')
     def original_coordinates_to_latlong(adf):
         (lat,long) = original_coordinates_to_latlong_obj.transform(adf[lat_column_name], adf[long_column_name])
@@ -49,6 +146,76 @@ def map_coord_transformer(df, proj_string, lat_column_name, long_column_name):
     
     return df
 
+def coordinate_array_transformer(transformer, x, y):
+    """
+    Function which pushes whole coordinate arrays through a pyproj transformer in a single call.
+    ---
+    
+    Keyword Arguments:
+    transformer - pyproj Transformer object which converts the original coordinates to latitude and longitude.
+    x - array like object containing the coordinates which will become latitude.
+    y - array like object containing the coordinates which will become longitude.
+    
+    Returns:
+    lat_array - numpy float64 array of calculated latitudes.
+    long_array - numpy float64 array of calculated longitudes.
+    """
+    #proj works in double precision internally so casting up front gives the same values as the scalar calls
+    x_array = np.asarray(x, dtype='float64')
+    y_array = np.asarray(y, dtype='float64')
+    
+    lat_array, long_array = transformer.transform(x_array, y_array)
+    
+    return np.asarray(lat_array, dtype='float64'), np.asarray(long_array, dtype='float64')
+
+def coordinate_chunk_transformer(chunk):
+    """
+    Function which projects one chunk of coordinates inside a worker process. Each worker builds its transformer once and reuses it for every chunk.
+    ---
+    
+    Keyword Arguments:
+    chunk - tuple of (proj_string, x_array, y_array).
+    
+    Returns:
+    lat_array - numpy float64 array of calculated latitudes for the chunk.
+    long_array - numpy float64 array of calculated longitudes for the chunk.
+    """
+    proj_string, x_array, y_array = chunk
+    
+    return coordinate_array_transformer(get_transformer(proj_string), x_array, y_array)
+
+def parallel_coordinate_transformer(proj_string, x, y, workers, chunks_per_worker = 4):
+    """
+    Function which splits coordinate arrays into chunks, projects them on a process pool and reassembles the results in the original order.
+    ---
+    
+    Keyword Arguments:
+    proj_string - projection string from the proj library describing the source coordinate system.
+    x - array like object containing the coordinates which will become latitude.
+    y - array like object containing the coordinates which will become longitude.
+    workers - integer number of worker processes.
+    chunks_per_worker - integer number of chunks handed to each worker. A few chunks per worker evens out uneven chunk run times.
+    
+    Returns:
+    lat_array - numpy float64 array of calculated latitudes.
+    long_array - numpy float64 array of calculated longitudes.
+    """
+    x_array = np.asarray(x, dtype='float64')
+    y_array = np.asarray(y, dtype='float64')
+    
+    #never make more chunks than there are points - empty chunks are pointless work for the pool.
+    chunk_count = max(1, min(len(x_array), workers*chunks_per_worker))
+    chunks = [(proj_string, x_chunk, y_chunk) for x_chunk, y_chunk in zip(np.array_split(x_array, chunk_count), np.array_split(y_array, chunk_count))]
+    
+    #the initializer builds one transformer per worker before any chunks arrive. map returns results in submission order.
+    with ProcessPoolExecutor(max_workers=workers, initializer=prewarm_transformers, initargs=([proj_string],)) as executor:
+        results = list(executor.map(coordinate_chunk_transformer, chunks))
+    
+    lat_array = np.concatenate([result[0] for result in results])
+    long_array = np.concatenate([result[1] for result in results])
+    
+    return lat_array, long_array
+
 def vehicles_id_generator(df):
     """
     Function takes the harmonised field names and produces the structured id in the form discussed in the documentation.
@@ -123,6 +290,88 @@ def vehicles_id_generator(df):
                    
     return vehicles_id
 
+#letters used for each vehicle type in the vehicles_id string - same order and letters as vehicles_id_generator.
+vehicle_id_strings = {'animals': 'a', 'car_sedan': 'c', 'car_utility': 'u', 'car_van': 'v', 'car_4x4': 'f', 'car_station_wagon': 'w', 'motor_cycle': 'mc', 
+                      'truck_small': 't', 'truck_large': 'T', 'bus': 'B', 'taxi': 'x', 'bicycle': 'b', 'scooter': 's', 'pedestrian': 'p', 'inanimate': 'i', 
+                      'train': 'n', 'tram': 'm', 'vehicle_other': 'o'}
+
+def vehicles_id_builder(df):
+    """
+    Function which produces the vehicles_id for a whole dataframe at once, working a column at a time rather than a row at a time. 
+    The strings are identical to those from applying vehicles_id_generator over the rows.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe object which contains the harmonised vehicle count fields in expected_vehicle_fields.
+    
+    Returns:
+    vehicles_id -- pandas series of vehicles_id strings aligned to the index of df.
+    """
+    vehicles_id = np.full(len(df), '', dtype=object)
+    
+    for field in expected_vehicle_fields:
+        counts = df[field]
+        #missing counts compare false and drop out, as they do in the row-wise generator. Most counts are zero so only format the rest.
+        exists = (counts > 0).to_numpy()
+        if exists.any():
+            #counts are formatted per column with str - as the f-string does for each value in a row - so floats keep their '.0'.
+            vehicles_id[exists] = vehicles_id[exists] + (counts[exists].astype(str) + vehicle_id_strings[field]).to_numpy()
+    
+    return pd.Series(vehicles_id, index=df.index)
+
+#compiled form of a vehicle mapping - the raw fields in matrix row order and a 0/1 matrix with a column for each field in expected_vehicle_fields.
+VehicleIncidence = namedtuple('VehicleIncidence', ['raw_fields', 'matrix'])
+
+def vehicle_incidence_compiler(vehicle_mapping):
+    """
+    Function which compiles a jurisdiction's declarative vehicle mapping into an incidence matrix.
+    ---
+    
+    Keyword Arguments:
+    vehicle_mapping -- dictionary of harmonised vehicle field to the list of raw fields which are summed into it. Fields in expected_vehicle_fields with
+                       no entry, or an empty list, come out as 0.
+    
+    Returns:
+    incidence -- VehicleIncidence holding the raw field names and the matrix where entry (i, j) is 1 if raw field i counts towards harmonised field j.
+    """
+    raw_fields = list(dict.fromkeys(raw_field for raw_field_list in vehicle_mapping.values() for raw_field in raw_field_list))
+    raw_positions = {raw_field: position for position, raw_field in enumerate(raw_fields)}
+    
+    matrix = np.zeros((len(raw_fields), len(expected_vehicle_fields)))
+    for column, field in enumerate(expected_vehicle_fields):
+        for raw_field in vehicle_mapping.get(field, []):
+            matrix[raw_positions[raw_field], column] = 1
+    
+    return VehicleIncidence(raw_fields, matrix)
+
+def vehicle_category_aggregator(df, incidence):
+    """
+    Function which totals the raw unit type fields into every harmonised vehicle field in one matrix product.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe object containing the raw fields of the incidence.
+    incidence -- VehicleIncidence produced by vehicle_incidence_compiler.
+    
+    Returns:
+    totals_df -- pandas dataframe with a column per field in expected_vehicle_fields, aligned to the index of df. Integer if every raw field is integer, 
+                 otherwise float.
+    """
+    #a unit type absent from the years loaded has no pivot column - it counted nothing, so it is filled with 0 rather than failing the run.
+    raw_df = df.reindex(columns=incidence.raw_fields, fill_value=0)
+    raw_block = raw_df.to_numpy(dtype='float64')
+    missing = np.isnan(raw_block)
+    
+    totals = np.where(missing, 0, raw_block) @ incidence.matrix
+    #a row sum with any missing value used to come out missing and then be filled with 0 - keep that behaviour.
+    totals[(missing.astype('float64') @ incidence.matrix) > 0] = 0
+    
+    totals_df = pd.DataFrame(totals, index=df.index, columns=expected_vehicle_fields)
+    if all(pd.api.types.is_integer_dtype(dtype) for dtype in raw_df.dtypes):
+        totals_df = totals_df.astype('int64')
+    
+    return totals_df
+
 def casualties_id_generator(df):
     """
     Function takes the harmonised field names and produces the structured id in the form discussed in the documentation.
@@ -153,6 +402,364 @@ def casualties_id_generator(df):
     
     return casualties_id
 
+def casualties_id_builder(df, keep_missing = False):
+    """
+    Function which produces the casualties_id for a whole dataframe at once using column-wise string operations. 
+    The strings are identical to those from applying casualties_id_generator over the rows.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe object which contains the casualties, fatalities, serious_injuries and minor_injuries fields.
+    keep_missing -- boolean. If true, missing fatalities, serious_injuries and minor_injuries counts appear as 'nan', so they are told apart from 0 as 
+                    they are in casualties_key. If false they drop out, as in casualties_id_generator.
+    
+    Returns:
+    casualties_id -- pandas series of casualties_id strings aligned to the index of df.
+    """
+    #the casualty count always appears - including when it is missing, where it reads 'nan' just as in the f-string.
+    casualties_id = (df['casualties'].astype(str) + 'c').to_numpy(dtype=object)
+    
+    #the remaining counts only appear when there are some.
+    for field, field_string in [('fatalities', 'f'), ('serious_injuries', 's'), ('minor_injuries', 'm')]:
+        counts = df[field]
+        exists = ((counts > 0) | (counts.isna() if keep_missing else False)).to_numpy()
+        if exists.any():
+            casualties_id[exists] = casualties_id[exists] + (counts[exists].astype(str) + field_string).to_numpy()
+    
+    return pd.Series(casualties_id, index=df.index)
+
+#bit widths used when packing the vehicle counts into a single int64 key. The widths add up to 63 so the key is never negative.
+vehicle_key_bits = {'animals': 3, 'car_sedan': 7, 'car_utility': 5, 'car_van': 3, 'car_4x4': 3, 'car_station_wagon': 3, 'motor_cycle': 4, 'truck_small': 3,
+                    'truck_large': 4, 'bus': 3, 'taxi': 3, 'bicycle': 4, 'scooter': 3, 'pedestrian': 4, 'inanimate': 3, 'train': 2, 'tram': 2, 
+                    'vehicle_other': 4}
+
+#bit widths used when packing the casualty counts. The largest value of each field is reserved to mark a missing count.
+casualty_key_bits = {'casualties': 15, 'fatalities': 15, 'serious_injuries': 15, 'minor_injuries': 15}
+
+def signature_key_encoder(df, key_bits, keep_missing = False):
+    """
+    Function which packs a set of count columns into a single int64 key, each count taking a fixed number of bits. The first field takes the lowest bits.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe object containing the count fields named in key_bits.
+    key_bits -- dictionary of field name to the number of bits reserved for it.
+    keep_missing -- boolean. If true, missing counts are stored as the largest value of their field so they decode back to missing. If false they are 
+                    stored as 0.
+    
+    Returns:
+    keys -- pandas series of int64 keys aligned to the index of df. Raises a ValueError if a count is negative, fractional or too large for its field.
+    """
+    keys = np.zeros(len(df), dtype='int64')
+    shift = 0
+    for field, bits in key_bits.items():
+        counts = pd.to_numeric(df[field]).to_numpy(dtype='float64')
+        missing = np.isnan(counts)
+        largest = (1 << bits) - 1
+        limit = largest - 1 if keep_missing else largest
+        present = counts[~missing]
+        if ((present < 0) | (present > limit) | (present != np.floor(present))).any():
+            raise ValueError(f'{field} holds counts outside 0 to {limit} which cannot be packed into {bits} bits.')
+        values = np.where(missing, largest if keep_missing else 0, counts).astype('int64')
+        keys |= values << shift
+        shift += bits
+    
+    return pd.Series(keys, index=df.index)
+
+def signature_key_decoder(keys, key_bits, keep_missing = False):
+    """
+    Function which unpacks int64 keys produced by signature_key_encoder back into their count columns.
+    ---
+    
+    Keyword Arguments:
+    keys -- array like object of int64 keys.
+    key_bits -- dictionary of field name to the number of bits reserved for it. Must be the same as used to encode.
+    keep_missing -- boolean. Must be the same as used to encode. If true, the reserved value decodes to nan.
+    
+    Returns:
+    counts_df -- pandas dataframe with one column per field in key_bits.
+    """
+    index = keys.index if isinstance(keys, pd.Series) else None
+    keys = np.asarray(keys, dtype='int64')
+    counts_df = pd.DataFrame(index=index)
+    shift = 0
+    for field, bits in key_bits.items():
+        largest = (1 << bits) - 1
+        values = (keys >> shift) & largest
+        if keep_missing:
+            counts_df[field] = np.where(values == largest, np.nan, values)
+        else:
+            counts_df[field] = values
+        shift += bits
+    
+    return counts_df
+
+def vehicles_key_builder(df):
+    """
+    Function which produces the packed integer equivalent of vehicles_id. Missing counts are treated as 0, as they are in the string.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe object which contains the harmonised vehicle count fields in expected_vehicle_fields.
+    
+    Returns:
+    vehicles_key -- pandas series of int64 keys aligned to the index of df.
+    """
+    return signature_key_encoder(df, vehicle_key_bits)
+
+def vehicles_key_decoder(keys):
+    """
+    Function which unpacks vehicles_key values back into the vehicle count fields.
+    ---
+    
+    Keyword Arguments:
+    keys -- array like object of vehicles_key values.
+    
+    Returns:
+    counts_df -- pandas dataframe with one int64 column per field in expected_vehicle_fields.
+    """
+    return signature_key_decoder(keys, vehicle_key_bits)
+
+def casualties_key_builder(df):
+    """
+    Function which produces the packed integer equivalent of casualties_id. Missing counts are kept distinct from 0.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe object which contains the casualties, fatalities, serious_injuries and minor_injuries fields.
+    
+    Returns:
+    casualties_key -- pandas series of int64 keys aligned to the index of df.
+    """
+    return signature_key_encoder(df, casualty_key_bits, keep_missing = True)
+
+def casualties_key_decoder(keys):
+    """
+    Function which unpacks casualties_key values back into the casualty count fields.
+    ---
+    
+    Keyword Arguments:
+    keys -- array like object of casualties_key values.
+    
+    Returns:
+    counts_df -- pandas dataframe with the casualties, fatalities, serious_injuries and minor_injuries fields. Missing counts come back as nan.
+    """
+    return signature_key_decoder(keys, casualty_key_bits, keep_missing = True)
+
+#layout of the packed date_time_id - decimal digits so the key reads as YYYYMMDDWHHA. Each part has a sentinel for unknown values.
+datetime_key_layout = [#(field, multiplier, smallest valid value, largest valid value, unknown sentinel)
+                       ('year', 10**8, 0, 9998, 9999),
+                       ('month', 10**6, 1, 12, 99),
+                       ('day_of_month', 10**4, 1, 31, 99),
+                       ('day_of_week', 10**3, 1, 7, 9),
+                       ('hour', 10, 0, 23, 99),
+                       ('approximate', 1, 0, 1, 9)]
+
+def datetime_key_builder(df):
+    """
+    Function which packs the year, month, day_of_month, day_of_week, hour and approximate fields into a single int64 date_time_id.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe object containing whichever of the datetime fields the jurisdiction provides. Absent fields, missing values and values outside
+          the valid range for the field are stored as that field's unknown sentinel.
+    
+    Returns:
+    date_time_id -- pandas series of int64 keys aligned to the index of df.
+    """
+    date_time_id = np.zeros(len(df), dtype='int64')
+    for field, multiplier, smallest, largest, sentinel in datetime_key_layout:
+        if field in df.columns:
+            values = pd.to_numeric(df[field], errors='coerce').to_numpy(dtype='float64')
+        else:
+            values = np.full(len(df), np.nan)
+        
+        unknown = np.isnan(values) | (values < smallest) | (values > largest)
+        if (unknown & ~np.isnan(values)).any():
+            logging.warning(f'{field} holds values outside {smallest} to {largest}. These are stored as unknown.')
+        date_time_id += np.where(unknown, sentinel, values).astype('int64')*multiplier
+    
+    return pd.Series(date_time_id, index=df.index)
+
+def datetime_key_decoder(keys):
+    """
+    Function which unpacks date_time_id keys back into their datetime fields.
+    ---
+    
+    Keyword Arguments:
+    keys -- array like object of date_time_id keys.
+    
+    Returns:
+    datetime_df -- pandas dataframe with one float column per datetime field. Unknown parts come back as nan.
+    """
+    index = keys.index if isinstance(keys, pd.Series) else None
+    keys = np.asarray(keys, dtype='int64')
+    datetime_df = pd.DataFrame(index=index)
+    for field, multiplier, smallest, largest, sentinel in datetime_key_layout:
+        #the width of each part is the number of digits in its sentinel.
+        values = (keys // multiplier) % 10**len(str(sentinel))
+        datetime_df[field] = np.where(values == sentinel, np.nan, values)
+    
+    return datetime_df
+
+def datetime_key_formatter(keys):
+    """
+    Function which turns date_time_id keys into the legacy year-month-day-weekday-hour strings, with unknown parts left empty, for csv output.
+    ---
+    
+    Keyword Arguments:
+    keys -- array like object of date_time_id keys.
+    
+    Returns:
+    date_time_strings -- pandas series of legacy date_time_id strings.
+    """
+    datetime_df = datetime_key_decoder(keys)
+    
+    def part_strings(field):
+        return datetime_df[field].astype('Int64').astype(str).where(datetime_df[field].notna(), '')
+    
+    return (part_strings('year') + '-' + part_strings('month') + '-' + part_strings('day_of_month') + '-' + part_strings('day_of_week') 
+            + '-' + part_strings('hour'))
+
+#packed location keys hold each coordinate to 1e-7 of a degree (about a centimetre) in 32 bits. Both halves are offset by 180 so either coordinate order fits.
+location_key_scale = 10**7
+location_key_missing = -1
+
+def location_key_builder(lat, long):
+    """
+    Function which packs latitude and longitude into a single int64 lat_long key at fixed precision, replacing the tuple of floats.
+    ---
+    
+    Keyword Arguments:
+    lat -- pandas series or array like object of latitudes in degrees.
+    long -- pandas series or array like object of longitudes in degrees.
+    
+    Returns:
+    lat_long -- pandas series of int64 keys, aligned to the index of lat when it is a series. Rows with a missing, infinite or out of range 
+                coordinate get location_key_missing.
+    """
+    index = lat.index if isinstance(lat, pd.Series) else None
+    lat_array = np.asarray(lat, dtype='float64')
+    long_array = np.asarray(long, dtype='float64')
+    
+    valid = np.isfinite(lat_array) & np.isfinite(long_array) & (np.abs(lat_array) <= 180) & (np.abs(long_array) <= 180)
+    lat_code = np.rint((np.where(valid, lat_array, 0) + 180)*location_key_scale).astype('uint64')
+    long_code = np.rint((np.where(valid, long_array, 0) + 180)*location_key_scale).astype('uint64')
+    
+    #the packed value uses all 64 bits, so read it back as a signed integer. No valid pair can produce the all ones missing key.
+    lat_long = ((lat_code << np.uint64(32)) | long_code).view('int64')
+    lat_long[~valid] = location_key_missing
+    
+    return pd.Series(lat_long, index=index)
+
+def location_key_decoder(keys):
+    """
+    Function which unpacks lat_long keys back into latitude and longitude at the precision they were stored.
+    ---
+    
+    Keyword Arguments:
+    keys -- array like object of lat_long keys.
+    
+    Returns:
+    location_df -- pandas dataframe with float64 latitude and longitude columns. Missing keys come back as nan.
+    """
+    index = keys.index if isinstance(keys, pd.Series) else None
+    key_array = np.asarray(keys, dtype='int64')
+    missing = key_array == location_key_missing
+    codes = key_array.view('uint64')
+    
+    latitude = (codes >> np.uint64(32)).astype('float64')/location_key_scale - 180
+    longitude = (codes & np.uint64(0xFFFFFFFF)).astype('float64')/location_key_scale - 180
+    
+    return pd.DataFrame({'latitude': np.where(missing, np.nan, latitude), 'longitude': np.where(missing, np.nan, longitude)}, index=index)
+
+
+def read_schema_kwargs(schema):
+    """
+    Function which turns a read schema into the keyword arguments for pandas read_csv, so only the listed columns are parsed and with compact dtypes.
+    ---
+    
+    Keyword Arguments:
+    schema -- dictionary of column name to dtype. A dtype of None leaves pandas to infer that column.
+    
+    Returns:
+    read_kwargs -- dictionary with usecols and dtype entries.
+    """
+    return {'usecols': list(schema), 'dtype': {column: dtype for column, dtype in schema.items() if dtype is not None}}
+
+def year_selector(candidate_years, years = None, since = None):
+    """
+    Function which narrows a list of years to those wanted by a years/since filter.
+    ---
+    
+    Keyword Arguments:
+    candidate_years -- iterable of integer years available.
+    years -- iterable of integer years wanted. If None every candidate year is wanted.
+    since -- integer first year wanted. If None there is no lower bound.
+    
+    Returns:
+    selected_years -- list of the wanted integer years in candidate order.
+    """
+    wanted_years = None if years is None else set(years)
+    
+    return [year for year in candidate_years if (wanted_years is None or year in wanted_years) and (since is None or year >= since)]
+
+def year_mask(year_series, years = None, since = None):
+    """
+    Function which flags the rows of a dataframe wanted by a years/since filter.
+    ---
+    
+    Keyword Arguments:
+    year_series -- pandas series of integer years, one per row.
+    years -- iterable of integer years wanted. If None every year is wanted.
+    since -- integer first year wanted. If None there is no lower bound.
+    
+    Returns:
+    mask -- boolean pandas series, true for the wanted rows.
+    """
+    mask = pd.Series(True, index=year_series.index)
+    if years is not None:
+        mask &= year_series.isin(list(years))
+    if since is not None:
+        mask &= year_series >= since
+    
+    return mask
+
+def year_filter_builder(field, years = None, since = None, date_prefix = False):
+    """
+    Function which turns a years/since filter into pyarrow filters, so parquet row groups whose statistics rule them out are never read.
+    ---
+    
+    Keyword Arguments:
+    field -- string name of the parquet column holding the year.
+    years -- iterable of integer years wanted. If None every year is wanted.
+    since -- integer first year wanted. If None there is no lower bound.
+    date_prefix -- boolean. If true the column is an ISO date string starting with the year and is compared as a string range.
+    
+    Returns:
+    filters -- pyarrow filters in disjunctive normal form, or None when nothing is filtered. If no year is wanted the filters match no rows.
+    """
+    if years is None and since is None:
+        return None
+    
+    if years is not None and not [year for year in years if since is None or year >= since]:
+        #no year is wanted - pyarrow rejects an empty filter and an empty 'in' list, so give a range nothing falls in.
+        bound = '0' if date_prefix else 0
+        return [[(field, '<', bound), (field, '>', bound)]]
+    
+    if date_prefix:
+        if years is None:
+            return [[(field, '>=', str(since))]]
+        #one string range per year, or'd together
+        return [[(field, '>=', str(year)), (field, '<', str(year + 1))] for year in sorted(set(years)) if since is None or year >= since]
+    
+    conditions = []
+    if years is not None:
+        conditions.append((field, 'in', list(years)))
+    if since is not None:
+        conditions.append((field, '>=', since))
+    
+    return [conditions]
 
 def structure_checker(df, expected_fields, coerce = True, add_only = False):
     """
@@ -283,6 +890,90 @@ traffic_controls_dict = {
                          **dict.fromkeys(['Flashing amber lights', 'Miscellaneous', 'LATM device', 'Other'], 'other')
                         }
 
+#compiled form of a harmonisation dictionary - each label maps to a code into categories. Labels mapped to None get the missing code -1.
+CategoricalLookup = namedtuple('CategoricalLookup', ['name', 'codes', 'categories'])
+
+#labels with no entry in their dictionary - {lookup name: {label: count}} - collected over the run instead of raising a KeyError.
+unmapped_labels = {}
+
+def lookup_compiler(mapping, name):
+    """
+    Function which compiles a harmonisation dictionary into a categorical code table.
+    ---
+    
+    Keyword Arguments:
+    mapping -- dictionary of source label to harmonised value.
+    name -- string name of the lookup used when reporting unmapped labels.
+    
+    Returns:
+    lookup -- CategoricalLookup holding the label to code table and the harmonised categories in order of first appearance.
+    """
+    categories = list(dict.fromkeys(value for value in mapping.values() if value is not None))
+    category_codes = {category: code for code, category in enumerate(categories)}
+    codes = {label: (-1 if value is None else category_codes[value]) for label, value in mapping.items()}
+    
+    return CategoricalLookup(name, codes, pd.Index(categories, dtype=object))
+
+def categorical_mapper(series, lookup):
+    """
+    Function which harmonises a column of labels with a compiled lookup. Each distinct label is looked up once and the codes are spread back over the rows.
+    ---
+    
+    Keyword Arguments:
+    series -- pandas series of source labels.
+    lookup -- CategoricalLookup produced by lookup_compiler.
+    
+    Returns:
+    harmonised -- pandas categorical series aligned to the index of series. Labels missing from the lookup, including missing values, come back as nan 
+                  and are counted in unmapped_labels.
+    """
+    #factorize gives each row the position of its label among the distinct labels, with -1 for missing values.
+    label_positions, labels = pd.factorize(series)
+    
+    #code of every distinct label, with -2 marking a label the lookup does not know. The extra entry on the end is picked up by the -1 positions.
+    label_codes = np.array([lookup.codes.get(label, -2) for label in labels] + [-2], dtype='int64')
+    codes = label_codes[label_positions]
+    unmapped = codes == -2
+    
+    if unmapped.any():
+        label_counts = np.bincount(label_positions[unmapped] + 1, minlength=len(labels) + 1)
+        report = unmapped_labels.setdefault(lookup.name, {})
+        for position in np.flatnonzero(label_counts):
+            label = np.nan if position == 0 else labels[position - 1]
+            report[label] = report.get(label, 0) + int(label_counts[position])
+        logging.warning(f'{unmapped.sum()} values of {series.name} have no {lookup.name} mapping. These are left missing.')
+    
+    return pd.Series(pd.Categorical.from_codes(np.where(unmapped, -1, codes), categories=lookup.categories), index=series.index)
+
+def unmapped_label_report():
+    """
+    Function which logs and returns the labels which had no mapping so far in this process.
+    ---
+    
+    Keyword Arguments:
+    None.
+    
+    Returns:
+    report_df -- pandas dataframe with lookup, label and count columns.
+    """
+    report_df = pd.DataFrame([{'lookup': name, 'label': label, 'count': count} for name, labels in unmapped_labels.items() for label, count in labels.items()], 
+                             columns=['lookup', 'label', 'count'])
+    for row in report_df.itertuples():
+        logging.warning(f'Unmapped {row.lookup} label {row.label!r} seen {row.count} times.')
+    
+    return report_df
+
+#compile the harmonisation dictionaries once.
+severity_lookup = lookup_compiler(severity_dict, 'severity')
+midblock_lookup = lookup_compiler(midblock_dict, 'midblock')
+road_position_horizontal_lookup = lookup_compiler(road_position_horizontal_dict, 'road_position_horizontal')
+road_position_vertical_lookup = lookup_compiler(road_position_vertical_dict, 'road_position_vertical')
+road_sealed_lookup = lookup_compiler(road_sealed_dict, 'road_sealed')
+road_wet_lookup = lookup_compiler(road_wet_dict, 'road_wet')
+weather_lookup = lookup_compiler(weather_dict, 'weather')
+lighting_lookup = lookup_compiler(lighting_dict, 'lighting')
+traffic_controls_lookup = lookup_compiler(traffic_controls_dict, 'traffic_controls')
+
 #some date dictionaries to make the date manipulations easier.
 
 month_dict = {'January': 1, 
@@ -1,19 +1,32 @@
 import logging
 import pandas as pd
 from datetime import datetime
-from sa_etl import sa_main
-from vic_etl import vic_main
-from nz_etl import nz_main
-from qld_etl import qld_main
-from wa_etl import wa_main
-from act_etl import act_main
+from sa_etl import sa_main, sa_fingerprint
+from vic_etl import vic_main, vic_fingerprint
+from nz_etl import nz_main, nz_fingerprint
+from qld_etl import qld_main, qld_fingerprint
+from wa_etl import wa_main, wa_fingerprint
+from act_etl import act_main, act_fingerprint
 
 from crash_utilities import expected_crash_fields, expected_location_fields, expected_datetime_fields, expected_vehicle_tab_fields, expected_casualty_fields
 from crash_utilities import expected_description_fields 
+from crash_utilities import prewarm_transformers, transformer_registry_report, transformer_registry_stats, unmapped_label_report, unmapped_labels
+from crash_utilities import datetime_key_formatter, datetime_key_layout
+from crash_cache import raw_cache_options
+from crash_storage import storage_path, storage_write_csv, storage_write_dataset, storage_remover, storage_report
+import crash_schema
+from crash_pipeline import Stage, pipeline_runner, partition_fingerprint, partition_loader, partition_writer
+from crash_instrumentation import instrumentation_options, stage_records, report_sections, stage_instrument, row_counter, run_report_writer
 
 import os
+import time
+import resource
+import threading
+import argparse
 import configparser
+import importlib.util
 import pyarrow
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 #read the config file to extract the aws credentials
 config = configparser.ConfigParser()
@@ -21,61 +34,174 @@ config.read('config_file.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-#set the base s3_path for subsequent manipulation 
-s3_path = config['S3']['S3_BUCKET_PATH']
+#size bound for the local mirror of the raw csv files
+raw_cache_options['max_bytes'] = config.getint('CACHE', 'RAW_CACHE_MAX_BYTES', fallback=raw_cache_options['max_bytes'])
+
+#stage checkpoints of the final tables - unset runs without checkpoints
+checkpoint_dir = config.get('CACHE', 'CHECKPOINT_DIR', fallback=None) or None
+
+#parallel jurisdiction runs - worker processes and an optional address space limit in bytes for each jurisdiction's process.
+jurisdiction_workers = config.getint('PARALLEL', 'WORKERS', fallback=1)
+jurisdiction_memory_limits = {name: int(config.get('PARALLEL', f'MEMORY_LIMIT_{name}', fallback='') or 0) or None for name in ['VIC', 'SA', 'NZ', 'QLD', 'WA', 'ACT']}
+
+#each jurisdiction's etl, in the order the staging tables are joined, and the function fingerprinting its inputs for incremental runs.
+jurisdiction_mains = {'SA': sa_main, 'VIC': vic_main, 'NZ': nz_main, 'QLD': qld_main, 'WA': wa_main, 'ACT': act_main}
+jurisdiction_fingerprinters = {'SA': sa_fingerprint, 'VIC': vic_fingerprint, 'NZ': nz_fingerprint, 'QLD': qld_fingerprint, 'WA': wa_fingerprint, 
+                               'ACT': act_fingerprint}
+
+#parquet output - each table is a hive partitioned dataset so state or year scoped reads only open those directories. The partition fields are copies 
+#built by partition_field_builder, so the table's own fields are stored unchanged.
+final_partitions = {'Crash': ['state_partition', 'year_partition'], 'Location': ['state_partition'], 'DateTime': ['year_partition']}
+parquet_options = {'row_group_size': config.getint('PARQUET', 'ROW_GROUP_SIZE', fallback=262144), 
+                   'compression': config.get('PARQUET', 'COMPRESSION', fallback='snappy')}
+
+#final writes - the number run at once, the compression of the csv objects (none, gzip or zstd - zstd needs the zstandard package), and the bytes of 
+#table data being written at once. A blank memory budget bounds the writes by the workers alone.
+output_options = {'workers': config.getint('OUTPUT', 'WORKERS', fallback=4), 'csv_compression': config.get('OUTPUT', 'CSV_COMPRESSION', fallback=None) or None,
+                  'memory_bytes': int(config.get('OUTPUT', 'MEMORY_BYTES', fallback=str(1024**3)) or 0) or None}
+csv_extensions = {None: '.csv', 'gzip': '.csv.gz', 'zstd': '.csv.zst'}
+#the codec is checked now rather than when the first table is written, after every jurisdiction has run.
+if output_options['csv_compression'] not in csv_extensions:
+    raise ValueError(f"CSV_COMPRESSION must be blank, gzip or zstd, not {output_options['csv_compression']}.")
+if output_options['csv_compression'] == 'zstd' and importlib.util.find_spec('zstandard') is None:
+    raise ImportError('CSV_COMPRESSION = zstd needs the zstandard package - install it, or use gzip or leave it blank.')
+
+#staging partitions kept by incremental runs - each jurisdiction's staging table and the fingerprint of the inputs it was built from.
+staging_partition_root = storage_path('Staging', 'Jurisdictions')
+
+#run reports - the local directory the json report of each run is written to, unset writes none, and whether stages trace their python allocations.
+run_report_dir = config.get('REPORT', 'RUN_REPORT_DIR', fallback='reports') or None
+instrumentation_options['tracemalloc'] = config.getboolean('REPORT', 'TRACEMALLOC', fallback=False)
 
 #initialise logging
 logging.basicConfig(filename=f'file{datetime.now().strftime("%Y-%m-%d")}.log', filemode='w', format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
                     level=logging.DEBUG)
 
-def etl_main():
-    logging.info('Commencing ETL runs.')
+def jurisdiction_runner(name, years = None, since = None, memory_limit = None, refresh_cache = False):
+    """
+    Function which runs one jurisdiction's etl inside a worker process of the parallel executor.
+    ---
     
-    #south australia
-    logging.info('Commencing SA data run')
-    sa_merge_df = sa_main()
+    Keyword Arguments:
+    name -- string jurisdiction code, e.g. VIC.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    memory_limit -- integer address space limit in bytes for the run. A run going over it fails, typically with a MemoryError, rather than starving 
+                    the others.
+    refresh_cache -- boolean. If true, every raw csv is read from source and its copy in the local raw file mirror is replaced.
     
-    #Victoria
-    logging.info('Commencing Vic data run')
-    vic_merge_df = vic_main()
+    Returns:
+    merge_df -- the jurisdiction's staging dataframe, or list of the paths of its part files if it is streamed.
+    seconds -- float wall clock seconds the run took.
+    labels -- dictionary of the unmapped label counts seen during the run, for merging into the parent's report.
+    records -- list of the stage records of the run, for merging into the parent's run report.
+    transformer_stats -- dictionary of the transformer registry hits and misses during the run, for merging into the parent's registry report.
+    """
+    raw_cache_options['refresh'] = refresh_cache
+    unmapped_labels.clear()
+    #a forked worker starts with the parent's counts - only this run's are sent back.
+    transformer_registry_stats.update({stat: 0 for stat in transformer_registry_stats})
+    stage_records.clear()
     
-    #New Zealand
-    logging.info('Commencing NZ data run')
-    nz_merge_df = nz_main()
+    start = time.perf_counter()
     
-    #Queensland
-    logging.info('Commencing QLD data run')
-    qld_merge_df = qld_main()
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit if hard_limit == resource.RLIM_INFINITY else min(memory_limit, hard_limit), hard_limit))
+    try:
+        with stage_instrument(name, 'total') as record:
+            merge_df = jurisdiction_mains[name](years = years, since = since)
+            record['rows_out'] = row_counter(merge_df)
+    finally:
+        #lift the limit again before the result is sent back - the worker needs the headroom to report a failure and is reused for later jurisdictions.
+        resource.setrlimit(resource.RLIMIT_AS, (hard_limit, hard_limit))
     
-    #Western australia
-    logging.info('Commencing WA data run')
-    wa_merge_df = wa_main()
+    return merge_df, time.perf_counter() - start, dict(unmapped_labels), list(stage_records), dict(transformer_registry_stats)
+
+def jurisdiction_executor(workers, names = None, years = None, since = None, refresh_cache = False):
+    """
+    Function which runs every jurisdiction's etl concurrently on a process pool. The largest jurisdictions are submitted first so they are never 
+    left to run alone at the end.
+    ---
     
-    #Australian Capital Territory data run
-    logging.info('Commencing ACT data run')
-    act_merge_df = act_main()
+    Keyword Arguments:
+    workers -- integer number of worker processes.
+    names -- iterable of the jurisdiction codes to run. If None every jurisdiction is run.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    refresh_cache -- boolean. If true, every raw csv is read from source and its copy in the local raw file mirror is replaced.
     
-    logging.info('All state level ETL runs completed successfully.')
+    Returns:
+    merge_dfs -- dictionary of jurisdiction code to staging dataframe.
+    """
+    start = time.perf_counter()
+    merge_dfs = {}
+    run_seconds = {}
     
-    #join all staging tables together
-    logging.info('Merge state level datasets...')
-    staging_df = pd.concat([sa_merge_df, vic_merge_df, nz_merge_df, qld_merge_df, wa_merge_df, act_merge_df], axis=0)
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        #submitted largest first - the dict order is the order work is picked up in.
+        futures = {name: executor.submit(jurisdiction_runner, name, years, since, jurisdiction_memory_limits[name], refresh_cache) 
+                   for name in jurisdiction_memory_limits if names is None or name in names}
+        
+        for name, future in futures.items():
+            try:
+                merge_dfs[name], run_seconds[name], labels, records, transformer_stats = future.result()
+            except Exception:
+                logging.error(f'{name} data run failed. Its memory limit is {jurisdiction_memory_limits[name]} bytes.')
+                raise
+            logging.info(f'{name} data run completed in {run_seconds[name]:.1f} seconds.')
+            
+            #workers keep their own unmapped label, stage and transformer registry counts - fold them into this process so the reports cover every 
+            #jurisdiction.
+            for lookup_name, label_counts in labels.items():
+                report = unmapped_labels.setdefault(lookup_name, {})
+                for label, count in label_counts.items():
+                    report[label] = report.get(label, 0) + count
+            stage_records.extend(records)
+            for stat, count in transformer_stats.items():
+                transformer_registry_stats[stat] += count
+    
+    wall_seconds = time.perf_counter() - start
+    #the runs share the machine while they overlap, so the sum of their times only estimates how long they would take one after another.
+    sequential_seconds = sum(run_seconds.values())
+    logging.info(f'Parallel jurisdiction runs took {wall_seconds:.1f} seconds against an estimated {sequential_seconds:.1f} seconds run one after '
+                 f'another (the sum of the worker run times) - an estimated {sequential_seconds/wall_seconds:.2f}x speedup on {workers} workers.')
+    
+    return merge_dfs
+
+def table_splitter(params, staging_dfs):
+    """
+    Function which splits the jurisdictions' staging tables into the final tables and drops their duplicates.
+    ---
     
-    logging.info('Generate serial numbe for description field...')
-    #generate serial number for rows for description id - could use crash id as primary key for description table but this is somewhat nicer - prevents silly joins.
-    #double reset index - and drop the original description id.
-    staging_df = staging_df.reset_index(drop=True).reset_index().drop(columns=['description_id']).rename(columns = {'index':'description_id'})
+    Keyword Arguments:
+    params -- dictionary of run parameters. integer_keys -- boolean. If true, packed integer vehicles_key and casualties_key fields are generated 
+              alongside the string ids. check_sample -- integer number of rows dropped from each dimension to check against the row kept for their key.
+    staging_dfs -- list of the jurisdictions' staging dataframes. The list is emptied as they are absorbed.
     
+    Returns:
+    tables -- tuple of the crash, description, datetime, casualties, location and vehicles dataframes.
+    """
     logging.info('Splitting table structure...')
-    #split into tables and drop duplicates
-    crash_df = staging_df[expected_crash_fields].drop_duplicates()
-    description_df = staging_df[expected_description_fields].drop_duplicates()
-    datetime_df = staging_df[expected_datetime_fields].drop_duplicates()
-    casualties_df = staging_df[expected_casualty_fields].drop_duplicates()
-    location_df = staging_df[expected_location_fields].drop_duplicates()
-    vehicles_df = staging_df[expected_vehicle_tab_fields].drop_duplicates()
+    #the staging tables are absorbed one at a time rather than joined first - the joined table and its slices were several times the data size.
+    tables = crash_schema.star_schema_builder(staging_dfs, params['integer_keys'], params['check_sample'])
+    logging.info('Success.')
     
-    logging.info('Success. Running count checks.')
+    return tables
+
+def final_writer(tables):
+    """
+    Function which count checks the final tables and writes them to the final bucket as csv and parquet, concurrently within the memory budget.
+    ---
+    
+    Keyword Arguments:
+    tables -- tuple of the crash, description, datetime, casualties, location and vehicles dataframes output by table_splitter.
+    
+    Returns:
+    None.
+    """
+    crash_df, description_df, datetime_df, casualties_df, location_df, vehicles_df = tables
+    logging.info('Running count checks.')
     
     #one more dict for the road - get dict of name of table vs table object
     name_dict = {'Crash': crash_df, 'Description': description_df, 'DateTime': datetime_df, 'Casualties': casualties_df, 'Location': location_df, 
@@ -86,25 +212,227 @@ def etl_main():
         row_count = len(name_dict[key])
         logging.info(f'{key} table contains {row_count} rows.')
     
-    #paths for writing - using both csv and parquet
-    s3_csv_path = s3_path + '/Final/CSV/'
-    s3_parquet_path = s3_path + '/Final/parquet/'
-    
-    #write to final bucket - csv first
-    crash_df.to_csv(s3_csv_path + 'Crash.csv')
-    description_df.to_csv(s3_csv_path + 'Description.csv')
-    datetime_df.to_csv(s3_csv_path + 'DateTime.csv')
-    casualties_df.to_csv(s3_csv_path + 'Casualties.csv')
-    location_df.to_csv(s3_csv_path + 'Location.csv')
-    vehicles_df.to_csv(s3_csv_path + 'Vehicles.csv')
-    
-    #now parquet
-    crash_df.to_parquet(s3_parquet_path + 'Crash.csv')
-    description_df.to_parquet(s3_parquet_path + 'Description.csv')
-    datetime_df.to_parquet(s3_parquet_path + 'DateTime.csv')
-    casualties_df.to_parquet(s3_parquet_path + 'Casualties.csv')
-    location_df.to_parquet(s3_parquet_path + 'Location.csv')
-    vehicles_df.to_parquet(s3_parquet_path + 'Vehicles.csv')
-    
-if __name__ is '__main__':
-    etl_main()
\ No newline at end of file
+    #the tables are serialised and uploaded concurrently on a bounded pool, rather than each write waiting on the last. Each write holds working copies 
+    #of its table, so writes only start while the tables being written fit the memory budget - a table larger than the budget is written alone.
+    csv_compression = output_options['csv_compression']
+    budget = {'bytes': output_options['memory_bytes'], 'in_use': 0, 'condition': threading.Condition()}
+    output_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = output_options['workers']) as executor:
+        futures = []
+        for name, df in name_dict.items():
+            table_bytes = int(df.memory_usage(index=True, deep=True).sum())
+            futures.append(executor.submit(budgeted_writer, budget, table_bytes, name, 'csv', df, 
+                                           storage_path('Final', 'CSV', name + csv_extensions[csv_compression]), compression = csv_compression))
+            futures.append(executor.submit(budgeted_writer, budget, table_bytes, name, 'parquet', df, storage_path('Final', 'parquet', name), 
+                                           partition_cols = final_partitions.get(name), **parquet_options))
+        
+        results = [future.result() for future in futures]
+    
+    output_report(results, time.perf_counter() - output_start)
+
+def partition_field_builder(df, partition_cols):
+    """
+    Function which adds the fields a table's parquet dataset is partitioned on. pyarrow takes partition fields out of the files and reads them back as 
+    categories at the end of the table, so they are copies rather than the table's own fields.
+    ---
+    
+    Keyword Arguments:
+    df -- pandas dataframe of the table, with a state field for state_partition and a date_time_id field for year_partition.
+    partition_cols -- list of the partition field names wanted.
+    
+    Returns:
+    df -- shallow copy of the dataframe with the partition fields added. The table's own columns are not copied.
+    """
+    df = df.copy(deep=False)
+    if 'state_partition' in partition_cols:
+        df['state_partition'] = df['state']
+    if 'year_partition' in partition_cols:
+        #read from the packed date_time_id, which leads with the year, so unknown years go to its 9999 sentinel rather than to a null partition.
+        df['year_partition'] = df['date_time_id'] // datetime_key_layout[0][1]
+    
+    return df
+
+def budgeted_writer(budget, table_bytes, *args, **kwargs):
+    """
+    Function which runs table_writer once the write fits the memory budget, and gives its share of the budget back when it is done.
+    ---
+    
+    Keyword Arguments:
+    budget -- dictionary of the budget bytes, or None for no budget, the bytes in use and the condition guarding them. Shared by every write.
+    table_bytes -- integer in memory bytes of the table being written, counted against the budget.
+    args, kwargs -- arguments passed on to table_writer.
+    
+    Returns:
+    result -- dictionary output by table_writer.
+    """
+    with budget['condition']:
+        #a write always starts when nothing else is running, so a table larger than the budget still gets written.
+        budget['condition'].wait_for(lambda: budget['bytes'] is None or budget['in_use'] == 0 or budget['in_use'] + table_bytes <= budget['bytes'])
+        budget['in_use'] += table_bytes
+    try:
+        return table_writer(*args, **kwargs)
+    finally:
+        with budget['condition']:
+            budget['in_use'] -= table_bytes
+            budget['condition'].notify_all()
+
+def table_writer(name, output_format, df, path, **write_kwargs):
+    """
+    Function which writes one final table in one format - a csv object, or a parquet dataset - and measures the write. The fields each format needs 
+    are derived here, on a shallow copy, so only the writes running at the time hold them.
+    ---
+    
+    Keyword Arguments:
+    name -- string name of the table, e.g. Crash.
+    output_format -- string, csv or parquet.
+    df -- pandas dataframe of the table as built by table_splitter.
+    path -- string storage path of the csv object or parquet dataset directory.
+    write_kwargs -- keyword arguments passed on to storage_write_csv or storage_write_dataset.
+    
+    Returns:
+    result -- dictionary of table, format, path, rows, bytes and seconds.
+    """
+    start = time.perf_counter()
+    if output_format == 'parquet':
+        df = partition_field_builder(df, write_kwargs.get('partition_cols') or [])
+    else:
+        df = df.copy(deep=False)
+    #the state carried on the crash table is only there to build its partitions.
+    if name == 'Crash':
+        del df['state']
+    
+    if output_format == 'csv':
+        #date_time_id is packed as an integer; csv consumers get the legacy string.
+        if 'date_time_id' in df.columns:
+            df['date_time_id'] = datetime_key_formatter(df['date_time_id'])
+        byte_count = storage_write_csv(df, path, **write_kwargs)
+        
+        #a copy left behind under another compression's name would no longer be current.
+        for extension in set(csv_extensions.values()) - {csv_extensions[write_kwargs.get('compression')]}:
+            storage_remover(storage_path('Final', 'CSV', name + extension))
+    else:
+        byte_count = storage_write_dataset(df, path, **write_kwargs)
+        #the single file the table used to be written to, misleadingly named .csv.
+        storage_remover(storage_path('Final', 'parquet', f'{name}.csv'))
+    
+    return {'table': name, 'format': output_format, 'path': path, 'rows': len(df), 'bytes': byte_count, 'seconds': time.perf_counter() - start}
+
+def output_report(results, wall_seconds):
+    """
+    Function which logs the rows, bytes and write throughput of every final table in every format.
+    ---
+    
+    Keyword Arguments:
+    results -- list of dictionaries output by table_writer.
+    wall_seconds -- float wall clock seconds all of the writes took together.
+    
+    Returns:
+    report_df -- pandas dataframe with one row per table and format and the columns table, format, path, rows, bytes, seconds and mb_per_second.
+    """
+    report_df = pd.DataFrame(results, columns=['table', 'format', 'path', 'rows', 'bytes', 'seconds'])
+    report_df['mb_per_second'] = report_df['bytes']/1024**2/report_df['seconds'].where(report_df['seconds'] > 0)
+    
+    report_sections['outputs'] = {'wall_seconds': wall_seconds, 'writes': list(results)}
+    for row in report_df.itertuples():
+        logging.info(f'Wrote {row.table} {row.format}: {row.rows} rows, {row.bytes} bytes in {row.seconds:.3f}s ({row.mb_per_second:.1f} MB/s)')
+    logging.info(f'Wrote {len(report_df)} outputs, {report_df["bytes"].sum()} bytes in {wall_seconds:.2f} seconds against {report_df["seconds"].sum():.2f} '
+                 f'seconds written one after another.')
+    
+    return report_df
+
+def etl_main(integer_keys = False, refresh_cache = False, years = None, since = None, workers = jurisdiction_workers, incremental = False, 
+             check_sample = 0):
+    """
+    Function which runs every jurisdiction's etl, combines the staging tables and writes the final tables. Every stage is timed and, unless the run 
+    report directory is unset, a json report of the run's stages, writes and storage transfers is written there for comparing runs.
+    ---
+    
+    Keyword Arguments:
+    integer_keys -- boolean. If true, packed integer vehicles_key and casualties_key fields are generated alongside the string ids. The Vehicles and 
+                    Casualties tables are then deduplicated on the integer keys and the Crash table carries them for joins. Off by default - the 
+                    packed counts have fixed widths, and a crash with more of a vehicle type than its width holds, e.g. 8 vans, fails the final build.
+    refresh_cache -- boolean. If true, every raw csv is read from source and its copy in the local raw file mirror is replaced.
+    years -- iterable of integer years to load for every jurisdiction. If None every year is loaded.
+    since -- integer first year to load for every jurisdiction. If None there is no lower bound.
+    workers -- integer number of processes the jurisdictions are run on. 1 runs them one after another in this process.
+    incremental -- boolean. If true, only the jurisdictions whose raw sources, run parameters or code changed since their staging partition was 
+                   written are run. Their partitions are replaced and the final tables are rebuilt with the other jurisdictions' partitions.
+    check_sample -- integer. The Location, DateTime, Casualties and Vehicles tables keep the first row for each key. If above 0, this many of the 
+                    dropped rows of each are compared with the row kept for their key and any differences are logged.
+    
+    Returns:
+    None.
+    """
+    logging.info('Commencing ETL runs.')
+    raw_cache_options['refresh'] = refresh_cache
+    started = datetime.now()
+    start = time.perf_counter()
+    stage_records.clear()
+    report_sections.clear()
+    
+    #build the sa and vic coordinate transformers once at startup
+    prewarm_transformers()
+    
+    if incremental:
+        fingerprints = {name: fingerprinter(years = years, since = since) for name, fingerprinter in jurisdiction_fingerprinters.items()}
+        run_names = [name for name in jurisdiction_mains if partition_fingerprint(staging_partition_root, name) != fingerprints[name]]
+        logging.info(f'Incremental run - inputs changed for {run_names or "no jurisdictions"}.')
+    else:
+        run_names = list(jurisdiction_mains)
+    
+    with stage_instrument('ETL', 'jurisdictions') as record:
+        if workers > 1 and len(run_names) > 1:
+            logging.info(f'Commencing state level ETL runs on {workers} processes')
+            merge_dfs = jurisdiction_executor(workers, run_names, years = years, since = since, refresh_cache = refresh_cache)
+        else:
+            merge_dfs = {}
+            for name in run_names:
+                logging.info(f'Commencing {name} data run')
+                with stage_instrument(name, 'total') as name_record:
+                    merge_dfs[name] = jurisdiction_mains[name](years = years, since = since)
+                    name_record['rows_out'] = row_counter(merge_dfs[name])
+        record['rows_out'] = row_counter(list(merge_dfs.values()))
+    
+    logging.info('All state level ETL runs completed successfully.')
+    transformer_registry_report()
+    unmapped_label_report()
+    
+    final_stages = [Stage('split', table_splitter, ['params', 'staging']),
+                    Stage('write', final_writer, ['split'])]
+    
+    if incremental:
+        with stage_instrument('ETL', 'partitions') as record:
+            for name in run_names:
+                partition_writer(merge_dfs[name], staging_partition_root, name, fingerprints[name])
+            for name in jurisdiction_mains:
+                if name not in run_names:
+                    logging.info(f'{name} inputs unchanged - loading its staging partition.')
+                    merge_dfs[name] = partition_loader(staging_partition_root, name)
+            record['rows_out'] = row_counter(list(merge_dfs.values()))
+    
+    #the jurisdiction outputs are keyed on their contents, so a rerun over unchanged staging data resumes from the saved split.
+    external = {'staging': [merge_dfs.pop(name) for name in jurisdiction_mains]}
+    pipeline_runner('Final', final_stages, {'integer_keys': integer_keys, 'check_sample': check_sample}, checkpoint_dir, [__file__, crash_schema.__file__], external = external)
+    
+    storage_df = storage_report()
+    
+    if run_report_dir is not None:
+        run_info = {'started': started.isoformat(timespec='seconds'), 'wall_seconds': time.perf_counter() - start, 'jurisdictions_run': run_names, 
+                    'params': {'integer_keys': integer_keys, 'refresh_cache': refresh_cache, 'years': list(years) if years is not None else None, 
+                               'since': since, 'workers': workers, 'incremental': incremental, 'check_sample': check_sample, 
+                               'tracemalloc': instrumentation_options['tracemalloc']}}
+        run_report_writer(run_report_dir, run_info, storage_df)
+    
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the ANZ crash ETL.')
+    parser.add_argument('--refresh', action='store_true', help='ignore the local raw file mirror and re-read every raw csv from source')
+    parser.add_argument('--years', type=int, nargs='+', help='only load these years')
+    parser.add_argument('--since', type=int, help='only load this year and later')
+    parser.add_argument('--workers', type=int, default=jurisdiction_workers, help='number of processes the jurisdictions are run on')
+    parser.add_argument('--incremental', action='store_true', help='only rerun the jurisdictions whose inputs changed since the last incremental run')
+    parser.add_argument('--integer-keys', action='store_true', help='also generate packed integer vehicles and casualties keys and deduplicate on them')
+    parser.add_argument('--check-sample', type=int, default=0, help='number of rows dropped from each dimension to check against the row kept for their key')
+    args = parser.parse_args()
+    
+    etl_main(integer_keys = args.integer_keys, refresh_cache = args.refresh, years = args.years, since = args.since, workers = args.workers, 
+             incremental = args.incremental, check_sample = args.check_sample)
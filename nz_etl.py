@@ -4,6 +4,10 @@ import pyarrow
 import pyproj
 import configparser
 from crash_utilities import *
+from crash_storage import storage_path, storage_read_csv_chunks, storage_remover, storage_write_parquet
+from crash_cache import cached_csv_reader
+from crash_pipeline import Stage, pipeline_runner, pipeline_fingerprint
+from crash_instrumentation import stage_instrument
 from datetime import datetime
 
 #read the config file to extract the aws credentials
@@ -12,9 +16,44 @@ config.read('config_file.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-#set the base s3_path for subsequent manipulation 
-s3_path = config['S3']['S3_BUCKET_PATH']
+#optional local parquet mirror of the raw csv files - unchanged files are loaded from the mirror rather than parsed again.
+raw_cache_dir = config.get('CACHE', 'RAW_CACHE_DIR', fallback=None) or None
 
+#optional checkpoints of every pipeline stage's output - a rerun after a failure resumes from the last stage saved.
+checkpoint_dir = config.get('CACHE', 'CHECKPOINT_DIR', fallback=None) or None
+
+#optional streaming mode - rows per chunk when the nz csv is processed a chunk at a time. Unset reads the file whole.
+nz_stream_chunksize = int(config.get('NZ', 'STREAM_CHUNKSIZE', fallback='') or 0) or None
+
+#declarative mapping of the raw NZ unit type fields to the harmonised vehicle fields. Compiled once into an incidence matrix.
+nz_vehicle_mapping = {'animals': ['animals'],
+                      'car_sedan': ['carStation'],
+                      'car_utility': ['vanOrUtili'],
+                      'car_van': [],
+                      'car_4x4': ['suv'],
+                      'car_station_wagon': [],
+                      'motor_cycle': ['motorcycle'],
+                      'truck_small': [],
+                      'truck_large': ['truck'],
+                      'bus': ['bus', 'schoolBus'],
+                      'taxi': ['taxi'],
+                      'bicycle': ['bicycle'],
+                      'scooter': ['moped'],
+                      'pedestrian': ['Pedestrian'],
+                      'inanimate': ['bridge', 'cliffBank', 'debris', 'ditch', 'fence', 'guardRail', 'houseBuild', 'kerb', 'objectThro', 'overBank',
+                                    'parkedVehi', 'phoneBoxEt', 'postOrPole', 'roadworks', 'slipFlood', 'strayAnima', 'trafficIsl', 'trafficSig',
+                                    'tree', 'waterRiver'],
+                      'train': ['train'],
+                      'tram': [],
+                      'vehicle_other': ['otherVehic', 'unknownVeh', 'other', 'vehicle']}
+nz_vehicle_incidence = vehicle_incidence_compiler(nz_vehicle_mapping)
+
+#columns read from the raw nz file and the dtypes they are parsed as - this is everything the nz etl consumes. None leaves pandas to infer the dtype.
+#labels only ever looked up or passed through are categories. trafficCon stays as strings as its gaps are filled with a new label.
+nz_read_schema = {'OBJECTID': None, 'X': 'float64', 'Y': 'float64', 'crashYear': 'int16', 'crashSever': 'category', 'intersec_1': 'category', 
+                  'roadCurvat': 'category', 'flatHill': 'category', 'weatherA': 'category', 'light': 'category', 'trafficCon': None, 'speedLimit': None, 
+                  'tlaName': 'category', 'areaUnitID': None, 'fatalCount': 'int16', 'seriousInj': 'int16', 'minorInjur': 'int16', 
+                  **{raw_field: 'int16' for raw_field in nz_vehicle_incidence.raw_fields}}
 
 def nz_vehicle_summary_harmoniser(df):
     """
@@ -29,58 +68,17 @@ def nz_vehicle_summary_harmoniser(df):
     """
     logging.info('Parsing vehicle data...')
     
-    logging.info('Declare mappings')
-    #declare mappings
-    animal_fields = ['animals']
-    car_sedan_fields = ['carStation']
-    car_utility_fields = ['vanOrUtili']
-    car_van_fields = []
-    car_4x4_fields = ['suv']
-    car_station_wagon_fields = []
-    motor_cycle_fields = ['motorcycle']
-    truck_small_fields = []
-    truck_large_fields = ['truck'] 
-    bus_fields = ['bus', 'schoolBus']
-    taxi_fields = ['taxi']
-    bicycle_fields = ['bicycle']
-    scooter_fields = ['moped']
-    pedestrian_fields = ['Pedestrian']
-    inanimate_fields = ['bridge', 'cliffBank', 'debris', 'ditch', 'fence', 'guardRail', 'houseBuild', 'kerb', 'objectThro', 'overBank', 'parkedVehi', 'phoneBoxEt',
-                        'postOrPole', 'roadworks', 'slipFlood', 'strayAnima', 'trafficIsl', 'trafficSig', 'tree', 'waterRiver']
-    train_fields = ['train']
-    tram_fields = []
-    vehicle_other_fields = ['otherVehic', 'unknownVeh', 'other', 'vehicle']
-    
     logging.info('Summing values...')
-    #apply the mapping by summing columns in each field name. 
-    df['animals'] = df[animal_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['car_sedan'] = df[car_sedan_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['car_utility'] = df[car_utility_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_van'] = df[car_van_fields].apply(sum, axis=1).fillna(0)
-    df['car_4x4'] = df[car_4x4_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_station_wagon'] = df[car_station_wagon_fields].apply(sum, axis=1).fillna(0)
-    df['motor_cycle'] = df[motor_cycle_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['truck_small'] = df[truck_small_fields].apply(sum, axis=1).fillna(0)
-    df['truck_large'] = df[truck_large_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['bus'] = df[bus_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['taxi'] = df[taxi_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['bicycle'] = df[bicycle_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['scooter'] = df[scooter_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['pedestrian'] = df[pedestrian_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['inanimate'] = df[inanimate_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['train'] = df[train_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['tram'] = df[tram_fields].apply(sum, axis=1).fillna(0)
-    df['vehicle_other'] = df[vehicle_other_fields].astype(int).apply(sum, axis=1).fillna(0)
-    
-    #add in two missing fields using structure checker
-    logging.info('Adding missing fields...')
-    df = structure_checker(df, expected_vehicle_fields, coerce=True, add_only = True)
+    #apply the mapping - every harmonised field is totalled from the raw fields in a single matrix product.
+    totals_df = vehicle_category_aggregator(df, nz_vehicle_incidence)
+    for field in expected_vehicle_fields:
+        df[field] = totals_df[field]
     
     #add in 0s
     df[expected_vehicle_fields] = df[expected_vehicle_fields].fillna(0).astype(int)
     
     #generate IDs 
-    df['vehicles_id'] = df.apply(vehicles_id_generator, axis=1)
+    df['vehicles_id'] = vehicles_id_builder(df)
             
     return df
     
@@ -103,7 +101,7 @@ def nz_casualties_summary_harmoniser(df):
     df['casualties'] = df['fatalities'] + df['serious_injuries'] + df['minor_injuries']
     
     #now generate the id field
-    df['casualties_id'] = df.apply(casualties_id_generator, axis=1)
+    df['casualties_id'] = casualties_id_builder(df)
     
     return df
     
@@ -120,20 +118,20 @@ def nz_description_harmoniser(df):
     
     #go down the list of things we can get for vic
     #severity - coerce to int bcause victoria records as int and dictionary accepts string keys
-    df['severity'] = df['crashSever'].astype(str).apply(lambda x: severity_dict[x])
+    df['severity'] = categorical_mapper(df['crashSever'].astype(str), severity_lookup)
     
     #intersection and midblock are opposites of one another.
-    df['midblock'] = df['intersec_1'].apply(lambda x: midblock_dict[x])
+    df['midblock'] = categorical_mapper(df['intersec_1'], midblock_lookup)
     df['intersection'] = (df['midblock']==False)
     
     #road positions
-    df['road_position_horizontal'] = df['roadCurvat'].apply(lambda x: road_position_horizontal_dict[x])
-    df['road_position_vertical'] = df['flatHill'].apply(lambda x: road_position_vertical_dict[x])
+    df['road_position_horizontal'] = categorical_mapper(df['roadCurvat'], road_position_horizontal_lookup)
+    df['road_position_vertical'] = categorical_mapper(df['flatHill'], road_position_vertical_lookup)
     
     #other condition
-    df['weather'] = df['weatherA'].apply(lambda x: weather_dict[x])
-    df['lighting'] = df['light'].apply(lambda x: lighting_dict[x])
-    df['traffic_controls'] = df['trafficCon'].fillna('Nil').apply(lambda x: traffic_controls_dict[x])
+    df['weather'] = categorical_mapper(df['weatherA'], weather_lookup)
+    df['lighting'] = categorical_mapper(df['light'], lighting_lookup)
+    df['traffic_controls'] = categorical_mapper(df['trafficCon'].fillna('Nil'), traffic_controls_lookup)
     
     #rename: speedLimit --> speed_limit
     df = df.rename(columns = {'speedLimit': 'speed_limit'})
@@ -159,8 +157,8 @@ def nz_datetime_handler(df):
     #assign approximate false because information provided is sufficient.
     df = df.assign(approximate = True)
     
-    #generate id using string operations. - truly this is pitiful
-    df['date_time_id'] = (df['year'].apply(str) + '-' + '-' + '-' + '-' )
+    #pack the parts into a single integer key - datetime_key_formatter gives back the legacy string.
+    df['date_time_id'] = datetime_key_builder(df)
     
     return df
     
@@ -177,7 +175,7 @@ def nz_location_handler(df):
     """
     logging.info('Parsing location data...')
     #generate the key field
-    df['lat_long'] = df[['X', 'Y']].apply(lambda x: (x[0], x[1]), axis=1)
+    df['lat_long'] = location_key_builder(df['X'], df['Y'])
     
     #assign country and state
     df = df.assign(country = 'NZ')
@@ -189,39 +187,185 @@ def nz_location_handler(df):
     return df
     
     
-def nz_main():
+def nz_data_loader(years = None, since = None):
     """
-    Function which conducts the etl to the final staging structure for new zealand data
+    Function which loads the new zealand crash data into memory as a pandas dataframe from the s3 storage location.
     ---
     
     Keyword Arguments:
-    None.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
     
     Returns:
-    Data frame containing the structure coerced appropriately to the correct format.
+    nz_df -- pandas dataframe containing the new zealand crash data
     """
     #read the datasets
     logging.info('Read in datasets...')
-    nz_df = pd.read_csv(s3_path+'/crash_nz/crash_nz.csv')
+    row_filter = None
+    if years is not None or since is not None:
+        row_filter = lambda df: year_mask(df['crashYear'], years, since)
+    nz_df = cached_csv_reader(storage_path('crash_nz', 'crash_nz.csv'), raw_cache_dir, row_filter, **read_schema_kwargs(nz_read_schema))
     
-    #field harmonisation
+    return nz_df
+
+def nz_harmoniser(nz_df):
+    """
+    Function which runs the vehicle, casualty and description harmonisers.
+    ---
+    
+    Keyword Arguments:
+    nz_df -- pandas dataframe of the raw nz crash data.
+    
+    Returns:
+    nz_df -- pandas dataframe with the harmonised fields.
+    """
     logging.info('Harmonising and renaming fields...')
     nz_df = nz_vehicle_summary_harmoniser(nz_df)
     nz_df = nz_casualties_summary_harmoniser(nz_df)
     nz_df = nz_description_harmoniser(nz_df)
+    
+    return nz_df
 
-    #field name changing
-    nz_df = nz_datetime_handler(nz_df)
-    nz_df = nz_location_handler(nz_df)
+def nz_structure_coercer(nz_df):
+    """
+    Function which assigns the crash ids and coerces the data to the final staging structure.
+    ---
     
+    Keyword Arguments:
+    nz_df -- pandas dataframe of the harmonised nz data.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
     #generate the primary key field.
     logging.info('Generating IDs...')
     nz_df['crash_id'] = nz_df['OBJECTID'].astype(str).apply(lambda x: 'NZ'+x)
     logging.info('Coercing to final staging structure...')
-    nz_df = structure_checker(nz_df, expected_fields, coerce = True)
+    
+    return structure_checker(nz_df, expected_fields, coerce = True)
+
+#the nz etl as a pipeline of stages, see crash_pipeline. Each stage is handed the outputs of its inputs in order.
+nz_stages = [Stage('load', lambda params: nz_data_loader(params['years'], params['since']), ['params']),
+             Stage('harmonise', nz_harmoniser, ['load']),
+             Stage('datetime', nz_datetime_handler, ['harmonise']),
+             Stage('location', nz_location_handler, ['datetime']),
+             Stage('coerce', nz_structure_coercer, ['location'])]
+
+def nz_stage_builder(nz_df):
+    """
+    Function which runs the stages after load over raw nz rows in memory, without checkpoints. NZ rows are independent of each other so this can be 
+    applied to any chunk of the file.
+    ---
+    
+    Keyword Arguments:
+    nz_df -- pandas dataframe containing raw rows of the nz crash data.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
+    for stage in nz_stages[1:]:
+        nz_df = stage.function(nz_df)
     
     return nz_df
 
+def nz_stream(chunksize, staging_path = None, years = None, since = None):
+    """
+    Function which conducts the etl for new zealand data a chunk at a time, writing each staged chunk out as a parquet part file before reading the next. 
+    Peak memory is set by the chunk size rather than the size of the file.
+    ---
+    
+    Keyword Arguments:
+    chunksize -- integer number of raw rows processed at a time.
+    staging_path -- string path the part files are written below. Defaults to Staging/NZ under the storage root. Existing parts are removed first.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    part_paths -- list of string paths of the part files written, in file order.
+    """
+    if staging_path is None:
+        staging_path = storage_path('Staging', 'NZ')
+    storage_remover(staging_path)
+    
+    #category dtypes would be decided per chunk and differ between parts - read the labels as strings and let the harmonisers map them.
+    read_kwargs = read_schema_kwargs(nz_read_schema)
+    read_kwargs['dtype'] = {field: dtype for field, dtype in read_kwargs['dtype'].items() if dtype != 'category'}
+    
+    part_paths = []
+    for chunk_df in storage_read_csv_chunks(storage_path('crash_nz', 'crash_nz.csv'), chunksize, **read_kwargs):
+        chunk_df = chunk_df[year_mask(chunk_df['crashYear'], years, since)]
+        if chunk_df.empty:
+            continue
+        
+        logging.info(f'Staging nz chunk {len(part_paths)} ({len(chunk_df)} rows)...')
+        part_path = f'{staging_path}/part-{len(part_paths):05d}.parquet'
+        storage_write_parquet(nz_stage_builder(chunk_df), part_path, index=False)
+        part_paths.append(part_path)
+    
+    return part_paths
+
+def nz_inputs(years = None, since = None):
+    """
+    Function which gives the run parameters and raw sources of the new zealand etl.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    params -- dictionary of run parameters handed to the stages.
+    sources -- list of storage paths of the raw data read.
+    """
+    sources = [storage_path('crash_nz', 'crash_nz.csv')]
+    
+    return {'years': None if years is None else sorted(years), 'since': since}, sources
+
+def nz_fingerprint(years = None, since = None):
+    """
+    Function which fingerprints the inputs of the new zealand etl - the raw sources' versions, the run parameters and the code. The fingerprint changes 
+    whenever a rerun could give a different result.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    fingerprint -- hex string.
+    """
+    params, sources = nz_inputs(years, since)
+    
+    return pipeline_fingerprint('NZ', nz_stages, params, [__file__], sources)
+
+def nz_main(chunksize = nz_stream_chunksize, years = None, since = None):
+    """
+    Function which conducts the etl to the final staging structure for new zealand data
+    ---
+    
+    Keyword Arguments:
+    chunksize -- integer number of raw rows processed at a time. If set, the data is staged through part files by nz_stream and the paths of the parts
+                 are returned in place of the data frame. If None the file is read and processed whole.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format, or list of the storage paths of its parquet parts if streamed.
+    """
+    if chunksize is not None:
+        logging.info(f'Streaming nz data in chunks of {chunksize} rows...')
+        with stage_instrument('NZ', 'stream'):
+            part_paths = nz_stream(chunksize, years = years, since = since)
+        if not part_paths:
+            return pd.DataFrame(columns = expected_fields)
+        
+        #the parts are handed on rather than joined, so the final build reads them one at a time and the whole table is never in memory.
+        return part_paths
+    
+    params, sources = nz_inputs(years, since)
+    
+    return pipeline_runner('NZ', nz_stages, params, checkpoint_dir, [__file__], sources)
+
 
 if __name__ is '__main__':
     nz_main()
\ No newline at end of file
@@ -4,6 +4,8 @@ import pyarrow
 import pyproj
 import configparser
 from crash_utilities import *
+from crash_storage import storage_path, storage_read_parquet
+from crash_pipeline import Stage, pipeline_runner, pipeline_fingerprint
 from datetime import datetime
 
 #read the config file to extract the aws credentials
@@ -12,10 +14,31 @@ config.read('config_file.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-#set the base s3_path for subsequent manipulation 
-s3_path = config['S3']['S3_BUCKET_PATH']
+#optional checkpoints of every pipeline stage's output - a rerun after a failure resumes from the last stage saved.
+checkpoint_dir = config.get('CACHE', 'CHECKPOINT_DIR', fallback=None) or None
 
 
+#declarative mapping of the raw QLD unit type fields to the harmonised vehicle fields. Compiled once into an incidence matrix.
+qld_vehicle_mapping = {'animals': [],
+                       'car_sedan': ['Count_Unit_Car'],
+                       'car_utility': [],
+                       'car_van': [],
+                       'car_4x4': [],
+                       'car_station_wagon': [],
+                       'motor_cycle': ['Count_Unit_Motorcycle_Moped'],
+                       'truck_small': [],
+                       'truck_large': ['Count_Unit_Truck'],
+                       'bus': ['Count_Unit_Bus'],
+                       'taxi': [],
+                       'bicycle': ['Count_Unit_Bicycle'],
+                       'scooter': [],
+                       'pedestrian': ['Count_Unit_Pedestrian'],
+                       'inanimate': [],
+                       'train': [],
+                       'tram': [],
+                       'vehicle_other': ['Count_Unit_Other']}
+qld_vehicle_incidence = vehicle_incidence_compiler(qld_vehicle_mapping)
+
 def qld_vehicle_summary_harmoniser(df):
     """
     Function which maps vehicle type fields to the vehicle types preferred in the dataset.
@@ -29,57 +52,17 @@ def qld_vehicle_summary_harmoniser(df):
     """
     logging.info('Parsing vehicle data...')
     
-    logging.info('Declare mappings')
-    #declare mappings
-    animal_fields = []
-    car_sedan_fields = ['Count_Unit_Car']
-    car_utility_fields = []
-    car_van_fields = []
-    car_4x4_fields = []
-    car_station_wagon_fields = []
-    motor_cycle_fields = ['Count_Unit_Motorcycle_Moped']
-    truck_small_fields = []
-    truck_large_fields = ['Count_Unit_Truck'] 
-    bus_fields = ['Count_Unit_Bus']
-    taxi_fields = []
-    bicycle_fields = ['Count_Unit_Bicycle']
-    scooter_fields = []
-    pedestrian_fields = ['Count_Unit_Pedestrian']
-    inanimate_fields = []
-    train_fields = []
-    tram_fields = []
-    vehicle_other_fields = ['Count_Unit_Other']
-    
     logging.info('Summing values...')
-    #apply the mapping by summing columns in each field name. 
-    #df['animals'] = df[animal_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['car_sedan'] = df[car_sedan_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_utility'] = df[car_utility_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_van'] = df[car_van_fields].apply(sum, axis=1).fillna(0)
-    #df['car_4x4'] = df[car_4x4_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_station_wagon'] = df[car_station_wagon_fields].apply(sum, axis=1).fillna(0)
-    df['motor_cycle'] = df[motor_cycle_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['truck_small'] = df[truck_small_fields].apply(sum, axis=1).fillna(0)
-    df['truck_large'] = df[truck_large_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['bus'] = df[bus_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['taxi'] = df[taxi_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['bicycle'] = df[bicycle_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['scooter'] = df[scooter_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['pedestrian'] = df[pedestrian_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['inanimate'] = df[inanimate_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['train'] = df[train_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['tram'] = df[tram_fields].apply(sum, axis=1).fillna(0)
-    df['vehicle_other'] = df[vehicle_other_fields].astype(int).apply(sum, axis=1).fillna(0)
-    
-    #add in two missing fields using structure checker
-    logging.info('Adding missing fields...')
-    df = structure_checker(df, expected_vehicle_fields, coerce=True, add_only = True)
+    #apply the mapping - every harmonised field is totalled from the raw fields in a single matrix product.
+    totals_df = vehicle_category_aggregator(df, qld_vehicle_incidence)
+    for field in expected_vehicle_fields:
+        df[field] = totals_df[field]
     
     #add in 0s
     df[expected_vehicle_fields] = df[expected_vehicle_fields].fillna(0).astype(int)
     
     #generate IDs 
-    df['vehicles_id'] = df.apply(vehicles_id_generator, axis=1)
+    df['vehicles_id'] = vehicles_id_builder(df)
             
     return df
     
@@ -104,7 +87,7 @@ def qld_casualties_summary_harmoniser(df):
                             'Count_Casualty_Total':'casualties'})
     
     #now generate the id field
-    df['casualties_id'] = df.apply(casualties_id_generator, axis=1)
+    df['casualties_id'] = casualties_id_builder(df)
     
     return df
     
@@ -121,24 +104,24 @@ def qld_description_harmoniser(df):
     
     #go down the list of things we can get for vic
     #severity - coerce to int bcause victoria records as int and dictionary accepts string keys
-    df['severity'] = df['Crash_Severity'].apply(lambda x: severity_dict[x])
+    df['severity'] = categorical_mapper(df['Crash_Severity'], severity_lookup)
         
     #intersection and midblock are opposites of one another.
-    df['midblock'] = df['Crash_Roadway_Feature'].apply(lambda x: midblock_dict[x])
+    df['midblock'] = categorical_mapper(df['Crash_Roadway_Feature'], midblock_lookup)
     df['intersection'] = (df['midblock']==False)
     
     #road positions
-    df['road_position_horizontal'] = df['Crash_Road_Horiz_Align'].apply(lambda x: road_position_horizontal_dict[x])
-    df['road_position_vertical'] = df['Crash_Road_Vert_Align'].apply(lambda x: road_position_vertical_dict[x])
+    df['road_position_horizontal'] = categorical_mapper(df['Crash_Road_Horiz_Align'], road_position_horizontal_lookup)
+    df['road_position_vertical'] = categorical_mapper(df['Crash_Road_Vert_Align'], road_position_vertical_lookup)
     
     #road_surface details
-    df['road_sealed'] = df['Crash_Road_Surface_Condition'].apply(lambda x: road_sealed_dict[x])
-    df['road_wet'] = df['Crash_Road_Surface_Condition'].apply(lambda x: road_wet_dict[x])
+    df['road_sealed'] = categorical_mapper(df['Crash_Road_Surface_Condition'], road_sealed_lookup)
+    df['road_wet'] = categorical_mapper(df['Crash_Road_Surface_Condition'], road_wet_lookup)
     
     #other condition
-    df['weather'] = df['Crash_Atmospheric_Condition'].apply(lambda x: weather_dict[x])
-    df['lighting'] = df['Crash_Lighting_Condition'].apply(lambda x: lighting_dict[x])
-    df['traffic_controls'] = df['Crash_Traffic_Control'].apply(lambda x: traffic_controls_dict[x])
+    df['weather'] = categorical_mapper(df['Crash_Atmospheric_Condition'], weather_lookup)
+    df['lighting'] = categorical_mapper(df['Crash_Lighting_Condition'], lighting_lookup)
+    df['traffic_controls'] = categorical_mapper(df['Crash_Traffic_Control'], traffic_controls_lookup)
     
     #rename: speedLimit --> speed_limit
     df = df.rename(columns = {'Crash_Speed_Limit': 'speed_limit'})
@@ -167,8 +150,8 @@ def qld_datetime_handler(df):
     #rename
     df = df.rename(columns = {'Crash_Year': 'year', 'Crash_Hour': 'hour'})
     
-    df['date_time_id'] = (df['year'].apply(str) + '-' + df['month'].apply(str) + '-' + df['day_of_month'].fillna('') + '-' + df['day_of_week'].apply(str) 
-                         + '-' + df['hour'].apply(str))
+    #pack the parts into a single integer key - datetime_key_formatter gives back the legacy string.
+    df['date_time_id'] = datetime_key_builder(df)
     
     return df
     
@@ -186,7 +169,7 @@ def qld_location_handler(df):
     logging.info('Parsing location data...')
     
     #generate the key field
-    df['lat_long'] = df[['Crash_Latitude_GDA94', 'Crash_Longitude_GDA94']].apply(lambda x: (x[0], x[1]), axis=1)
+    df['lat_long'] = location_key_builder(df['Crash_Latitude_GDA94'], df['Crash_Longitude_GDA94'])
     
     #assign country and state
     df = df.assign(country = 'AU')
@@ -199,38 +182,117 @@ def qld_location_handler(df):
     return df
     
     
-def qld_main():
+def qld_data_loader(years = None, since = None):
     """
-    Function which conducts the etl to the final staging structure for new zealand data
+    Function which loads the queensland crash data into memory as a pandas dataframe from the s3 storage location.
     ---
     
     Keyword Arguments:
-    None.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
     
     Returns:
-    Data frame containing the structure coerced appropriately to the correct format.
+    qld_df -- pandas dataframe containing the queensland crash data
     """
     #read the datasets
     logging.info('Read in datasets...')
-    qld_df = pd.read_parquet(s3_path+'/crash_qld/crash')
+    #the year filter is pushed into the parquet scan - row groups outside the years are skipped on their statistics.
+    qld_df = storage_read_parquet(storage_path('crash_qld', 'crash'), filters = year_filter_builder('Crash_Year', years, since))
     
-    #field harmonisation
+    return qld_df
+
+def qld_harmoniser(qld_df):
+    """
+    Function which runs the field harmonisers.
+    ---
+    
+    Keyword Arguments:
+    qld_df -- pandas dataframe of the raw queensland crash data.
+    
+    Returns:
+    qld_df -- pandas dataframe with the harmonised fields.
+    """
     logging.info('Harmonising and renaming fields...')
     qld_df = qld_vehicle_summary_harmoniser(qld_df)
     qld_df = qld_casualties_summary_harmoniser(qld_df)
     qld_df = qld_description_harmoniser(qld_df)
+    
+    return qld_df
 
-    #field name changing
-    qld_df = qld_datetime_handler(qld_df)
-    qld_df = qld_location_handler(qld_df)
+def qld_structure_coercer(qld_df):
+    """
+    Function which assigns the crash ids and coerces the data to the final staging structure.
+    ---
     
+    Keyword Arguments:
+    qld_df -- pandas dataframe of the harmonised queensland data.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
     #generate the primary key field.
     logging.info('Generating IDs...')
     qld_df['crash_id'] = qld_df['Crash_Ref_Number'].astype(str).apply(lambda x: 'QLD'+x)
     logging.info('Coercing to final staging structure...')
-    qld_df = structure_checker(qld_df, expected_fields, coerce = True)
     
-    return qld_df
+    return structure_checker(qld_df, expected_fields, coerce = True)
+
+#the queensland etl as a pipeline of stages, see crash_pipeline. Each stage is handed the outputs of its inputs in order.
+qld_stages = [Stage('load', lambda params: qld_data_loader(params['years'], params['since']), ['params']),
+              Stage('harmonise', qld_harmoniser, ['load']),
+              Stage('datetime', qld_datetime_handler, ['harmonise']),
+              Stage('location', qld_location_handler, ['datetime']),
+              Stage('coerce', qld_structure_coercer, ['location'])]
+
+def qld_inputs(years = None, since = None):
+    """
+    Function which gives the run parameters and raw sources of the queensland etl.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    params -- dictionary of run parameters handed to the stages.
+    sources -- list of storage paths of the raw data read.
+    """
+    sources = [storage_path('crash_qld', 'crash')]
+    
+    return {'years': None if years is None else sorted(years), 'since': since}, sources
+
+def qld_fingerprint(years = None, since = None):
+    """
+    Function which fingerprints the inputs of the queensland etl - the raw sources' versions, the run parameters and the code. The fingerprint changes 
+    whenever a rerun could give a different result.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    fingerprint -- hex string.
+    """
+    params, sources = qld_inputs(years, since)
+    
+    return pipeline_fingerprint('QLD', qld_stages, params, [__file__], sources)
+
+def qld_main(years = None, since = None):
+    """
+    Function which conducts the etl to the final staging structure for queensland data
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
+    params, sources = qld_inputs(years, since)
+    
+    return pipeline_runner('QLD', qld_stages, params, checkpoint_dir, [__file__], sources)
 
 
 if __name__ is '__main__':
@@ -4,7 +4,11 @@ import pyarrow
 import pyproj
 import configparser
 from crash_utilities import *
+from crash_storage import storage_path
+from crash_cache import cached_csv_reader
+from crash_pipeline import Stage, pipeline_runner, pipeline_fingerprint
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 #read the config file to extract the aws credentials
 config = configparser.ConfigParser()
@@ -12,40 +16,60 @@ config.read('config_file.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-#set the base s3_path for subsequent manipulation 
-s3_path = config['S3']['S3_BUCKET_PATH']
+#optional on disk cache of projected coordinates - points seen in earlier runs are not reprojected.
+coord_cache_dir = config.get('CACHE', 'COORD_CACHE_DIR', fallback=None) or None
 
-def sa_data_loader(year_start = 2012, year_end = 2019):
+#optional local parquet mirror of the raw csv files - unchanged files are loaded from the mirror rather than parsed again.
+raw_cache_dir = config.get('CACHE', 'RAW_CACHE_DIR', fallback=None) or None
+
+#optional checkpoints of every pipeline stage's output - a rerun after a failure resumes from the last stage saved.
+checkpoint_dir = config.get('CACHE', 'CHECKPOINT_DIR', fallback=None) or None
+
+#columns read from each raw sa file and the dtypes they are parsed as - this is everything the sa etl consumes. None leaves pandas to infer the dtype.
+#labels only ever looked up or passed through are categories. Month, Day and Unit Type stay as strings as they are mapped or grouped on directly.
+sa_read_schemas = {'crash': {'REPORT_ID': None, 'Year': 'int16', 'Month': None, 'Day': None, 'Time': None, 
+                             'Total Cas': 'int16', 'Total Fats': 'int16', 'Total SI': 'int16', 'Total MI': 'int16', 
+                             'CSEF Severity': 'category', 'Position Type': 'category', 'Horizontal Align': 'category', 'Vertical Align': 'category', 
+                             'Road Surface': 'category', 'Moisture Cond': 'category', 'Weather Cond': 'category', 'DayNight': 'category', 
+                             'Traffic Ctrls': 'category', 'Area Speed': None, 'Crash Type': 'category', 'DUI Involved': 'category', 
+                             'ACCLOC_X': 'float64', 'ACCLOC_Y': 'float64', 'LGA Name': 'category', 'Suburb': 'category'},
+                   'units': {'REPORT_ID': None, 'Unit Type': None, 'Unit No': None}}
+
+def sa_data_loader(year_start = 2012, year_end = 2019, years = None, max_workers = 8):
     """
-    Function which loads the two relevant table types into memory as pandas dataframes from the s3 storage location.
+    Function which loads the two relevant table types into memory as pandas dataframes from the s3 storage location. Every year's files are fetched 
+    concurrently and concatenated once at the end.
     ---
     
     Keyword Arguments:
     year_start (int) -- The first year to be read in from the s3 storage location.
     year_end (int) -- The final year to be read in from the s3 storage location.
+    years (iterable of int) -- The years to be read in. Overrides year_start and year_end, and need not be contiguous.
+    max_workers (int) -- The largest number of files fetched at the same time.
     
     Returns:
     crash_df -- data stored in s3 buckets as {year}_DATA_SA_Crash.csv files. This contains information regarding most parts of the crash.
     unit_df -- data stored in s3 buckets as {year}_DATA_SA_Units.csv files. This contains information regarding vehicles involved in the crash.
     """
     #declare file strings for subsequent format manipulation.
-    units_file_string = s3_path + "/crash_sa/road-crash-data-{}/{}_DATA_SA_Units.csv"
-    crash_main_file_string = s3_path + "/crash_sa/road-crash-data-{}/{}_DATA_SA_Crash.csv"
-    
-    #initialise two dataframes for the first year and then loop the rest
-    unit_df = pd.read_csv(units_file_string.format(year_start, year_start), low_memory=False)
-    crash_df = pd.read_csv(crash_main_file_string.format(year_start, year_start), low_memory=False)
-    
-    #initialise year range for the remaining years sought and loop through
-    year_range = range(year_start+1, year_end+1)
-    for year in year_range:
-        #read in the next year's data
-        next_year_crash_df = pd.read_csv(crash_main_file_string.format(year, year), low_memory=False)
-        next_year_unit_df = pd.read_csv(units_file_string.format(year, year), low_memory=False)
+    units_file_string = storage_path("crash_sa", "road-crash-data-{}", "{}_DATA_SA_Units.csv")
+    crash_main_file_string = storage_path("crash_sa", "road-crash-data-{}", "{}_DATA_SA_Crash.csv")
+    
+    if years is None:
+        years = range(year_start, year_end+1)
+    years = list(years)
+    
+    #reading is mostly waiting on s3 so threads are enough. Futures are kept in year order so the concatenated frames are too.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        crash_futures = [executor.submit(cached_csv_reader, crash_main_file_string.format(year, year), raw_cache_dir, low_memory=False, 
+                                         **read_schema_kwargs(sa_read_schemas['crash'])) for year in years]
+        unit_futures = [executor.submit(cached_csv_reader, units_file_string.format(year, year), raw_cache_dir, low_memory=False, 
+                                        **read_schema_kwargs(sa_read_schemas['units'])) for year in years]
         
-        #join to existing table
-        unit_df = pd.concat([unit_df, next_year_unit_df])
-        crash_df = pd.concat([crash_df, next_year_crash_df])
+        #join every year in one go rather than growing the tables a year at a time. Years with different labels concatenate to strings so recast.
+        crash_df = pd.concat([future.result() for future in crash_futures]).astype(read_schema_kwargs(sa_read_schemas['crash'])['dtype'])
+        unit_df = pd.concat([future.result() for future in unit_futures])
+    
     return crash_df, unit_df
 
 def sa_unit_summariser(df):
@@ -66,6 +90,29 @@ def sa_unit_summariser(df):
                          .pivot_table(index='REPORT_ID', columns='Unit Type', values='Count', aggfunc=sum, fill_value=0))
     return unit_summary_df
 
+#declarative mapping of the raw south australian unit type fields to the harmonised vehicle fields. Compiled once into an incidence matrix.
+sa_vehicle_mapping = {'animals': ['Animal - Domestic - Not Ridden', 'Animal - Wild', 'Animal Drawn Vehicle', 'Ridden Animal'],
+                      'car_sedan': ['Motor Cars - Sedan'],
+                      'car_utility': ['Utility'],
+                      'car_van': ['Forward Control Passenger Van', 'Panel Van'],
+                      'car_4x4': ['Motor Cars - Tourer'],
+                      'car_station_wagon': ['Station Wagon'],
+                      'motor_cycle': ['Motor Cycle'],
+                      'truck_small': ['Light Truck LT 4.5T'],
+                      'truck_large': ['BDOUBLE - ROAD TRAIN', 'RIGID TRUCK LGE GE 4.5T', 'SEMI TRAILER'],
+                      'bus': ['OMNIBUS'],
+                      'taxi': ['Taxi Cab'],
+                      'bicycle': ['Pedal Cycle', 'Power Asst. Bicycle'],
+                      'scooter': ['Scooter'],
+                      'pedestrian': ['Motorised Wheelchair/Gopher', 'Pedestrian on Footpath/Carpark', 'Pedestrian on Road',
+                                     'Small Wheel Vehicle User', 'Wheelchair / Elec. Wheelchair'],
+                      'inanimate': ['Bridge', 'Guard Rail', 'Other Fixed Obstruction', 'Other Inanimate Object', 'Pole - not Stobie', 'Tree',
+                                    'Sign Post', 'Stobie Pole', 'Traffic Signal Pole', 'Wire Rope Barrier'],
+                      'train': ['Railway Vehicle'],
+                      'tram': ['Tram'],
+                      'vehicle_other': ['Motor Vehicle - Type Unknown', 'Other Defined Special Vehicle']}
+sa_vehicle_incidence = vehicle_incidence_compiler(sa_vehicle_mapping)
+
 def sa_vehicle_summary_harmoniser(df):
     """
     Function which maps vehicle type fields to the vehicle types preferred in the dataset.
@@ -78,78 +125,18 @@ def sa_vehicle_summary_harmoniser(df):
     df -- Pandas dataframe object which contains the information harmonised to the preferred type list. Original fields will have been removed.
     """
     logging.info('Harmoninsing vehicles data...')
-    #declare mappings
-    logging.info('Declaring mappings...')
-    animal_fields = ['Animal - Domestic - Not Ridden',
-                     'Animal - Wild', 
-                     'Animal Drawn Vehicle', 
-                     'Ridden Animal']
-    car_sedan_fields = ['Motor Cars - Sedan']
-    car_utility_fields = ['Utility']
-    car_van_fields = ['Forward Control Passenger Van', 
-                      'Panel Van']
-    car_4x4_fields = ['Motor Cars - Tourer']
-    car_station_wagon_fields = ['Station Wagon']
-    motor_cycle_fields = ['Motor Cycle']
-    truck_small_fields = ['Light Truck LT 4.5T']
-    truck_large_fields = ['BDOUBLE - ROAD TRAIN', 
-                          'RIGID TRUCK LGE GE 4.5T', 
-                          'SEMI TRAILER'] 
-    bus_fields = ['OMNIBUS']
-    taxi_fields = ['Taxi Cab']
-    bicycle_fields = ['Pedal Cycle', 
-                      'Power Asst. Bicycle']
-    scooter_fields = ['Scooter']
-    pedestrian_fields = ['Motorised Wheelchair/Gopher', 
-                         'Pedestrian on Footpath/Carpark', 
-                         'Pedestrian on Road', 
-                         'Small Wheel Vehicle User', 
-                         'Wheelchair / Elec. Wheelchair']
-    inanimate_fields = ['Bridge', 
-                        'Guard Rail', 
-                        'Other Fixed Obstruction', 
-                        'Other Inanimate Object', 
-                        'Pole - not Stobie', 
-                        'Tree', 'Sign Post', 
-                        'Stobie Pole', 
-                        'Traffic Signal Pole',
-                        'Wire Rope Barrier']
-    train_fields = ['Railway Vehicle']
-    tram_fields = ['Tram']
-    vehicle_other_fields = ['Motor Vehicle - Type Unknown', 
-                            'Other Defined Special Vehicle']
-    
     logging.info('Totaling values...')
-    #apply the mapping by summing columns in each field name. 
-    df['animals'] = df[animal_fields].apply(sum, axis=1).fillna(0)
-    df['car_sedan'] = df[car_sedan_fields].apply(sum, axis=1).fillna(0)
-    df['car_utility'] = df[car_utility_fields].apply(sum, axis=1).fillna(0)
-    df['car_van'] = df[car_van_fields].apply(sum, axis=1).fillna(0)
-    df['car_4x4'] = df[car_4x4_fields].apply(sum, axis=1).fillna(0)
-    df['car_station_wagon'] = df[car_station_wagon_fields].apply(sum, axis=1).fillna(0)
-    df['motor_cycle'] = df[motor_cycle_fields].apply(sum, axis=1).fillna(0)
-    df['truck_small'] = df[truck_small_fields].apply(sum, axis=1).fillna(0)
-    df['truck_large'] = df[truck_large_fields].apply(sum, axis=1).fillna(0)
-    df['bus'] = df[bus_fields].apply(sum, axis=1).fillna(0)
-    df['taxi'] = df[taxi_fields].apply(sum, axis=1).fillna(0)
-    df['bicycle'] = df[bicycle_fields].apply(sum, axis=1).fillna(0)
-    df['scooter'] = df[scooter_fields].apply(sum, axis=1).fillna(0)
-    df['pedestrian'] = df[pedestrian_fields].apply(sum, axis=1).fillna(0)
-    df['inanimate'] = df[inanimate_fields].apply(sum, axis=1).fillna(0)
-    df['train'] = df[train_fields].apply(sum, axis=1).fillna(0)
-    df['tram'] = df[tram_fields].apply(sum, axis=1).fillna(0)
-    df['vehicle_other'] = df[vehicle_other_fields].apply(sum, axis=1).fillna(0)
+    #apply the mapping - every harmonised field is totalled from the raw fields in a single matrix product.
+    totals_df = vehicle_category_aggregator(df, sa_vehicle_incidence)
+    for field in expected_vehicle_fields:
+        df[field] = totals_df[field]
     
     logging.info('Generating IDs...')
     #generate IDs 
-    df['vehicles_id'] = df.apply(vehicles_id_generator, axis=1)
+    df['vehicles_id'] = vehicles_id_builder(df)
     
     #dump the originals
-    dump_fields = [animal_fields, car_sedan_fields, car_utility_fields, car_van_fields, car_4x4_fields, car_station_wagon_fields, motor_cycle_fields, truck_small_fields,
-                   truck_large_fields, bus_fields, taxi_fields, bicycle_fields, scooter_fields, pedestrian_fields, inanimate_fields, train_fields, tram_fields, 
-                   vehicle_other_fields]
-    for field_list in dump_fields:
-        df = df.drop(columns = field_list)
+    df = df.drop(columns = sa_vehicle_incidence.raw_fields)
         
     return df
     
@@ -170,7 +157,7 @@ def sa_casualties_summary_harmoniser(df):
     df = df.rename(columns={'Total Cas':'casualties', 'Total Fats':'fatalities', 'Total SI':'serious_injuries', 'Total MI':'minor_injuries'})
     
     #now generate the id field
-    df['casualties_id'] = df.apply(casualties_id_generator, axis=1)
+    df['casualties_id'] = casualties_id_builder(df)
     
     return df
     
@@ -190,24 +177,24 @@ def sa_description_harmoniser(df):
 
     #go down the list of things we can get for sa data
     #severity
-    df['severity'] = df['CSEF Severity'].apply(lambda x: severity_dict[x])
+    df['severity'] = categorical_mapper(df['CSEF Severity'], severity_lookup)
     
     #intersection and midblock are opposites of one another.
-    df['midblock'] = df['Position Type'].apply(lambda x: midblock_dict[x])
+    df['midblock'] = categorical_mapper(df['Position Type'], midblock_lookup)
     df['intersection'] = (df['midblock']==False)
     
     #road positions
-    df['road_position_horizontal'] = df['Horizontal Align'].apply(lambda x: road_position_horizontal_dict[x])
-    df['road_position_vertical'] = df['Vertical Align'].apply(lambda x: road_position_vertical_dict[x])
+    df['road_position_horizontal'] = categorical_mapper(df['Horizontal Align'], road_position_horizontal_lookup)
+    df['road_position_vertical'] = categorical_mapper(df['Vertical Align'], road_position_vertical_lookup)
     
     #road condition
-    df['road_sealed'] = df['Road Surface'].apply(lambda x: road_sealed_dict[x])
-    df['road_wet'] = df['Moisture Cond'].apply(lambda x: road_wet_dict[x])
+    df['road_sealed'] = categorical_mapper(df['Road Surface'], road_sealed_lookup)
+    df['road_wet'] = categorical_mapper(df['Moisture Cond'], road_wet_lookup)
     
     #other condition
-    df['weather'] = df['Weather Cond'].apply(lambda x: weather_dict[x])
-    df['lighting'] = df['DayNight'].apply(lambda x: lighting_dict[x])
-    df['traffic_controls'] = df['Traffic Ctrls'].apply(lambda x: traffic_controls_dict[x])
+    df['weather'] = categorical_mapper(df['Weather Cond'], weather_lookup)
+    df['lighting'] = categorical_mapper(df['DayNight'], lighting_lookup)
+    df['traffic_controls'] = categorical_mapper(df['Traffic Ctrls'], traffic_controls_lookup)
     
     #rename: Area Speed --> speed_limit,  Crash Type --> crash_type, DUI Involved --> drugs_alcohol
     df = df.rename(columns = {'Area Speed': 'speed_limit', 'Crash Type': 'crash_type', 'DUI Involved': 'drugs_alcohol'})
@@ -237,8 +224,8 @@ def sa_datetime_handler(df):
     #rename
     df = df.rename(columns = {'Year': 'year'})
     
-    df['date_time_id'] = (df['year'].apply(str) + '-' + df['month'].apply(str) + '-' + df['day_of_month'].fillna('') + '-' + df['day_of_week'].apply(str) 
-                         + '-' + df['hour'].apply(str))
+    #pack the parts into a single integer key - datetime_key_formatter gives back the legacy string.
+    df['date_time_id'] = datetime_key_builder(df)
     
     return df
     
@@ -254,7 +241,7 @@ def sa_location_handler(df):
     df - dataframe object with reformatted description information.
     """
     logging.info('Parsing location information...')
-    df['lat_long'] = df[['calc_lat', 'calc_long']].apply(lambda x: (x[0], x[1]), axis=1)
+    df['lat_long'] = location_key_builder(df['calc_lat'], df['calc_long'])
     df = df.assign(country = 'AU')
     df = df.assign(state = 'SA')
     
@@ -267,51 +254,126 @@ def sa_location_handler(df):
     return df
     
     
-def sa_main():
+def sa_merger(sa_crash_df, sa_unit_summary_df):
     """
-    Function which conducts the etl to the final staging structure for south australian data
+    Function which joins the unit summary onto the crash data.
     ---
     
     Keyword Arguments:
-    None.
+    sa_crash_df -- pandas dataframe of the sa crash data.
+    sa_unit_summary_df -- pandas dataframe of the unit data summarised by sa_unit_summariser.
     
     Returns:
-    Data frame containing the structure coerced appropriately to the correct format.
+    sa_merge_df -- pandas dataframe with one row per crash.
     """
-    #read the datasets
-    logging.info('Read in datasets...')
-    sa_crash_df, sa_unit_df = sa_data_loader(year_start = 2012, year_end = 2018)
-    
-    #summarise the unit data
-    logging.info('Summarise vehicle data...')
-    sa_unit_summary_df = sa_unit_summariser(sa_unit_df)
-    
-    #merge the dataset
     logging.info('Merging datasets...')
-    sa_merge_df = sa_crash_df.merge(sa_unit_summary_df, on='REPORT_ID', how = 'left')
     
-    #coordinate translation
-    logging.info('Transforming SA map coordinates...')
-    sa_merge_df = map_coord_transformer(sa_merge_df, sa_proj_string, 'ACCLOC_X', 'ACCLOC_Y')
+    return sa_crash_df.merge(sa_unit_summary_df, on='REPORT_ID', how = 'left')
+
+def sa_harmoniser(sa_merge_df):
+    """
+    Function which runs the casualty, vehicle and description harmonisers.
+    ---
+    
+    Keyword Arguments:
+    sa_merge_df -- pandas dataframe of the merged sa data with calculated coordinates.
     
-    #field harmonisation
+    Returns:
+    sa_merge_df -- pandas dataframe with the harmonised fields.
+    """
     logging.info('Conduct field harmonisation and renaming...')
     sa_merge_df = sa_casualties_summary_harmoniser(sa_merge_df)
     sa_merge_df = sa_vehicle_summary_harmoniser(sa_merge_df)
     sa_merge_df = sa_description_harmoniser(sa_merge_df)
     
-    #field name changing
-    sa_merge_df = sa_datetime_handler(sa_merge_df)
-    sa_merge_df = sa_location_handler(sa_merge_df)
+    return sa_merge_df
+
+def sa_structure_coercer(sa_merge_df):
+    """
+    Function which assigns the crash ids and coerces the data to the final staging structure.
+    ---
+    
+    Keyword Arguments:
+    sa_merge_df -- pandas dataframe of the harmonised sa data.
     
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
     #generate the primary key field.
     logging.info('Assigning keys...')
     sa_merge_df['crash_id'] = sa_merge_df['REPORT_ID'].apply(lambda x: 'SA'+x)
     
     logging.info('Coercing to final staging table structure...')
-    sa_merge_df = structure_checker(sa_merge_df, expected_fields = expected_fields, coerce = True)
     
-    return sa_merge_df
+    return structure_checker(sa_merge_df, expected_fields = expected_fields, coerce = True)
+
+#sa years with published files
+sa_available_years = range(2012, 2019)
+
+#the sa etl as a pipeline of stages, see crash_pipeline. Each stage is handed the outputs of its inputs in order.
+sa_stages = [Stage('load', lambda params: sa_data_loader(years = year_selector(sa_available_years, params['years'], params['since'])), ['params']),
+             Stage('summarise', lambda loaded: sa_unit_summariser(loaded[1]), ['load']),
+             Stage('merge', lambda loaded, sa_unit_summary_df: sa_merger(loaded[0], sa_unit_summary_df), ['load', 'summarise']),
+             Stage('project', lambda df: map_coord_transformer(df, sa_proj_string, 'ACCLOC_X', 'ACCLOC_Y', cache_dir = coord_cache_dir), ['merge']),
+             Stage('harmonise', sa_harmoniser, ['project']),
+             Stage('datetime', sa_datetime_handler, ['harmonise']),
+             Stage('location', sa_location_handler, ['datetime']),
+             Stage('coerce', sa_structure_coercer, ['location'])]
+
+def sa_inputs(years = None, since = None):
+    """
+    Function which gives the run parameters and raw sources of the south australian etl.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    params -- dictionary of run parameters handed to the stages.
+    sources -- list of storage paths of the raw data read.
+    """
+    #sa is split into a file per year so only the wanted years' files are read, and only their versions go into the checkpoint keys.
+    sources = [storage_path('crash_sa', f'road-crash-data-{year}') for year in year_selector(sa_available_years, years, since)]
+    
+    return {'years': None if years is None else sorted(years), 'since': since}, sources
+
+def sa_fingerprint(years = None, since = None):
+    """
+    Function which fingerprints the inputs of the south australian etl - the raw sources' versions, the run parameters and the code. The fingerprint changes 
+    whenever a rerun could give a different result.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    fingerprint -- hex string.
+    """
+    params, sources = sa_inputs(years, since)
+    
+    return pipeline_fingerprint('SA', sa_stages, params, [__file__], sources)
+
+def sa_main(years = None, since = None):
+    """
+    Function which conducts the etl to the final staging structure for south australian data
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
+    params, sources = sa_inputs(years, since)
+    if not sources:
+        #no sa year is wanted, e.g. a reload of years after the sa data ends - there is nothing to read.
+        logging.info('No sa years selected - skipping the sa data run.')
+        return pd.DataFrame(columns = expected_fields)
+    
+    return pipeline_runner('SA', sa_stages, params, checkpoint_dir, [__file__], sources)
 
 
 if __name__ is '__main__':
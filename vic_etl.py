@@ -4,6 +4,9 @@ import pyarrow
 import pyproj
 import configparser
 from crash_utilities import *
+from crash_storage import storage_path
+from crash_cache import cached_csv_reader
+from crash_pipeline import Stage, pipeline_runner, pipeline_fingerprint
 from datetime import datetime
 
 #read the config file to extract the aws credentials
@@ -12,16 +15,32 @@ config.read('config_file.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-#set the base s3_path for subsequent manipulation 
-s3_path = config['S3']['S3_BUCKET_PATH']
+#optional on disk cache of projected coordinates - points seen in earlier runs are not reprojected.
+coord_cache_dir = config.get('CACHE', 'COORD_CACHE_DIR', fallback=None) or None
 
-def vic_data_loader():
+#optional local parquet mirror of the raw csv files - unchanged files are loaded from the mirror rather than parsed again.
+raw_cache_dir = config.get('CACHE', 'RAW_CACHE_DIR', fallback=None) or None
+
+#optional checkpoints of every pipeline stage's output - a rerun after a failure resumes from the last stage saved.
+checkpoint_dir = config.get('CACHE', 'CHECKPOINT_DIR', fallback=None) or None
+
+#columns read from each raw victorian file and the dtypes they are parsed as - this is everything the victorian etl consumes. None leaves pandas to infer 
+#the dtype. Labels only ever looked up or passed through are categories. The date and time stay as strings for joining and Vehicle Type Desc for grouping.
+vic_read_schemas = {'accident': {'ACCIDENT_NO': None, 'ACCIDENTDATE': None, 'ACCIDENTTIME': None, 'SEVERITY': 'int8', 'Road Geometry Desc': 'category', 
+                                 'Light Condition Desc': 'category', 'SPEED_ZONE': None, 'Accident Type Desc': 'category', 'DCA_CODE': None, 
+                                 'DCA Description': 'category', 'NO_PERSONS_KILLED': 'int16', 'NO_PERSONS_INJ_2': 'int16', 'NO_PERSONS_INJ_3': 'int16'},
+                    'node': {'ACCIDENT_NO': None, 'AMG_X': 'float64', 'AMG_Y': 'float64', 'LGA_NAME': 'category'},
+                    'atmospheric_cond': {'ACCIDENT_NO': None, 'Atmosph Cond Desc': 'category'},
+                    'vehicle': {'ACCIDENT_NO': None, 'Vehicle Type Desc': None, 'VEHICLE_ID': None}}
+
+def vic_data_loader(years = None, since = None):
     """
     Function which loads the two relevant table types into memory as pandas dataframes from the s3 storage location.
     ---
     
     Keyword Arguments:
-    None.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
     
     Returns:
     vic_df -- pandas dataframe containing the victorian crash data
@@ -31,11 +50,26 @@ def vic_data_loader():
     
     """
     
+    #filter the accidents on the year of ACCIDENTDATE (dd/mm/yyyy) as they are read, then keep only the other files' rows for those accidents.
+    accident_filter = None
+    if years is not None or since is not None:
+        accident_filter = lambda df: year_mask(df['ACCIDENTDATE'].str[-4:].astype(int), years, since)
+    
     #load specific Vic files into memory - ACCIDENT, NODE, ATMOSPHERIC_COND, VEHICLE
-    vic_df = pd.read_csv(s3_path + '/crash_vic/ACCIDENT.csv', low_memory = False)
-    vic_node_df = pd.read_csv(s3_path + '/crash_vic/NODE.csv', low_memory = False)
-    vic_atmos_df = pd.read_csv(s3_path + '/crash_vic/ATMOSPHERIC_COND.csv', low_memory = False)
-    vic_vehic_df = pd.read_csv(s3_path + '/crash_vic/VEHICLE.csv', low_memory = False)
+    vic_df = cached_csv_reader(storage_path('crash_vic', 'ACCIDENT.csv'), raw_cache_dir, accident_filter, low_memory = False, 
+                               **read_schema_kwargs(vic_read_schemas['accident']))
+    
+    related_filter = None
+    if accident_filter is not None:
+        accident_numbers = vic_df['ACCIDENT_NO'].unique()
+        related_filter = lambda df: df['ACCIDENT_NO'].isin(accident_numbers)
+    
+    vic_node_df = cached_csv_reader(storage_path('crash_vic', 'NODE.csv'), raw_cache_dir, related_filter, low_memory = False, 
+                                    **read_schema_kwargs(vic_read_schemas['node']))
+    vic_atmos_df = cached_csv_reader(storage_path('crash_vic', 'ATMOSPHERIC_COND.csv'), raw_cache_dir, related_filter, low_memory = False, 
+                                     **read_schema_kwargs(vic_read_schemas['atmospheric_cond']))
+    vic_vehic_df = cached_csv_reader(storage_path('crash_vic', 'VEHICLE.csv'), raw_cache_dir, related_filter, low_memory = False, 
+                                     **read_schema_kwargs(vic_read_schemas['vehicle']))
     
     return vic_df, vic_node_df, vic_atmos_df, vic_vehic_df
 
@@ -60,6 +94,28 @@ def vic_unit_summariser(df):
                            )
     return vic_vehic_summary_df
 
+#declarative mapping of the raw victorian unit type fields to the harmonised vehicle fields. Compiled once into an incidence matrix.
+vic_vehicle_mapping = {'animals': ['Horse (ridden or drawn)'],
+                       'car_sedan': ['Car'],
+                       'car_utility': ['Utility'],
+                       'car_van': ['Panel Van'],
+                       'car_4x4': [],
+                       'car_station_wagon': ['Station Wagon'],
+                       'motor_cycle': ['Motor Cycle', 'Quad Bike'],
+                       'truck_small': ['Light Commercial Vehicle (Rigid) <= 4.5 Tonnes GVM'],
+                       'truck_large': ['Heavy Vehicle (Rigid) > 4.5 Tonnes', 'Prime Mover (No of Trailers Unknown)', 'Prime Mover - Single Trailer',
+                                       'Prime Mover B-Double', 'Prime Mover B-Triple', 'Prime Mover Only', 'Rigid Truck(Weight Unknown)'],
+                       'bus': ['Bus/Coach', 'Mini Bus(9-13 seats)'],
+                       'taxi': ['Taxi'],
+                       'bicycle': ['Bicycle'],
+                       'scooter': ['Moped', 'Motor Scooter'],
+                       'pedestrian': [],
+                       'inanimate': ['Not Applicable', 'Parked trailers'],
+                       'train': ['Train'],
+                       'tram': ['Tram'],
+                       'vehicle_other': ['Other Vehicle', 'Plant machinery and Agricultural equipment', 'Unknown']}
+vic_vehicle_incidence = vehicle_incidence_compiler(vic_vehicle_mapping)
+
 def vic_vehicle_summary_harmoniser(df):
     """
     Function which maps vehicle type fields to the vehicle types preferred in the dataset.
@@ -72,57 +128,17 @@ def vic_vehicle_summary_harmoniser(df):
     df -- Pandas dataframe object which contains the information harmonised to the preferred type list. 
     """
     logging.info('Parsing vehicle data...')
-    logging.info('Declaring mappings...')
-    #declare mappings
-    animal_fields = ['Horse (ridden or drawn)']
-    car_sedan_fields = ['Car']
-    car_utility_fields = ['Utility']
-    car_van_fields = ['Panel Van']
-    car_4x4_fields = []
-    car_station_wagon_fields = ['Station Wagon']
-    motor_cycle_fields = ['Motor Cycle', 'Quad Bike']
-    truck_small_fields = ['Light Commercial Vehicle (Rigid) <= 4.5 Tonnes GVM']
-    truck_large_fields = ['Heavy Vehicle (Rigid) > 4.5 Tonnes', 'Prime Mover (No of Trailers Unknown)', 'Prime Mover - Single Trailer','Prime Mover B-Double', 
-                          'Prime Mover B-Triple', 'Prime Mover Only', 'Rigid Truck(Weight Unknown)'] 
-    bus_fields = ['Bus/Coach', 'Mini Bus(9-13 seats)']
-    taxi_fields = ['Taxi']
-    bicycle_fields = ['Bicycle']
-    scooter_fields = ['Moped', 'Motor Scooter']
-    pedestrian_fields = []
-    inanimate_fields = ['Not Applicable', 'Parked trailers']
-    train_fields = ['Train']
-    tram_fields = ['Tram']
-    vehicle_other_fields = ['Other Vehicle', 'Plant machinery and Agricultural equipment', 'Unknown']
-
     logging.info('Summing fields...')
-    #apply the mapping by summing columns in each field name. 
-    df['animals'] = df[animal_fields].apply(sum, axis=1).fillna(0)
-    df['car_sedan'] = df[car_sedan_fields].apply(sum, axis=1).fillna(0)
-    df['car_utility'] = df[car_utility_fields].apply(sum, axis=1).fillna(0)
-    df['car_van'] = df[car_van_fields].apply(sum, axis=1).fillna(0)
-    #df['car_4x4'] = df[car_4x4_fields].apply(sum, axis=1).fillna(0)
-    df['car_station_wagon'] = df[car_station_wagon_fields].apply(sum, axis=1).fillna(0)
-    df['motor_cycle'] = df[motor_cycle_fields].apply(sum, axis=1).fillna(0)
-    df['truck_small'] = df[truck_small_fields].apply(sum, axis=1).fillna(0)
-    df['truck_large'] = df[truck_large_fields].apply(sum, axis=1).fillna(0)
-    df['bus'] = df[bus_fields].apply(sum, axis=1).fillna(0)
-    df['taxi'] = df[taxi_fields].apply(sum, axis=1).fillna(0)
-    df['bicycle'] = df[bicycle_fields].apply(sum, axis=1).fillna(0)
-    df['scooter'] = df[scooter_fields].apply(sum, axis=1).fillna(0)
-    #df['pedestrian'] = df[pedestrian_fields].apply(sum, axis=1).fillna(0)
-    df['inanimate'] = df[inanimate_fields].apply(sum, axis=1).fillna(0)
-    df['train'] = df[train_fields].apply(sum, axis=1).fillna(0)
-    df['tram'] = df[tram_fields].apply(sum, axis=1).fillna(0)
-    df['vehicle_other'] = df[vehicle_other_fields].apply(sum, axis=1).fillna(0)
-    
-    #add in two missing fields using structure checker
-    df = structure_checker(df, expected_vehicle_fields, coerce=True, add_only = True)
+    #apply the mapping - every harmonised field is totalled from the raw fields in a single matrix product.
+    totals_df = vehicle_category_aggregator(df, vic_vehicle_incidence)
+    for field in expected_vehicle_fields:
+        df[field] = totals_df[field]
     
     #add in 0s
     df[expected_vehicle_fields] = df[expected_vehicle_fields].fillna(0).astype(int)
     
     #generate IDs 
-    df['vehicles_id'] = df.apply(vehicles_id_generator, axis=1)
+    df['vehicles_id'] = vehicles_id_builder(df)
             
     return df
     
@@ -147,7 +163,7 @@ def vic_casualties_summary_harmoniser(df):
     df['casualties'] = df['fatalities'] + df['serious_injuries'] + df['minor_injuries']
     
     #now generate the id field
-    df['casualties_id'] = df.apply(casualties_id_generator, axis=1)
+    df['casualties_id'] = casualties_id_builder(df)
     
     return df
     
@@ -165,15 +181,15 @@ def vic_description_harmoniser(df):
 
     #go down the list of things we can get for vic
     #severity - coerce to int bcause victoria records as int and dictionary accepts string keys
-    df['severity'] = df['SEVERITY'].astype(str).apply(lambda x: severity_dict[x])
+    df['severity'] = categorical_mapper(df['SEVERITY'].astype(str), severity_lookup)
     
     #intersection and midblock are opposites of one another.
-    df['midblock'] = df['Road Geometry Desc'].apply(lambda x: midblock_dict[x])
+    df['midblock'] = categorical_mapper(df['Road Geometry Desc'], midblock_lookup)
     df['intersection'] = (df['midblock']==False)
     
     #other condition
-    df['weather'] = df['Atmosph Cond Desc'].apply(lambda x: weather_dict[x])
-    df['lighting'] = df['Light Condition Desc'].apply(lambda x: lighting_dict[x])
+    df['weather'] = categorical_mapper(df['Atmosph Cond Desc'], weather_lookup)
+    df['lighting'] = categorical_mapper(df['Light Condition Desc'], lighting_lookup)
     
     #rename: SPEED_ZONE --> speed_limit,  Accident Type Desc --> crash_type, DCA_CODE --> DCA_code, DCA Description
     df = df.rename(columns = {'SPEED_ZONE': 'speed_limit', 'Accident Type Desc': 'crash_type', 'DCA_CODE': 'DCA_code', 'DCA Description': 'comment'})
@@ -198,7 +214,8 @@ def vic_datetime_handler(df):
     df['ACCIDENTDATETIME'] = df['ACCIDENTDATE'] + " " + df['ACCIDENTTIME']
     
     #introduce datetime variable
-    df['datetime'] = df['ACCIDENTDATETIME'].str.strip().apply(lambda x: datetime.strptime(x, '%d/%m/%Y %H:%M:%S'))
+    #the strptime results are cast too, as a selection of years with no crashes leaves an empty, untyped column.
+    df['datetime'] = pd.to_datetime(df['ACCIDENTDATETIME'].str.strip().apply(lambda x: datetime.strptime(x, '%d/%m/%Y %H:%M:%S')))
     
     #extract relevant parts
     df['year'] = df['datetime'].dt.year
@@ -210,9 +227,8 @@ def vic_datetime_handler(df):
     #assign approximate false because information provided is sufficient.
     df = df.assign(approximate = False)
     
-    #generate id using string operations.
-    df['date_time_id'] = (df['year'].apply(str) + '-' + df['month'].apply(str) + '-' + df['day_of_month'].fillna('').apply(str) + '-' + df['day_of_week'].apply(str) 
-                         + '-' + df['hour'].apply(str))
+    #pack the parts into a single integer key - datetime_key_formatter gives back the legacy string.
+    df['date_time_id'] = datetime_key_builder(df)
     
     return df
     
@@ -229,7 +245,7 @@ def vic_location_handler(df):
     """
     logging.info('Parsing location data...')
     
-    df['lat_long'] = df[['calc_lat', 'calc_long']].apply(lambda x: (x[0], x[1]), axis=1)
+    df['lat_long'] = location_key_builder(df['calc_lat'], df['calc_long'])
     
     df = df.assign(country = 'AU')
     df = df.assign(state = 'VIC')
@@ -240,25 +256,20 @@ def vic_location_handler(df):
     return df
     
     
-def vic_main():
+def vic_merger(vic_df, vic_node_df, vic_atmos_df, vic_vehic_summary_df):
     """
-    Function which conducts the etl to the final staging structure for victorian data
+    Function which joins the node, atmospheric condition and vehicle summary data onto the crash data.
     ---
     
     Keyword Arguments:
-    None.
+    vic_df -- pandas dataframe containing the victorian crash data
+    vic_node_df -- pandas dataframe containing the victorian node (location) data
+    vic_atmos_df -- pandas dataframe containing the victorian atmospheric condition (weather) data
+    vic_vehic_summary_df -- pandas dataframe of the vehicle data summarised by vic_unit_summariser.
     
     Returns:
-    Data frame containing the structure coerced appropriately to the correct format.
+    vic_merge_df -- pandas dataframe with one row per crash.
     """
-    #read the datasets
-    logging.info('Read in datasets...')
-    vic_df, vic_node_df, vic_atmos_df, vic_vehic_df = vic_data_loader()
-    
-    #summarise the vehicle data
-    logging.info('Summarising vehicle information')
-    vic_vehic_summary_df = vic_unit_summariser(vic_vehic_df)
-    
     #merge the dataset - main crash, then node, then atmospheric, finally vehicle summary
     logging.info('Merging datasets...')
     vic_merge_df = (vic_df
@@ -266,32 +277,105 @@ def vic_main():
                     .merge(vic_atmos_df, on = 'ACCIDENT_NO', how='left')
                     .merge(vic_vehic_summary_df, how = 'left', on = 'ACCIDENT_NO'))
     
+    return vic_merge_df
+
+def vic_harmoniser(vic_merge_df):
+    """
+    Function which runs the vehicle, casualty and description harmonisers.
+    ---
     
+    Keyword Arguments:
+    vic_merge_df -- pandas dataframe of the merged victorian data with calculated coordinates.
     
-    #coordinate translation
-    logging.info('Conducting coordinate translation...')
-    vic_merge_df = map_coord_transformer(vic_merge_df, vic_proj_string, 'AMG_X', 'AMG_X')
-    
-    
-    #field harmonisation
+    Returns:
+    vic_merge_df -- pandas dataframe with the harmonised fields.
+    """
     logging.info('Harmonising and renaming fields...')
     vic_merge_df = vic_vehicle_summary_harmoniser(vic_merge_df)
     vic_merge_df = vic_casualties_summary_harmoniser(vic_merge_df)
     vic_merge_df = vic_description_harmoniser(vic_merge_df)
+    
+    return vic_merge_df
 
-    #field name changing
-    vic_merge_df = vic_datetime_handler(vic_merge_df)
-    vic_merge_df = vic_location_handler(vic_merge_df)
+def vic_structure_coercer(vic_merge_df):
+    """
+    Function which assigns the crash ids and coerces the data to the final staging structure.
+    ---
     
+    Keyword Arguments:
+    vic_merge_df -- pandas dataframe of the harmonised victorian data.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
     #generate the primary key field.
     logging.info('Generating crash IDs...')
     vic_merge_df['crash_id'] = vic_merge_df['ACCIDENT_NO'].apply(lambda x: 'VIC'+x)
     
     #coerce to final staging structure.
     logging.info('Coercing to final staging structure...')
-    vic_merge_df = structure_checker(vic_merge_df, expected_fields, coerce = True)
     
-    return vic_merge_df
+    return structure_checker(vic_merge_df, expected_fields, coerce = True)
+
+#the victorian etl as a pipeline of stages, see crash_pipeline. Each stage is handed the outputs of its inputs in order.
+vic_stages = [Stage('load', lambda params: vic_data_loader(params['years'], params['since']), ['params']),
+              Stage('summarise', lambda loaded: vic_unit_summariser(loaded[3]), ['load']),
+              Stage('merge', lambda loaded, vic_vehic_summary_df: vic_merger(*loaded[:3], vic_vehic_summary_df), ['load', 'summarise']),
+              Stage('project', lambda df: map_coord_transformer(df, vic_proj_string, 'AMG_X', 'AMG_X', cache_dir = coord_cache_dir), ['merge']),
+              Stage('harmonise', vic_harmoniser, ['project']),
+              Stage('datetime', vic_datetime_handler, ['harmonise']),
+              Stage('location', vic_location_handler, ['datetime']),
+              Stage('coerce', vic_structure_coercer, ['location'])]
+
+def vic_inputs(years = None, since = None):
+    """
+    Function which gives the run parameters and raw sources of the victorian etl.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    params -- dictionary of run parameters handed to the stages.
+    sources -- list of storage paths of the raw data read.
+    """
+    sources = [storage_path('crash_vic', file_name) for file_name in ['ACCIDENT.csv', 'NODE.csv', 'ATMOSPHERIC_COND.csv', 'VEHICLE.csv']]
+    
+    return {'years': None if years is None else sorted(years), 'since': since}, sources
+
+def vic_fingerprint(years = None, since = None):
+    """
+    Function which fingerprints the inputs of the victorian etl - the raw sources' versions, the run parameters and the code. The fingerprint changes 
+    whenever a rerun could give a different result.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    fingerprint -- hex string.
+    """
+    params, sources = vic_inputs(years, since)
+    
+    return pipeline_fingerprint('VIC', vic_stages, params, [__file__], sources)
+
+def vic_main(years = None, since = None):
+    """
+    Function which conducts the etl to the final staging structure for victorian data
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
+    params, sources = vic_inputs(years, since)
+    
+    return pipeline_runner('VIC', vic_stages, params, checkpoint_dir, [__file__], sources)
 
 
 if __name__ is '__main__':
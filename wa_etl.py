@@ -4,6 +4,8 @@ import pyarrow
 import pyproj
 import configparser
 from crash_utilities import *
+from crash_storage import storage_path, storage_read_parquet
+from crash_pipeline import Stage, pipeline_runner, pipeline_fingerprint
 from datetime import datetime
 
 #read the config file to extract the aws credentials
@@ -12,10 +14,31 @@ config.read('config_file.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-#set the base s3_path for subsequent manipulation 
-s3_path = config['S3']['S3_BUCKET_PATH']
+#optional checkpoints of every pipeline stage's output - a rerun after a failure resumes from the last stage saved.
+checkpoint_dir = config.get('CACHE', 'CHECKPOINT_DIR', fallback=None) or None
 
 
+#declarative mapping of the raw WA unit type fields to the harmonised vehicle fields. Compiled once into an incidence matrix.
+wa_vehicle_mapping = {'animals': [],
+                      'car_sedan': [],
+                      'car_utility': [],
+                      'car_van': [],
+                      'car_4x4': [],
+                      'car_station_wagon': [],
+                      'motor_cycle': ['TOTAL_MOTOR_CYCLE_INVOLVED'],
+                      'truck_small': ['TOTAL_TRUCK_INVOLVED'],
+                      'truck_large': ['TOTAL_HEAVY_TRUCK_INVOLVED'],
+                      'bus': [],
+                      'taxi': [],
+                      'bicycle': ['TOTAL_BIKE_INVOLVED'],
+                      'scooter': [],
+                      'pedestrian': ['TOTAL_PEDESTRIANS_INVOLVED'],
+                      'inanimate': [],
+                      'train': [],
+                      'tram': [],
+                      'vehicle_other': ['TOTAL_OTHER_VEHICLES_INVOLVED']}
+wa_vehicle_incidence = vehicle_incidence_compiler(wa_vehicle_mapping)
+
 def wa_vehicle_summary_harmoniser(df):
     """
     Function which maps vehicle type fields to the vehicle types preferred in the dataset.
@@ -29,67 +52,17 @@ def wa_vehicle_summary_harmoniser(df):
     """
     logging.info('Parsing vehicle data...')
     
-    logging.info('Declare mappings')
-    #declare mappings
-    animal_fields = []
-    car_sedan_fields = []
-    car_utility_fields = []
-    car_van_fields = []
-    car_4x4_fields = []
-    car_station_wagon_fields = []
-    motor_cycle_fields = ['TOTAL_MOTOR_CYCLE_INVOLVED']
-    truck_small_fields = ['TOTAL_TRUCK_INVOLVED']
-    truck_large_fields = ['TOTAL_HEAVY_TRUCK_INVOLVED'] 
-    bus_fields = []
-    taxi_fields = []
-    bicycle_fields = ['TOTAL_BIKE_INVOLVED']
-    scooter_fields = []
-    pedestrian_fields = ['TOTAL_PEDESTRIANS_INVOLVED']
-    inanimate_fields = []
-    train_fields = []
-    tram_fields = []
-    vehicle_other_fields = ['TOTAL_OTHER_VEHICLES_INVOLVED']
-    
-    
-    
-    
-    
-    
-    
-    
-
-    
-    
     logging.info('Summing values...')
-    #apply the mapping by summing columns in each field name. 
-    #df['animals'] = df[animal_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_sedan'] = df[car_sedan_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_utility'] = df[car_utility_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_van'] = df[car_van_fields].apply(sum, axis=1).fillna(0)
-    #df['car_4x4'] = df[car_4x4_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['car_station_wagon'] = df[car_station_wagon_fields].apply(sum, axis=1).fillna(0)
-    df['motor_cycle'] = df[motor_cycle_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['truck_small'] = df[truck_small_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['truck_large'] = df[truck_large_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['bus'] = df[bus_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['taxi'] = df[taxi_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['bicycle'] = df[bicycle_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['scooter'] = df[scooter_fields].astype(int).apply(sum, axis=1).fillna(0)
-    df['pedestrian'] = df[pedestrian_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['inanimate'] = df[inanimate_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['train'] = df[train_fields].astype(int).apply(sum, axis=1).fillna(0)
-    #df['tram'] = df[tram_fields].apply(sum, axis=1).fillna(0)
-    df['vehicle_other'] = df[vehicle_other_fields].astype(int).apply(sum, axis=1).fillna(0)
-    
-    #add in two missing fields using structure checker
-    logging.info('Adding missing fields...')
-    df = structure_checker(df, expected_vehicle_fields, coerce=True, add_only = True)
+    #apply the mapping - every harmonised field is totalled from the raw fields in a single matrix product.
+    totals_df = vehicle_category_aggregator(df, wa_vehicle_incidence)
+    for field in expected_vehicle_fields:
+        df[field] = totals_df[field]
     
     #add in 0s
     df[expected_vehicle_fields] = df[expected_vehicle_fields].fillna(0).astype(int)
     
     #generate IDs 
-    df['vehicles_id'] = df.apply(vehicles_id_generator, axis=1)
+    df['vehicles_id'] = vehicles_id_builder(df)
             
     return df
     
@@ -106,13 +79,13 @@ def wa_description_harmoniser(df):
     
     #go down the list of things we can get for vic
     #severity - coerce to int bcause victoria records as int and dictionary accepts string keys
-    df['severity'] = df['SEVERITY'].apply(lambda x: severity_dict[x])
+    df['severity'] = categorical_mapper(df['SEVERITY'], severity_lookup)
     
     #build the crash type field out of EVENT_NATURE and EVENT_TYPE
     df['crash_type'] = df['EVENT_NATURE'] + ' ' +  df['EVENT_TYPE']
 
     #intersection and midblock are opposites of one another.
-    df['midblock'] = (df['ACCIDENT_TYPE'].fillna('Unknown').apply(lambda x: midblock_dict[x]))
+    df['midblock'] = (categorical_mapper(df['ACCIDENT_TYPE'].fillna('Unknown'), midblock_lookup))
     df['intersection'] = (df['midblock']==False)
     
     return df
@@ -136,7 +109,8 @@ def wa_datetime_handler(df):
     df['CRASH_DATETIME'] = df['CRASH_DATE'] + ' ' + df['crash_time_mod']
     
     #cast to datetime
-    df['datetime'] = df['CRASH_DATETIME'].str.strip().apply(lambda x: datetime.strptime(x, '%d/%m/%Y %H%M'))
+    #the strptime results are cast too, as a selection of years with no crashes leaves an empty, untyped column.
+    df['datetime'] = pd.to_datetime(df['CRASH_DATETIME'].str.strip().apply(lambda x: datetime.strptime(x, '%d/%m/%Y %H%M')))
     
     
     #extract relevant parts
@@ -149,9 +123,8 @@ def wa_datetime_handler(df):
     #assign approximate false because information provided is sufficient.
     df = df.assign(approximate = False)
     
-    #generate id using string operations.
-    df['date_time_id'] = (df['year'].apply(str) + '-' + df['month'].apply(str) + '-' + df['day_of_month'].fillna('').apply(str) + '-' + df['day_of_week'].apply(str) 
-                         + '-' + df['hour'].apply(str))
+    #pack the parts into a single integer key - datetime_key_formatter gives back the legacy string.
+    df['date_time_id'] = datetime_key_builder(df)
     return df
     
 def wa_location_handler(df):
@@ -168,7 +141,7 @@ def wa_location_handler(df):
     logging.info('Parsing location data...')
     
     #generate the key field
-    df['lat_long'] = df[['LATITUDE', 'LONGITUDE']].apply(lambda x: (x[0], x[1]), axis=1)
+    df['lat_long'] = location_key_builder(df['LATITUDE'], df['LONGITUDE'])
     
     #assign country and state
     df = df.assign(country = 'AU')
@@ -180,37 +153,119 @@ def wa_location_handler(df):
     return df
     
     
-def wa_main():
+def wa_data_loader(years = None, since = None):
     """
-    Function which conducts the etl to the final staging structure for new zealand data
+    Function which loads the western australian crash data into memory as a pandas dataframe from the s3 storage location.
     ---
     
     Keyword Arguments:
-    None.
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
     
     Returns:
-    Data frame containing the structure coerced appropriately to the correct format.
+    wa_df -- pandas dataframe containing the western australian crash data
     """
     #read the datasets
     logging.info('Read in datasets...')
-    wa_df = pd.read_parquet(s3_path + '/crash_wa/crash')
+    wa_df = storage_read_parquet(storage_path('crash_wa', 'crash'))
+    
+    #CRASH_DATE is a dd/mm/yyyy string - its statistics cannot rule out a year, so the filter is applied once read.
+    if years is not None or since is not None:
+        wa_df = wa_df[year_mask(wa_df['CRASH_DATE'].str[-4:].astype(int), years, since)].reset_index(drop = True)
     
-    #field harmonisation
+    return wa_df
+
+def wa_harmoniser(wa_df):
+    """
+    Function which runs the field harmonisers.
+    ---
+    
+    Keyword Arguments:
+    wa_df -- pandas dataframe of the raw western australian crash data.
+    
+    Returns:
+    wa_df -- pandas dataframe with the harmonised fields.
+    """
     logging.info('Harmonising and renaming fields...')
     wa_df = wa_vehicle_summary_harmoniser(wa_df)
     wa_df = wa_description_harmoniser(wa_df)
+    
+    return wa_df
 
-    #field name changing
-    wa_df = wa_datetime_handler(wa_df)
-    wa_df = wa_location_handler(wa_df)
+def wa_structure_coercer(wa_df):
+    """
+    Function which assigns the crash ids and coerces the data to the final staging structure.
+    ---
     
+    Keyword Arguments:
+    wa_df -- pandas dataframe of the harmonised western australian data.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
     #generate the primary key field.
     logging.info('Generating IDs...')
     wa_df['crash_id'] = wa_df['ACC_ID'].astype(str).apply(lambda x: 'WA'+x)
     logging.info('Coercing to final staging structure...')
-    wa_df = structure_checker(wa_df, expected_fields, coerce = True)
     
-    return wa_df
+    return structure_checker(wa_df, expected_fields, coerce = True)
+
+#the western australian etl as a pipeline of stages, see crash_pipeline. Each stage is handed the outputs of its inputs in order.
+wa_stages = [Stage('load', lambda params: wa_data_loader(params['years'], params['since']), ['params']),
+             Stage('harmonise', wa_harmoniser, ['load']),
+             Stage('datetime', wa_datetime_handler, ['harmonise']),
+             Stage('location', wa_location_handler, ['datetime']),
+             Stage('coerce', wa_structure_coercer, ['location'])]
+
+def wa_inputs(years = None, since = None):
+    """
+    Function which gives the run parameters and raw sources of the western australian etl.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    params -- dictionary of run parameters handed to the stages.
+    sources -- list of storage paths of the raw data read.
+    """
+    sources = [storage_path('crash_wa', 'crash')]
+    
+    return {'years': None if years is None else sorted(years), 'since': since}, sources
+
+def wa_fingerprint(years = None, since = None):
+    """
+    Function which fingerprints the inputs of the western australian etl - the raw sources' versions, the run parameters and the code. The fingerprint changes 
+    whenever a rerun could give a different result.
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    fingerprint -- hex string.
+    """
+    params, sources = wa_inputs(years, since)
+    
+    return pipeline_fingerprint('WA', wa_stages, params, [__file__], sources)
+
+def wa_main(years = None, since = None):
+    """
+    Function which conducts the etl to the final staging structure for western australian data
+    ---
+    
+    Keyword Arguments:
+    years -- iterable of integer years to load. If None every year is loaded.
+    since -- integer first year to load. If None there is no lower bound.
+    
+    Returns:
+    Data frame containing the structure coerced appropriately to the correct format.
+    """
+    params, sources = wa_inputs(years, since)
+    
+    return pipeline_runner('WA', wa_stages, params, checkpoint_dir, [__file__], sources)
 
 
 if __name__ is '__main__':